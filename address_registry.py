@@ -0,0 +1,91 @@
+import os
+import json
+import threading
+
+# Interns addresses into small integer ids so that the analysis maps key on ints
+# instead of hashing and comparing 42-char hex strings, and lowercases each address
+# once instead of on every tx. Ids are handed out in order of first sight and are
+# persisted, so an address keeps its id across updates. Maps are converted back to
+# hex keys with hex_keys right before they are written out.
+REGISTRY_FILE = "blockchain_data/address_registry.json"
+
+
+class AddressRegistry:
+    def __init__(self, filename=REGISTRY_FILE):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.addresses = []  # id -> lowercase hex address
+        self.ids = {}  # hex address, as given and lowercased -> id
+        self.saved = 0  # number of addresses in the file
+        if filename is not None and os.path.exists(filename):
+            with open(filename) as f:
+                for address in json.load(f):
+                    self.ids[address] = len(self.addresses)
+                    self.addresses.append(address)
+            self.saved = len(self.addresses)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    # returns the id of address. A missing address raises, as lowercasing it did
+    # before addresses were interned, instead of being counted under a None key.
+    def intern(self, address):
+        address_id = self.ids.get(address)
+        if address_id is not None:
+            return address_id
+        if address is None:
+            raise ValueError("missing address")
+        lower = address.lower()
+        with self.lock:
+            address_id = self.ids.get(lower)
+            if address_id is None:
+                address_id = len(self.addresses)
+                self.addresses.append(lower)
+                self.ids[lower] = address_id
+            # remembers the spelling as given, so the next lookup skips lower()
+            self.ids[address] = address_id
+        return address_id
+
+    def address(self, address_id):
+        return self.addresses[address_id]
+
+    def ids_of(self, addresses):
+        return {self.intern(address) for address in addresses}
+
+    def hex_keys(self, map, depth=0):
+        """
+        Returns map with the address ids used as keys at the given nesting depth
+        (0 for map's own keys) replaced by their hex address. Other keys, such as
+        builder names and "total", are kept as they are.
+        """
+        if not isinstance(map, dict):
+            return map
+        if depth > 0:
+            return {key: self.hex_keys(value, depth - 1) for key, value in map.items()}
+        return {
+            (self.addresses[key] if type(key) is int else key): value
+            for key, value in map.items()
+        }
+
+    # writes the registry out when addresses were added since the last save
+    def save(self):
+        if self.filename is None or self.saved == len(self.addresses):
+            return
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        tmp = self.filename + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.addresses, f)
+        os.replace(tmp, self.filename)
+        self.saved = len(self.addresses)
+
+
+_shared_registry = None
+_shared_lock = threading.Lock()
+
+
+def get_registry():
+    global _shared_registry
+    with _shared_lock:
+        if _shared_registry is None:
+            _shared_registry = AddressRegistry(REGISTRY_FILE)
+        return _shared_registry
@@ -0,0 +1,168 @@
+import atomic_mev
+
+# Accumulators for the analysis, in place of the nested defaultdicts it filled. A
+# Metric has one cell per key, e.g. (builder, searcher), numbered in order of first
+# touch, and keeps the values of all its cells in one flat list: a row of fields
+# per cell for the atomic maps, a value or a list per cell for the others. An
+# update is one lookup of the key tuple and an index into the list, and merging
+# two metrics adds up their cells. to_map returns the nested dicts the maps were,
+# with their keys in the same order, for compiling and writing out.
+SEARCHER_FIELDS = list(atomic_mev.default_searcher_dic())
+
+
+class Metric:
+    def __init__(self, fields=None, lists=False, address_at=1):
+        self.fields = fields  # None for one value per cell
+        self.field_index = {field: i for i, field in enumerate(fields or [])}
+        self.width = len(fields) if fields else 1
+        self.lists = lists  # cells hold lists of values instead of sums
+        self.address_at = address_at  # position of the searcher address in the keys
+        self.cells = {}  # key -> cell number
+        self.values = []
+
+    def __len__(self):
+        return len(self.cells)
+
+    def cell(self, key):
+        cell = self.cells.get(key)
+        if cell is None:
+            cell = len(self.cells)
+            self.cells[key] = cell
+            if self.lists:
+                self.values.append([])
+            else:
+                self.values.extend([0] * self.width)
+        return cell
+
+    # position of the value of key, or of its field, in self.values
+    def position(self, key, field=None):
+        if self.fields is None:
+            return self.cell(key)
+        return self.cell(key) * self.width + self.field_index[field]
+
+    def add(self, key, value, field=None):
+        self.values[self.position(key, field)] += value
+
+    def append(self, key, value):
+        self.values[self.cell(key)].append(value)
+
+    def merge(self, other, remap=None):
+        """
+        Adds the cells of other, in their order, with the address ids in its keys
+        mapped through remap, e.g. those handed out in a worker process.
+        """
+        at = self.address_at
+        width = self.width
+        for key, cell in other.cells.items():
+            if remap and type(key[at]) is int:
+                key = key[:at] + (remap.get(key[at], key[at]),) + key[at + 1 :]
+            own = self.cell(key)
+            if self.lists:
+                self.values[own].extend(other.values[cell])
+                continue
+            for i in range(width):
+                self.values[own * width + i] += other.values[cell * width + i]
+
+    def to_map(self):
+        map = {}
+        width = self.width
+        for key, cell in self.cells.items():
+            if self.fields is None:
+                value = self.values[cell]
+            else:
+                row = self.values[cell * width : (cell + 1) * width]
+                value = dict(zip(self.fields, row))
+            inner = map
+            for level in key[:-1]:
+                if level not in inner:
+                    inner[level] = {}
+                inner = inner[level]
+            inner[key[-1]] = value
+        return map
+
+    # the cells as lists of keys and values, with hex addresses, e.g. for a file
+    def to_lists(self, registry):
+        at = self.address_at
+        keys = []
+        for key in self.cells:
+            key = list(key)
+            if type(key[at]) is int:
+                key[at] = registry.address(key[at])
+            keys.append(key)
+        return {"keys": keys, "values": self.values}
+
+    # adds cells read back from what to_lists returned
+    def add_lists(self, lists, registry):
+        at = self.address_at
+        other = Metric(self.fields, self.lists, at)
+        for cell, key in enumerate(lists["keys"]):
+            if type(key[at]) is str and key[at].startswith("0x"):
+                key[at] = registry.intern(key[at])
+            other.cells[tuple(key)] = cell
+        other.values = lists["values"]
+        self.merge(other)
+
+
+class AnalysisMetrics:
+    """
+    The metrics of an analysis, named after the maps they replace and listed by
+    metrics() in the order of those maps.
+    """
+
+    def __init__(self):
+        self.builder_atomic_map_block = Metric()  # keys include (builder, "total")
+        self.builder_atomic_map_tx = Metric(SEARCHER_FIELDS)
+        self.builder_atomic_map_profit = Metric(SEARCHER_FIELDS)
+        self.builder_atomic_map_vol = Metric(SEARCHER_FIELDS)
+        self.builder_atomic_map_coin_bribe = Metric(SEARCHER_FIELDS)
+        self.builder_atomic_map_gas_bribe = Metric(SEARCHER_FIELDS)
+        self.builder_atomic_map_vol_list = Metric(lists=True)
+
+        self.builder_nonatomic_map_block = Metric()
+        self.builder_nonatomic_map_tx = Metric()
+        self.builder_nonatomic_map_vol = Metric()
+        self.builder_nonatomic_map_coin_bribe = Metric()
+        self.builder_nonatomic_map_gas_bribe = Metric()
+        self.builder_nonatomic_map_vol_list = Metric(lists=True)
+
+        # {searcher: {builder: [bribes]}}
+        self.coinbase_bribe = Metric(lists=True, address_at=0)
+        self.after_bribe = Metric(lists=True, address_at=0)
+        # {searcher: [{high_gas_tx_info}]}
+        self.tob_bribe = Metric(lists=True, address_at=0)  # keys are (searcher,)
+
+    def metrics(self):
+        return [
+            self.builder_atomic_map_block,
+            self.builder_atomic_map_tx,
+            self.builder_atomic_map_profit,
+            self.builder_atomic_map_vol,
+            self.builder_atomic_map_coin_bribe,
+            self.builder_atomic_map_gas_bribe,
+            self.builder_atomic_map_vol_list,
+            self.builder_nonatomic_map_block,
+            self.builder_nonatomic_map_tx,
+            self.builder_nonatomic_map_vol,
+            self.builder_nonatomic_map_coin_bribe,
+            self.builder_nonatomic_map_gas_bribe,
+            self.builder_nonatomic_map_vol_list,
+            self.coinbase_bribe,
+            self.after_bribe,
+            self.tob_bribe,
+        ]
+
+    # Counts are added and lists extended, so merging the metrics of block ranges
+    # in block order gives those of analyzing the blocks one after the other
+    def merge(self, other, remap=None):
+        for metric, other_metric in zip(self.metrics(), other.metrics()):
+            metric.merge(other_metric, remap)
+
+    def to_maps(self):
+        return [metric.to_map() for metric in self.metrics()]
+
+    def to_lists(self, registry):
+        return [metric.to_lists(registry) for metric in self.metrics()]
+
+    def add_lists(self, lists, registry):
+        for metric, metric_lists in zip(self.metrics(), lists):
+            metric.add_lists(metric_lists, registry)
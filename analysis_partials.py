@@ -0,0 +1,151 @@
+import os
+import hashlib
+import serialization
+import address_registry
+import analysis_metrics
+import mev_table
+import main_mev
+import labels.builder_addr_map as builder_addr_map
+
+# Per-day partial aggregates of the window's analysis. The analysis metrics of each
+# day the window fully covers (a block_store.PARTITION_SIZE range, as the window
+# stores are partitioned) are saved once analyzed, and the window's metrics are
+# merged from them in block order. An update then analyzes only the new day and
+# the window's first and last days, which it covers in part, and drops the
+# partials of the days that left the window. A partial is reused only while its
+# day's signature matches: the same block hashes, transfers, zeromev rows, builder
+# labels and PARTIALS_VERSION, so reorged or refetched blocks are analyzed again.
+# Sums merged from partials can differ from a single pass in the last float digits.
+PARTIALS_DIR = "blockchain_data/analysis_partials/"
+DAY_BLOCKS = 7200  # block_store.PARTITION_SIZE, not imported as it imports helpers
+# bump when the analysis changes, so that partials written before are not reused
+PARTIALS_VERSION = 2
+# the standard JSON encoder, which keeps nan sums that orjson writes as null
+PARTIALS_FORMAT = "json+zstd"
+
+
+def day_start(block_num):
+    return int(block_num) // DAY_BLOCKS * DAY_BLOCKS
+
+
+def partial_path(day):
+    return os.path.join(PARTIALS_DIR, f"{day}-{day + DAY_BLOCKS - 1}.json")
+
+
+def labels_digest():
+    labels = (builder_addr_map.extraData_builder_mapping, builder_addr_map.known_anons)
+    return hashlib.sha256(repr(labels).encode()).hexdigest()
+
+
+def day_signature(block_nums, fetched_blocks, transfers, zeromev, labels):
+    sha256 = hashlib.sha256(f"{PARTIALS_VERSION} {labels}".encode())
+    for block_num in block_nums:
+        block_hash = fetched_blocks[block_num]["hash"]
+        block_transfers = transfers.get(block_num, {})
+        sha256.update(f" {block_num}:{block_hash}:{block_transfers!r}".encode())
+        if not isinstance(zeromev, mev_table.MevTable):
+            sha256.update(repr(zeromev.get(block_num, []) or []).encode())
+    if isinstance(zeromev, mev_table.MevTable):
+        update_with_table_rows(sha256, zeromev, block_nums)
+    return sha256.hexdigest()
+
+
+# Adds the zeromev rows of block_nums to sha256, reading them column by column from
+# the table, where the rows of a day are next to each other, instead of row by row.
+# Coded values and address ids are hashed as the values they stand for, and rows by
+# their position in the day, so the digest does not change as the window moves.
+def update_with_table_rows(sha256, table, block_nums):
+    slices = [
+        table.slices[str(block_num)] for block_num in block_nums if block_num in table
+    ]
+    if len(slices) == 0:
+        return
+    first, end = slices[0][0], slices[-1][1]
+    sha256.update(table.block_nums[first:end].tobytes())
+    sha256.update(table.tx_indices[first:end].tobytes())
+    # NO_VALUE, i.e. -1, looks up the None at the end
+    values = table.values + [None]
+    for field in mev_table.CODED_FIELDS:
+        codes = table.coded[field][first:end]
+        sha256.update(repr(list(map(values.__getitem__, codes))).encode())
+    addresses = table.registry.addresses + [None]
+    for field in mev_table.ADDRESS_FIELDS:
+        address_ids = table.addresses[field][first:end]
+        sha256.update(repr(list(map(addresses.__getitem__, address_ids))).encode())
+    for field in mev_table.USD_FIELDS:
+        sha256.update(table.usd[field][first:end].tobytes())
+    extra = table.extra
+    rows = [
+        (index - first, extra[index]) for index in range(first, end) if index in extra
+    ]
+    sha256.update(repr(rows).encode())
+
+
+# the day's metrics, or None when there is no valid partial
+def load_partial(day, signature):
+    path = partial_path(day)
+    if not os.path.exists(path):
+        return None
+    partial = serialization.load(path)
+    if partial.get("signature") != signature:
+        return None
+    metrics = analysis_metrics.AnalysisMetrics()
+    metrics.add_lists(partial["metrics"], address_registry.get_registry())
+    return metrics
+
+
+# saved with hex addresses, so a partial does not depend on the registry file
+def save_partial(day, signature, metrics):
+    os.makedirs(PARTIALS_DIR, exist_ok=True)
+    partial = {
+        "signature": signature,
+        "metrics": metrics.to_lists(address_registry.get_registry()),
+    }
+    serialization.dump(partial, partial_path(day), PARTIALS_FORMAT)
+
+
+# deletes the partials of the days starting before start, which the window no
+# longer fully covers
+def expire(start):
+    if not os.path.isdir(PARTIALS_DIR):
+        return
+    for name in os.listdir(PARTIALS_DIR):
+        if name.endswith(".json") and int(name.split("-")[0]) < start:
+            os.remove(os.path.join(PARTIALS_DIR, name))
+
+
+def analyze_window(fetched_blocks, transfers, zeromev, metrics):
+    """
+    Analyzes the window into metrics, as main_mev.analyze_blocks does, reusing the
+    saved partials of its full days and saving those of the full days analyzed.
+    """
+    window = sorted(fetched_blocks, key=int)
+    days = {}
+    for block_num in window:
+        days.setdefault(day_start(block_num), []).append(block_num)
+    labels = labels_digest()
+    reused = 0
+
+    for day, block_nums in days.items():
+        day_blocks = {block_num: fetched_blocks[block_num] for block_num in block_nums}
+        if len(block_nums) < DAY_BLOCKS:
+            # the window covers part of the day, which is analyzed every time
+            main_mev.analyze_blocks(day_blocks, transfers, zeromev, metrics)
+            continue
+
+        signature = day_signature(
+            block_nums, fetched_blocks, transfers, zeromev, labels
+        )
+        partial = load_partial(day, signature)
+        if partial is None:
+            partial = analysis_metrics.AnalysisMetrics()
+            main_mev.analyze_blocks(day_blocks, transfers, zeromev, partial)
+            save_partial(day, signature, partial)
+        else:
+            reused += 1
+        metrics.merge(partial)
+
+    if len(window) > 0:
+        expire(int(window[0]))
+    print(f"Reused the partial aggregates of {reused} of {len(days)} days")
+    return metrics
@@ -1,4 +1,5 @@
 import helpers
+import address_registry
 
 
 # increments the frequency counter of searcher, which can be addr_from/to, for the builder
@@ -10,13 +11,8 @@ def analyze_tx(
     transfer_map,
     block_base_fee,
     addrs_counted_in_block,
-    builder_atomic_map_block,
-    builder_atomic_map_tx,
-    builder_atomic_map_profit,
-    builder_atomic_map_vol,
-    builder_atomic_map_coin_bribe,
-    builder_atomic_map_gas_bribe,
-    builder_atomic_map_vol_list,
+    metrics,
+    registry,
 ):
     mev_type = tx["mev_type"]
 
@@ -25,80 +21,91 @@ def analyze_tx(
     elif mev_type == "sandwich" or mev_type == "swap":
         return
 
-    addr_to = tx["address_to"].lower()
-    addr_from = tx["address_from"].lower()
+    # searchers are keyed by address id, see address_registry. A missing address
+    # raises and the rest of the block is not analyzed.
+    addr_to = registry.intern(tx["address_to"])
+    addr_from = registry.intern(tx["address_from"])
     profit = tx.get("extractor_profit_usd", 0) or 0
     volume = tx.get("extractor_swap_volume_usd", 0) or 0
+    # the metrics of analysis_metrics.AnalysisMetrics, keyed by (builder, searcher)
+    block_counts = metrics.builder_atomic_map_block
+    tx_counts = metrics.builder_atomic_map_tx
+    profits = metrics.builder_atomic_map_profit
+    volumes = metrics.builder_atomic_map_vol
+    coin_bribes = metrics.builder_atomic_map_coin_bribe
+    gas_bribes = metrics.builder_atomic_map_gas_bribe
+    volume_lists = metrics.builder_atomic_map_vol_list
 
     # collect info on bribes
     if full_tx["hash"] in transfer_map.keys():
-        builder_atomic_map_coin_bribe[builder][addr_to][mev_type] += transfer_map[
-            full_tx["hash"]
-        ]["value"]
-        builder_atomic_map_coin_bribe[builder][addr_to]["total"] += transfer_map[
-            full_tx["hash"]
-        ]["value"]
+        coin_bribe = transfer_map[full_tx["hash"]]["value"]
+        coin_bribes.add((builder, addr_to), coin_bribe, mev_type)
+        coin_bribes.add((builder, addr_to), coin_bribe, "total")
 
     tx_priority_fee = (
         full_tx["gasUsed"] * full_tx["gasPrice"] - full_tx["gasUsed"] * block_base_fee
     )
 
-    builder_atomic_map_gas_bribe[builder][addr_to][mev_type] += tx_priority_fee
-    builder_atomic_map_gas_bribe[builder][addr_to]["total"] += tx_priority_fee
+    gas_bribes.add((builder, addr_to), tx_priority_fee, mev_type)
+    gas_bribes.add((builder, addr_to), tx_priority_fee, "total")
 
     # handle info collection depending on mev_type
     if mev_type == "arb" or mev_type == "frontrun":
-        builder_atomic_map_tx[builder][addr_to][mev_type] += 1
-        builder_atomic_map_profit[builder][addr_to][mev_type] += profit
-        builder_atomic_map_vol[builder][addr_to][mev_type] += volume
-        builder_atomic_map_vol_list[builder][addr_to].append(volume)
-        builder_atomic_map_tx[builder][addr_to]["total"] += 1
-        builder_atomic_map_profit[builder][addr_to]["total"] += profit
-        builder_atomic_map_vol[builder][addr_to]["total"] += volume
+        key = (builder, addr_to)
+        tx_counts.add(key, 1, mev_type)
+        profits.add(key, profit, mev_type)
+        volumes.add(key, volume, mev_type)
+        volume_lists.append(key, volume)
+        tx_counts.add(key, 1, "total")
+        profits.add(key, profit, "total")
+        volumes.add(key, volume, "total")
 
         if addr_to not in addrs_counted_in_block:
-            builder_atomic_map_block[builder][addr_to] += 1
+            block_counts.add(key, 1)
             addrs_counted_in_block.add(addr_to)
     elif mev_type == "backrun":
+        key = (builder, addr_to)
         # counting both txs in a sandwich
-        builder_atomic_map_tx[builder][addr_to][mev_type] += 1
+        tx_counts.add(key, 1, mev_type)
         # revenut (not profit) will be zero for one of the legs. if even, then in front
-        builder_atomic_map_profit[builder][addr_to][mev_type] += profit
-        builder_atomic_map_vol[builder][addr_to][mev_type] += volume
-        builder_atomic_map_vol_list[builder][addr_to].append(volume)
+        profits.add(key, profit, mev_type)
+        volumes.add(key, volume, mev_type)
+        volume_lists.append(key, volume)
 
         # only count volume from frontrun in the total (can count it separate for later purpose)
-        builder_atomic_map_tx[builder][addr_to]["total"] += 1
-        builder_atomic_map_profit[builder][addr_to]["total"] += profit
+        tx_counts.add(key, 1, "total")
+        profits.add(key, profit, "total")
 
         if addr_to not in addrs_counted_in_block:
-            builder_atomic_map_block[builder][addr_to] += 1
+            block_counts.add(key, 1)
             addrs_counted_in_block.add(addr_to)
 
     elif mev_type == "liquid":
         # addr_from here, bc liquidation doesnt use special contracts but EOA
-        builder_atomic_map_tx[builder][addr_from][mev_type] += 1
-        builder_atomic_map_vol[builder][addr_from][mev_type] += volume
-        builder_atomic_map_vol_list[builder][addr_from].append(volume)
+        key = (builder, addr_from)
+        tx_counts.add(key, 1, mev_type)
+        volumes.add(key, volume, mev_type)
+        volume_lists.append(key, volume)
 
-        builder_atomic_map_tx[builder][addr_from]["total"] += 1
-        builder_atomic_map_profit[builder][addr_from]["total"] += profit
-        builder_atomic_map_vol[builder][addr_from]["total"] += volume
+        tx_counts.add(key, 1, "total")
+        profits.add(key, profit, "total")
+        volumes.add(key, volume, "total")
 
         if addr_from not in addrs_counted_in_block:
-            builder_atomic_map_block[builder][addr_from] += 1
+            block_counts.add(key, 1)
             addrs_counted_in_block.add(addr_from)
     # for swaps that are likely atomic MEV due to their multiple hop nature
     elif mev_type == "uncertain":
-        builder_atomic_map_tx[builder][addr_to][mev_type] += 1
+        key = (builder, addr_to)
+        tx_counts.add(key, 1, mev_type)
         user_volume = tx.get("user_swap_volume_usd", 0) or 0
-        builder_atomic_map_vol[builder][addr_to][mev_type] += user_volume
-        builder_atomic_map_vol_list[builder][addr_to].append(user_volume)
-        builder_atomic_map_tx[builder][addr_to]["total"] += 1
-        builder_atomic_map_vol[builder][addr_to]["total"] += user_volume
+        volumes.add(key, user_volume, mev_type)
+        volume_lists.append(key, user_volume)
+        tx_counts.add(key, 1, "total")
+        volumes.add(key, user_volume, "total")
 
         if addr_to not in addrs_counted_in_block:
-            builder_atomic_map_block[builder][addr_to] += 1
+            block_counts.add(key, 1)
             addrs_counted_in_block.add(addr_to)
 
 
@@ -122,6 +129,16 @@ def compile_atomic_data(
     builder_atomic_map_gas_bribe,
     builder_atomic_map_vol_list,
 ):
+    # back from address ids to hex addresses before anything is written out
+    registry = address_registry.get_registry()
+    builder_atomic_map_block = registry.hex_keys(builder_atomic_map_block, 1)
+    builder_atomic_map_tx = registry.hex_keys(builder_atomic_map_tx, 1)
+    builder_atomic_map_profit = registry.hex_keys(builder_atomic_map_profit, 1)
+    builder_atomic_map_vol = registry.hex_keys(builder_atomic_map_vol, 1)
+    builder_atomic_map_coin_bribe = registry.hex_keys(builder_atomic_map_coin_bribe, 1)
+    builder_atomic_map_gas_bribe = registry.hex_keys(builder_atomic_map_gas_bribe, 1)
+    builder_atomic_map_vol_list = registry.hex_keys(builder_atomic_map_vol_list, 1)
+
     helpers.dump_dict_to_json(
         builder_atomic_map_block,
         "atomic/fourteen/builder_atomic_maps/builder_atomic_map_block.json",
@@ -0,0 +1,425 @@
+import os
+import mmap
+import struct
+import helpers
+import serialization
+
+# Rolling-window data (blocks, transfers, zeromev rows keyed by block num) stored as
+# one file per fixed range of blocks. Advancing the window writes the partitions
+# that received new blocks and deletes the ones that fell out of the window, so an
+# update rewrites about a day of data instead of the whole fourteen days.
+PARTITION_SIZE = 7200  # blocks per partition, about a day of 12s blocks
+
+# BlockLog files. The log is a sequence of records, each a RECORD_HEADER followed
+# by the block, serialized in the format serialization.py picks for the log's path.
+# The index starts with INDEX_HEADER and holds one INDEX_ENTRY per block num from
+# there on, pointing at the block's latest record.
+RECORD_HEADER = struct.Struct("<qI")  # block num, length of the block, 0 if dropped
+INDEX_HEADER = struct.Struct("<q")  # block num of the first entry
+INDEX_ENTRY = struct.Struct("<QI")  # offset of the block in the log, its length or 0
+# the log is compacted once less than this share of it is live blocks
+COMPACT_LIVE_RATIO = 0.5
+# blocks of a single-file window read into memory at a time when importing it
+IMPORT_CHUNK = 1000
+
+
+# The block nums of missing, as merge_block_files returns them for [start, end],
+# that lie between blocks the partition holds. The ones before its first block and
+# after its last are those of a partition the window only covers in part.
+def gaps(missing, start, end):
+    block_nums = [int(block_num) for block_num in missing]
+    first, last = 0, len(block_nums)
+    while first < last and block_nums[first] == start + first:
+        first += 1
+    while last > first and block_nums[last - 1] == end - (len(block_nums) - last):
+        last -= 1
+    return block_nums[first:last]
+
+
+class PartitionedStore:
+    def __init__(self, directory, partition_size=PARTITION_SIZE):
+        self.directory = directory
+        self.partition_size = partition_size
+
+    def partition_start(self, block_num):
+        return int(block_num) // self.partition_size * self.partition_size
+
+    def partition_path(self, start):
+        end = start + self.partition_size - 1
+        return os.path.join(self.directory, f"{start}-{end}.json")
+
+    # path of the n-th checkpoint written next to the partition since its last merge
+    def checkpoint_path(self, start, n):
+        return self.partition_path(start)[: -len(".json")] + f".checkpoint-{n}.json"
+
+    # checkpoints of the partition not merged into it yet, oldest first
+    def checkpoint_paths(self, start):
+        if not os.path.isdir(self.directory):
+            return []
+        prefix = os.path.basename(self.partition_path(start))[: -len(".json")]
+        prefix += ".checkpoint-"
+        checkpoints = [
+            int(file[len(prefix) : -len(".json")])
+            for file in os.listdir(self.directory)
+            if file.startswith(prefix) and file.endswith(".json")
+        ]
+        return [self.checkpoint_path(start, n) for n in sorted(checkpoints)]
+
+    # starts of the partitions on disk, merged or only checkpointed, in block order
+    def partitions(self):
+        if not os.path.isdir(self.directory):
+            return []
+        starts = set()
+        for file in os.listdir(self.directory):
+            name, ext = os.path.splitext(file)
+            if ext == ".json" and "-" in name:
+                starts.add(int(name.split("-")[0]))
+        return sorted(starts)
+
+    def is_empty(self):
+        return len(self.partitions()) == 0
+
+    def load_partition(self, start):
+        data = {}
+        for path in [self.partition_path(start)] + self.checkpoint_paths(start):
+            if os.path.exists(path):
+                data.update(helpers.load_dict_from_json(path))
+        return data
+
+    def load(self, start, end):
+        """
+        Returns {block_num: value} of the blocks in [start, end], reading only the
+        partitions that overlap it.
+        """
+        data = {}
+        for partition in self.partitions():
+            if partition + self.partition_size <= start or partition > end:
+                continue
+            for block_num, value in self.load_partition(partition).items():
+                if start <= int(block_num) <= end:
+                    data[block_num] = value
+        return data
+
+    # {partition start: {block_num: value}} of data
+    def split(self, data):
+        by_partition = {}
+        for block_num, value in data.items():
+            by_partition.setdefault(self.partition_start(block_num), {})[
+                str(block_num)
+            ] = value
+        return by_partition
+
+    def write(self, data, dropped=()):
+        """
+        Adds data, {block_num: value}, to the partitions it falls in and removes the
+        dropped block nums. Only the partitions touched are merged and rewritten,
+        along with their checkpoints. Returns the block nums missing between the
+        blocks the partitions hold.
+        """
+        by_partition = self.split(data)
+        for block_num in dropped:
+            by_partition.setdefault(self.partition_start(block_num), {})
+        # a block both dropped and in data, e.g. a refetched reorged one, is kept
+        dropped = {str(block_num) for block_num in dropped} - set(map(str, data))
+        return self.merge(by_partition, dropped)
+
+    def checkpoint(self, data):
+        """
+        Writes data, {block_num: value}, next to the partitions it falls in instead
+        of rewriting them, so that a stage fetching a partition's blocks a chunk at
+        a time does not rewrite it for every chunk. Loads see the checkpoints right
+        away and flush merges them into their partitions.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        for partition, new_data in self.split(data).items():
+            path = self.checkpoint_path(
+                partition, len(self.checkpoint_paths(partition))
+            )
+            helpers.dump_dict_to_json(
+                dict(sorted(new_data.items(), key=lambda kv: int(kv[0]))), path
+            )
+        print(f"Checkpointed {len(data)} blocks to {self.directory}")
+
+    # merges the checkpoints into their partitions, rewriting each partition once
+    def flush(self):
+        return self.merge(
+            {
+                partition: {}
+                for partition in self.partitions()
+                if len(self.checkpoint_paths(partition)) > 0
+            }
+        )
+
+    def merge(self, by_partition, dropped=()):
+        os.makedirs(self.directory, exist_ok=True)
+        missing = []
+        written = 0
+        for partition, new_data in by_partition.items():
+            # the partition on disk is streamed through, not loaded
+            path = self.partition_path(partition)
+            checkpoints = self.checkpoint_paths(partition)
+            sources = [path] if os.path.exists(path) else []
+            sources += checkpoints
+            if len(sources) == 0 and len(new_data) == 0:
+                continue  # only drops blocks from a partition that was never written
+            sources.append(sorted(new_data.items(), key=lambda kv: int(kv[0])))
+            end = partition + self.partition_size - 1
+            partition_missing = helpers.merge_block_files(
+                sources, path, partition, end, dropped
+            )
+            for checkpoint in checkpoints:
+                os.remove(checkpoint)
+            if len(partition_missing) == self.partition_size:
+                # every block of it was dropped
+                os.remove(path)
+                continue
+            written += 1
+            missing += gaps(partition_missing, partition, end)
+        print(f"Wrote {written} partitions to {self.directory}")
+        if len(missing) > 0:
+            print(f"Missing {len(missing)} blocks in {self.directory}:")
+            print(sorted(missing))
+        return missing
+
+    # deletes the partitions that only hold blocks before start
+    def expire(self, start):
+        for partition in self.partitions():
+            if partition + self.partition_size <= start:
+                for path in [self.partition_path(partition)] + self.checkpoint_paths(
+                    partition
+                ):
+                    if os.path.exists(path):
+                        os.remove(path)
+                print(f"Deleted expired partition {self.partition_path(partition)}")
+
+    # moves a single-file window, as stored before partitioning, into the store a
+    # partition's worth of blocks at a time
+    def import_file(self, filename):
+        print(f"Importing {filename} into {self.directory}")
+        for chunk in helpers.load_dict_in_chunks(filename, self.partition_size):
+            self.write(chunk)
+
+
+class BlockLog:
+    """
+    Append-only log of blocks with a memory-mapped index from block num to the
+    block's record, so presence checks (`str(block_num) in log`) and reads of a
+    single block cost one index lookup instead of parsing the whole window.
+    Rewritten and dropped blocks are appended again, expired ones are removed
+    from the index, and the log is compacted once it is mostly dead records.
+    Can be used in place of a PartitionedStore.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.log_path = os.path.join(directory, "blocks.log")
+        self.index_path = os.path.join(directory, "blocks.idx")
+        self.index = None
+        self.base = None
+        self.num_entries = 0
+
+    def open_index(self):
+        if self.index is not None:
+            return
+        if not os.path.exists(self.index_path):
+            self.rebuild_index()
+        with open(self.index_path, "r+b") as f:
+            self.index = mmap.mmap(f.fileno(), 0)
+        (self.base,) = INDEX_HEADER.unpack_from(self.index, 0)
+        self.num_entries = (len(self.index) - INDEX_HEADER.size) // INDEX_ENTRY.size
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+            self.index = None
+
+    # (offset, length) of the block in the log, or None
+    def entry(self, block_num):
+        self.open_index()
+        i = int(block_num) - self.base
+        if i < 0 or i >= self.num_entries:
+            return None
+        offset, length = INDEX_ENTRY.unpack_from(
+            self.index, INDEX_HEADER.size + i * INDEX_ENTRY.size
+        )
+        return (offset, length) if length > 0 else None
+
+    def set_entry(self, block_num, offset, length):
+        INDEX_ENTRY.pack_into(
+            self.index,
+            INDEX_HEADER.size + (int(block_num) - self.base) * INDEX_ENTRY.size,
+            offset,
+            length,
+        )
+
+    def entries(self):
+        self.open_index()
+        for i, (offset, length) in enumerate(
+            INDEX_ENTRY.iter_unpack(self.index[INDEX_HEADER.size :])
+        ):
+            if length > 0:
+                yield self.base + i, offset, length
+
+    def __contains__(self, block_num):
+        return self.entry(block_num) is not None
+
+    def is_empty(self):
+        return next(self.entries(), None) is None
+
+    def get(self, block_num, default=None):
+        entry = self.entry(block_num)
+        if entry is None or not os.path.exists(self.log_path):
+            return default
+        with open(self.log_path, "rb") as f:
+            return serialization.decode(os.pread(f.fileno(), entry[1], entry[0]))
+
+    # transform is applied to each block as it is read, e.g. tx_table.compact_block
+    def load(self, start, end, transform=None):
+        data = {}
+        if not os.path.exists(self.log_path):
+            return data
+        with open(self.log_path, "rb") as f:
+            for block_num, offset, length in self.entries():
+                if start <= block_num <= end:
+                    block = serialization.decode(os.pread(f.fileno(), length, offset))
+                    if transform is not None:
+                        block = transform(block)
+                    data[str(block_num)] = block
+        return data
+
+    # grows the index so that it covers block nums first to last
+    def cover(self, first, last):
+        self.open_index()
+        base = min(self.base, first) if self.num_entries > 0 else first
+        num_entries = max(self.base + self.num_entries, last + 1) - base
+        if base == self.base and num_entries <= self.num_entries:
+            return
+        old = self.index[INDEX_HEADER.size :]
+        shift = (self.base - base) * INDEX_ENTRY.size if self.num_entries > 0 else 0
+        self.close()
+        with open(self.index_path, "r+b") as f:
+            f.truncate(INDEX_HEADER.size + num_entries * INDEX_ENTRY.size)
+            f.seek(0)
+            f.write(INDEX_HEADER.pack(base))
+            f.write(bytes(shift))
+            f.write(old)
+        self.open_index()
+
+    def write(self, data, dropped=()):
+        """
+        Appends data, {block_num: block}, and tombstones for the dropped block
+        nums to the log, then points the index at the new records.
+        """
+        records = [(int(block_num), value) for block_num, value in data.items()]
+        records += [(int(block_num), None) for block_num in dropped]
+        if len(records) == 0:
+            return
+        records.sort(key=lambda record: record[0])
+
+        os.makedirs(self.directory, exist_ok=True)
+        entries = []
+        format = serialization.format_for_path(self.log_path)
+        with open(self.log_path, "ab") as f:
+            f.seek(0, os.SEEK_END)
+            for block_num, value in records:
+                payload = b"" if value is None else serialization.encode(value, format)
+                f.write(RECORD_HEADER.pack(block_num, len(payload)))
+                entries.append((block_num, f.tell(), len(payload)))
+                f.write(payload)
+        # the records are on disk before the index points at them
+        self.cover(records[0][0], records[-1][0])
+        for block_num, offset, length in entries:
+            self.set_entry(block_num, offset, length)
+        self.index.flush()
+        print(f"Appended {len(records)} blocks to {self.log_path}")
+
+    # appends are what a PartitionedStore checkpoint saves, so it is a write
+    def checkpoint(self, data):
+        self.write(data)
+
+    def flush(self):
+        pass
+
+    # removes the blocks before start from the index, compacting the log when
+    # most of it is no longer referenced
+    def expire(self, start):
+        self.open_index()
+        expired = min(max(0, start - self.base), self.num_entries)
+        self.index[
+            INDEX_HEADER.size : INDEX_HEADER.size + expired * INDEX_ENTRY.size
+        ] = bytes(expired * INDEX_ENTRY.size)
+        self.index.flush()
+        if not os.path.exists(self.log_path):
+            return
+
+        live = sum(RECORD_HEADER.size + length for _, _, length in self.entries())
+        if live < os.path.getsize(self.log_path) * COMPACT_LIVE_RATIO:
+            self.compact()
+
+    def compact(self):
+        print(f"Compacting {self.log_path}")
+        tmp_log = self.log_path + ".tmp"
+        entries = []
+        with open(self.log_path, "rb") as src, open(tmp_log, "wb") as dst:
+            for block_num, offset, length in self.entries():
+                dst.write(RECORD_HEADER.pack(block_num, length))
+                entries.append((block_num, dst.tell(), length))
+                dst.write(os.pread(src.fileno(), length, offset))
+
+        tmp_index = self.index_path + ".tmp"
+        with open(tmp_index, "wb") as f:
+            base = entries[0][0] if len(entries) > 0 else 0
+            f.write(INDEX_HEADER.pack(base))
+            index = bytearray(
+                ((entries[-1][0] - base + 1) if len(entries) > 0 else 0)
+                * INDEX_ENTRY.size
+            )
+            for block_num, offset, length in entries:
+                INDEX_ENTRY.pack_into(
+                    index, (block_num - base) * INDEX_ENTRY.size, offset, length
+                )
+            f.write(index)
+
+        # without an index the log is rescanned, so a crash in between leaves
+        # either the old or the new log with a matching index
+        self.close()
+        os.remove(self.index_path)
+        os.replace(tmp_log, self.log_path)
+        os.replace(tmp_index, self.index_path)
+
+    # rebuilds the index from the log, the latest record of a block wins and a
+    # partly written record at the end is cut off
+    def rebuild_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        latest = {}
+        end = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, "r+b") as f:
+                size = os.path.getsize(self.log_path)
+                while end + RECORD_HEADER.size <= size:
+                    block_num, length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+                    if end + RECORD_HEADER.size + length > size:
+                        break
+                    latest[block_num] = (end + RECORD_HEADER.size, length)
+                    f.seek(length, os.SEEK_CUR)
+                    end += RECORD_HEADER.size + length
+                f.truncate(end)
+
+        base = min(latest) if len(latest) > 0 else 0
+        num_entries = max(latest) - base + 1 if len(latest) > 0 else 0
+        index = bytearray(INDEX_HEADER.size + num_entries * INDEX_ENTRY.size)
+        INDEX_HEADER.pack_into(index, 0, base)
+        for block_num, (offset, length) in latest.items():
+            INDEX_ENTRY.pack_into(
+                index,
+                INDEX_HEADER.size + (block_num - base) * INDEX_ENTRY.size,
+                offset,
+                length,
+            )
+        with open(self.index_path, "wb") as f:
+            f.write(index)
+
+    def import_file(self, filename):
+        print(f"Importing {filename} into {self.directory}")
+        for chunk in helpers.load_dict_in_chunks(filename, IMPORT_CHUNK):
+            self.write(chunk)
@@ -0,0 +1,128 @@
+import re
+import threading
+import labels.builder_addr_map as builder_addr_map
+
+# Resolves the builder name of a block from its extraData and fee recipient, as
+# main_mev.map_extra_data_to_builder does. A window has only a few hundred
+# distinct extraData values, so the name each one gives is cached, and only the
+# known_anons lookup of the fee recipient is left per block. A new extraData value
+# is matched against all the builder keywords in one pass of an Aho-Corasick
+# automaton, which returns the keyword first in extraData_builder_mapping's order,
+# as the scan of the mapping did.
+
+
+class KeywordMatcher:
+    """Aho-Corasick automaton over keywords, finding the ones a text contains."""
+
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self.goto = [{}]  # state -> {char: next state}
+        self.fail = [0]
+        # state -> index of the first keyword, in the given order, that ends at
+        # the state or at a state on its fail chain, None if none does
+        self.first = [None]
+        for index, keyword in enumerate(self.keywords):
+            state = 0
+            for char in keyword:
+                if char not in self.goto[state]:
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.first.append(None)
+                    self.goto[state][char] = len(self.goto) - 1
+                state = self.goto[state][char]
+            if self.first[state] is None:
+                self.first[state] = index
+
+        # fail links in breadth first order, so a state's fail state is done first
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, next_state in self.goto[state].items():
+                fail = self.fail[state]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[next_state] = fail
+                if self.first[fail] is not None and (
+                    self.first[next_state] is None
+                    or self.first[fail] < self.first[next_state]
+                ):
+                    self.first[next_state] = self.first[fail]
+                queue.append(next_state)
+
+    def first_match(self, text):
+        """The keyword that comes first in the given order among those in text."""
+        goto, fail, first = self.goto, self.fail, self.first
+        state = 0
+        best = first[0]
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            found = first[state]
+            if found is not None and (best is None or found < best):
+                best = found
+                if best == 0:
+                    break
+        return None if best is None else self.keywords[best]
+
+
+class BuilderResolver:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keywords = KeywordMatcher(builder_addr_map.extraData_builder_mapping)
+        # keys of BUILDER_ADDR_MAP, matched in builder names as they are
+        self.address_keys = KeywordMatcher(builder_addr_map.BUILDER_ADDR_MAP)
+        self.names = {}  # extraData -> builder name, None if it has no word chars
+        self.addresses = {}  # builder name -> its BUILDER_ADDR_MAP value or None
+        self.hits = 0
+        self.misses = 0
+
+    def name(self, extra_data):
+        if extra_data in self.names:
+            self.hits += 1
+            return self.names[extra_data]
+        builder = re.sub(r"\W+", "", extra_data)
+        if builder == "":
+            name = None
+        else:
+            keyword = self.keywords.first_match(builder.lower())
+            if keyword is None:
+                name = builder
+            else:
+                name = builder_addr_map.extraData_builder_mapping[keyword]
+        with self.lock:
+            self.misses += 1
+            self.names[extra_data] = name
+        return name
+
+    # extra_data is the block's extraData decoded as ISO-8859-1
+    def builder(self, extra_data, fee_recipient):
+        anon = builder_addr_map.known_anons.get(fee_recipient)
+        if anon is not None:
+            return anon
+        name = self.name(extra_data)
+        return fee_recipient if name is None else name
+
+    # the fee recipient value of the first BUILDER_ADDR_MAP key in builder, or None
+    def builder_addresses(self, builder):
+        if builder not in self.addresses:
+            key = self.address_keys.first_match(builder)
+            self.addresses[builder] = (
+                None if key is None else builder_addr_map.BUILDER_ADDR_MAP[key]
+            )
+        return self.addresses[builder]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "names": len(self.names)}
+
+
+_shared_resolver = None
+_shared_lock = threading.Lock()
+
+
+def get_resolver():
+    global _shared_resolver
+    with _shared_lock:
+        if _shared_resolver is None:
+            _shared_resolver = BuilderResolver()
+        return _shared_resolver
@@ -0,0 +1,605 @@
+import numpy as np
+import main_mev
+import mev_table
+import tx_table
+import atomic_mev
+import address_registry
+
+# Columnar backend of main_mev.analyze_blocks (see main_mev.ANALYSIS_BACKEND). The
+# zeromev rows of the blocks are joined with their txs, transfers and block fields
+# into one array per field, the rules of atomic_mev.analyze_tx and
+# nonatomic_mev.analyze_tx are applied to all rows at once as boolean masks, and
+# each metric cell is the sum (or list) of the values its rows contribute.
+# Sums are taken over object arrays in row order, starting from the value already
+# in the cell. That way ints over 64 bits (wei) stay exact and floats come out
+# bit for bit as analyze_block adds them.
+# analyze_block stops at a row that raises, e.g. a row without a tx_index or a tx
+# without gasUsed. A block with such a row is analyzed by analyze_block, in its
+# place between the runs of blocks analyzed in columns.
+
+# codes of the mev_types are their index in default_searcher_dic, a "total" row
+# would add its gas twice and is left to analyze_block
+SEARCHER_FIELDS = list(atomic_mev.default_searcher_dic())
+TOTAL = SEARCHER_FIELDS.index("total")
+ARB, FRONTRUN, BACKRUN, LIQUID, UNCERTAIN = [
+    SEARCHER_FIELDS.index(field)
+    for field in ["arb", "frontrun", "backrun", "liquid", "uncertain"]
+]
+SANDWICH, SWAP = -2, -3  # codes of the mev_types that are not searcher fields
+UNKNOWN = -4
+# tx fields read for the row's own tx and for the tx after it, a row whose tx
+# keeps one of them in TxTable.extra is left to analyze_block
+TX_FIELDS = {"hash", "from", "gasPrice", "gasUsed"}
+NEXT_TX_FIELDS = {"from", "value"}
+WEI_PER_ETH = 10**18
+
+
+def canonical_bytes(value, size):
+    """The bytes of a lowercase 0x hex string of size bytes, None for other values."""
+    if not isinstance(value, str) or len(value) != 2 + 2 * size:
+        return None
+    try:
+        raw = bytes.fromhex(value[2:])
+    except ValueError:
+        return None
+    return raw if "0x" + raw.hex() == value else None
+
+
+def object_column(values):
+    array = np.empty(len(values), dtype=object)
+    array[:] = values
+    return array
+
+
+class Contributions:
+    """
+    Values that rows add to a metric, keyed by a tuple of code columns, one per
+    key level, which decode turns back into the metric's keys and fields.
+    """
+
+    def __init__(self, *decode):
+        self.decode = decode
+        self.parts = []
+
+    def add(self, rows, keys, values):
+        if len(rows) > 0:
+            self.parts.append((rows, keys, values))
+
+    # groups the values by key, each group in row order, and decodes the keys of
+    # the groups in order of their first row, which is the order analyze_block
+    # inserts them in
+    def groups(self):
+        rows = np.concatenate([part[0] for part in self.parts])
+        codes = [
+            np.concatenate([part[1][level] for part in self.parts])
+            for level in range(len(self.decode))
+        ]
+        values = np.concatenate([part[2] for part in self.parts])
+        order = np.lexsort([rows] + codes[::-1])
+        codes = [code[order] for code in codes]
+        changed = np.zeros(len(order), dtype=bool)
+        changed[0] = True
+        for code in codes:
+            changed[1:] |= code[1:] != code[:-1]
+        starts = np.flatnonzero(changed)
+        ends = np.append(starts[1:], len(order))
+        by_first_row = np.argsort(rows[order][starts], kind="stable")
+        keys = []
+        for decode, code in zip(self.decode, codes):
+            distinct, inverse = np.unique(
+                code[starts][by_first_row], return_inverse=True
+            )
+            decoded = object_column([decode(c) for c in distinct.tolist()])
+            keys.append(decoded[inverse].tolist())
+        return values[order], starts, ends, by_first_row, keys
+
+    # positions in metric.values of the groups' values, with the metric's cells
+    # created in order of the groups' first rows, as analyze_block creates them.
+    # The last key level of a metric with fields is the field.
+    def positions(self, metric, keys):
+        levels = keys if metric.fields is None else keys[:-1]
+        cells = [metric.cell(key) for key in zip(*levels)]
+        if metric.fields is None:
+            return cells
+        return [
+            cell * metric.width + metric.field_index[field]
+            for cell, field in zip(cells, keys[-1])
+        ]
+
+    def add_sums_to(self, metric):
+        if len(self.parts) == 0:
+            return
+        values, starts, _, by_first_row, keys = self.groups()
+        positions = self.positions(metric, keys)
+        firsts = starts[by_first_row]
+        # the first value of each group is added to the metric's, as += does
+        values[firsts] = (
+            object_column([metric.values[position] for position in positions])
+            + values[firsts]
+        )
+        sums = np.add.reduceat(values, starts)[by_first_row]
+        for position, total in zip(positions, sums.tolist()):
+            metric.values[position] = total
+
+    def append_lists_to(self, metric):
+        if len(self.parts) == 0:
+            return
+        values, starts, ends, by_first_row, keys = self.groups()
+        positions = self.positions(metric, keys)
+        values = values.tolist()
+        for position, start, end in zip(
+            positions,
+            starts[by_first_row].tolist(),
+            ends[by_first_row].tolist(),
+        ):
+            metric.values[position].extend(values[start:end])
+
+
+def analyze_blocks(
+    fetched_blocks, fetched_internal_transfers, fetched_zeromev_blocks, metrics
+):
+    """
+    Adds the analysis of fetched_blocks to metrics, an
+    analysis_metrics.AnalysisMetrics, the same as calling main_mev.analyze_block
+    on each of them.
+    """
+    registry = address_registry.get_registry()
+    table = fetched_zeromev_blocks
+    if not isinstance(table, mev_table.MevTable):
+        table = mev_table.MevTable(table, registry)
+    elif table.registry is not registry:
+        table = mev_table.MevTable(table.to_dict(), registry)
+
+    fallback = analyze_columns(
+        fetched_blocks, fetched_internal_transfers, table, metrics
+    )
+    if len(fallback) > 0:
+        fallback = set(fallback)
+        run = {}
+        for block_number, block in fetched_blocks.items():
+            if block_number not in fallback:
+                run[block_number] = block
+                continue
+            analyze_columns(run, fetched_internal_transfers, table, metrics)
+            run = {}
+            main_mev.analyze_block(
+                block_number,
+                block,
+                fetched_internal_transfers.get(str(block_number), {}),
+                fetched_zeromev_blocks.get(str(block_number), []),
+                metrics,
+            )
+        analyze_columns(run, fetched_internal_transfers, table, metrics)
+    print(
+        f"Analyzed {len(fetched_blocks) - len(fallback)} blocks in columns, "
+        f"{len(fallback)} block by block"
+    )
+
+
+def analyze_columns(fetched_blocks, fetched_internal_transfers, table, metrics):
+    """
+    Analyzes fetched_blocks into metrics. When some of them have rows the columns
+    do not cover, returns those block nums and leaves metrics as they are.
+    """
+    registry = table.registry
+
+    # BLOCKS, with the txs of the ones that have rows in one set of columns
+
+    block_keys = []
+    builders = []
+    builder_codes = {}
+    block_builders = []
+    fee_recipients = []
+    base_fees = []
+    boundaries = []
+    num_txs = []
+    tx_offsets = []
+    row_slices = []
+    fallback = []
+    fee_recipient_bytes = {}
+    # the transfers of the blocks, with their block and tx hash as bytes
+    transfers = []
+    transfer_keys = []
+    tx_columns = {"present": [], "hash": [], "from": [], "to": []}
+    tx_columns.update({"values_low": [], "values_high": [], "gas_prices": []})
+    tx_columns.update({"gas_used": [], "has_gas_used": []})
+    tx_extra = {}  # tx -> its TxTable.extra
+    total_tx_rows = 0
+
+    for block_number, block in fetched_blocks.items():
+        try:
+            total_txs = len(block["transactions"])
+            if total_txs < 1:
+                continue
+            extra_data = bytes.fromhex(block["extraData"].lstrip("0x")).decode(
+                "ISO-8859-1"
+            )
+            builder = main_mev.map_extra_data_to_builder(
+                extra_data, block["feeRecipient"]
+            )
+            fee_recipient = block["feeRecipient"]
+            block_base_fee = block["baseFeePerGas"]
+            int(block_number)
+        except Exception:
+            fallback.append(block_number)
+            continue
+        transfer_map = fetched_internal_transfers.get(str(block_number), {})
+        # a float base fee would make the order of the gas additions matter
+        if type(block_base_fee) is not int or not isinstance(transfer_map, dict):
+            fallback.append(block_number)
+            continue
+
+        block = len(block_keys)
+        block_keys.append(block_number)
+        if builder not in builder_codes:
+            builder_codes[builder] = len(builders)
+            builders.append(builder)
+        block_builders.append(builder_codes[builder])
+        if fee_recipient not in fee_recipient_bytes:
+            fee_recipient_bytes[fee_recipient] = canonical_bytes(fee_recipient, 20)
+        fee_recipients.append(fee_recipient_bytes[fee_recipient])
+        base_fees.append(block_base_fee)
+        boundaries.append(int(total_txs * 0.1) + ((total_txs * 0.1) % 1 > 0))
+        num_txs.append(total_txs)
+        tx_offsets.append(total_tx_rows)
+        first, end = table.slices.get(str(block_number), (0, 0))
+        row_slices.append((first, end))
+        if end == first:
+            continue
+
+        txs = fetched_blocks[block_number]["transactions"]
+        if not isinstance(txs, tx_table.TxTable):
+            txs = tx_table.TxTable(list(txs))
+        tx_columns["present"].append(txs.present)
+        for field in tx_table.BINARY_FIELDS:
+            tx_columns[field].append(txs.binary[field])
+        for field in ["values_low", "values_high", "gas_prices", "gas_used"]:
+            tx_columns[field].append(getattr(txs, field).tobytes())
+        tx_columns["has_gas_used"].append(txs.has_gas_used)
+        for index, extra in txs.extra.items():
+            tx_extra[total_tx_rows + index] = extra
+        total_tx_rows += total_txs
+        for tx_hash, transfer in transfer_map.items():
+            raw = canonical_bytes(tx_hash, 32)
+            if raw is not None:
+                transfers.append(transfer)
+                transfer_keys.append(block.to_bytes(8, "big") + raw)
+
+    num_blocks = len(block_keys)
+    tx_present = np.frombuffer(b"".join(tx_columns["present"]), dtype=np.uint8)
+    tx_present = tx_present.astype(bool)
+    tx_binary = {
+        field: np.frombuffer(b"".join(tx_columns[field]), dtype=np.uint8).reshape(
+            -1, size
+        )
+        for field, size in tx_table.BINARY_FIELDS.items()
+    }
+    tx_numbers = {
+        field: np.frombuffer(b"".join(tx_columns[field]), dtype=np.uint64)
+        for field in ["values_low", "values_high", "gas_prices", "gas_used"]
+    }
+    tx_has_gas_used = np.frombuffer(
+        b"".join(tx_columns["has_gas_used"]), dtype=np.uint8
+    ).astype(bool)
+    # txs with one of the fields read kept in extra, and txs without a "to"
+    tx_unreadable = np.zeros(total_tx_rows + 1, dtype=bool)
+    next_tx_unreadable = np.zeros(total_tx_rows + 1, dtype=bool)
+    tx_without_to = np.zeros(total_tx_rows + 1, dtype=bool)
+    for tx, extra in tx_extra.items():
+        tx_unreadable[tx] = not TX_FIELDS.isdisjoint(extra)
+        next_tx_unreadable[tx] = not NEXT_TX_FIELDS.isdisjoint(extra)
+        if "to" in extra:
+            if extra["to"] is None:
+                tx_without_to[tx] = True
+            else:
+                next_tx_unreadable[tx] = True
+
+    # ROWS, the zeromev rows of the blocks in block order
+
+    slices = np.array(row_slices, dtype=np.int64).reshape(-1, 2)
+    lengths = slices[:, 1] - slices[:, 0]
+    row_block = np.repeat(np.arange(num_blocks), lengths)
+    row_starts = np.cumsum(lengths) - lengths
+    table_row = (
+        np.arange(len(row_block)) - np.repeat(row_starts, lengths)
+    ) + np.repeat(slices[:, 0], lengths)
+    num_rows = len(table_row)
+
+    tx_index = np.frombuffer(table.tx_indices, dtype=np.int64)[table_row]
+    block_num_txs = np.array(num_txs, dtype=np.int64)[row_block]
+    valid_index = (tx_index >= 0) & (tx_index < block_num_txs)
+    tx = np.where(valid_index, np.array(tx_offsets, dtype=np.int64)[row_block], 0)
+    tx = tx + np.where(valid_index, tx_index, 0)
+    is_last = tx_index == block_num_txs - 1
+    next_tx = np.where(valid_index & ~is_last, tx + 1, tx)
+
+    # a lookup of each code of the table's values, with the last entry for NO_VALUE
+    type_of_code = np.array(
+        [
+            (
+                SEARCHER_FIELDS.index(value)
+                if value in SEARCHER_FIELDS and value != "total"
+                else {"sandwich": SANDWICH, "swap": SWAP}.get(value, UNKNOWN)
+            )
+            if isinstance(value, str)
+            else UNKNOWN
+            for value in table.values
+        ]
+        + [UNKNOWN],
+        dtype=np.int64,
+    )
+    is_multiple = np.array(
+        [isinstance(v, str) and v == "multiple" for v in table.values] + [False]
+    )
+    mev_type = type_of_code[np.frombuffer(table.coded["mev_type"], np.int64)[table_row]]
+    protocol = np.frombuffer(table.coded["protocol"], dtype=np.int64)[table_row]
+    is_swap = mev_type == SWAP
+    nonatomic = is_swap & ~is_multiple[protocol]
+    mev_type = np.where(is_swap & is_multiple[protocol], UNCERTAIN, mev_type)
+    atomic = (mev_type >= 0) & ~nonatomic
+
+    bad = ~valid_index | (mev_type == UNKNOWN) | (is_swap & (protocol == -1))
+    reads_tx = atomic | nonatomic
+    bad |= reads_tx & (~(tx_present[tx] & tx_has_gas_used[tx]) | tx_unreadable[tx])
+
+    # address ids, -1 for None. Addresses kept in the table's extra are interned
+    # here. A row without the field, or with None, only raises for atomic rows,
+    # whose blocks are then analyzed block by block.
+    addresses = {}
+    for field in mev_table.ADDRESS_FIELDS:
+        ids = np.frombuffer(table.addresses[field], dtype=np.int64)[table_row]
+        for row in np.flatnonzero(ids == mev_table.NO_VALUE).tolist():
+            extra = table.extra.get(int(table_row[row]), {})
+            if extra.get(field) is None:
+                bad[row] |= bool(atomic[row])
+            elif not isinstance(extra[field], str):
+                bad[row] |= bool(reads_tx[row])
+            else:
+                ids[row] = registry.intern(extra[field])
+        addresses[field] = ids
+    addr_from, addr_to = addresses["address_from"], addresses["address_to"]
+    # swaps without both addresses are skipped, as are those with an empty one
+    nonatomic &= (addr_to != -1) & (addr_from != -1)
+    empty = registry.ids.get("")
+    if empty is not None:
+        nonatomic &= (addr_to != empty) & (addr_from != empty)
+    next_readable = tx_present[next_tx] & ~next_tx_unreadable[next_tx]
+    bad |= nonatomic & ~is_last & ~next_readable
+
+    # usd values as analyze_tx reads them, tx.get(field, 0) or 0
+    usd = {}
+    for field in mev_table.USD_FIELDS:
+        column = np.frombuffer(table.usd[field], dtype=np.float64)[table_row]
+        values = column.astype(object)
+        values[column == 0] = 0
+        for row in np.flatnonzero(np.isnan(column)).tolist():
+            values[row] = table.extra.get(int(table_row[row]), {}).get(field, 0) or 0
+        usd[field] = values
+
+    # the row's coinbase transfer, for the blocks with transfers
+    in_transfer = np.zeros(num_rows, dtype=bool)
+    transfer_value = np.zeros(num_rows, dtype=object)
+    if len(transfers) > 0:
+        # rows and transfers are matched on (block, tx hash), as 40 byte keys
+        keys = np.frombuffer(b"".join(transfer_keys), dtype="V40")
+        key_order = np.argsort(keys, kind="stable")
+        keys = keys[key_order]
+        row_keys = np.hstack(
+            [
+                row_block.astype(">u8").view(np.uint8).reshape(-1, 8),
+                tx_binary["hash"][tx],
+            ]
+        )
+        row_keys = np.ascontiguousarray(row_keys).view("V40").ravel()
+        found = np.minimum(np.searchsorted(keys, row_keys), len(keys) - 1)
+        in_transfer = reads_tx & ~bad & (keys[found] == row_keys)
+        for row, transfer in zip(
+            np.flatnonzero(in_transfer).tolist(),
+            key_order[found[in_transfer]].tolist(),
+        ):
+            try:
+                transfer_value[row] = transfers[transfer]["value"]
+            except Exception:
+                bad[row] = True
+
+    # blocks with a row the columns do not cover go to analyze_block
+    bad_blocks = np.zeros(num_blocks, dtype=bool)
+    bad_blocks[row_block[bad]] = True
+    fallback += [block_keys[block] for block in np.flatnonzero(bad_blocks).tolist()]
+    if len(fallback) > 0:
+        return fallback
+
+    for block in range(num_blocks):
+        builder = builders[block_builders[block]]
+        metrics.builder_atomic_map_block.add((builder, "total"), 1)
+        metrics.builder_nonatomic_map_block.add((builder, "total"), 1)
+
+    # VALUES
+
+    rows = np.arange(num_rows)
+    builder = np.array(block_builders, dtype=np.int64)[row_block]
+    # wei, as Python ints, only for the rows that read them
+    gas_used = np.zeros(num_rows, dtype=object)
+    gas_price = np.zeros(num_rows, dtype=object)
+    priority_fee = np.zeros(num_rows, dtype=object)
+    pays = atomic | nonatomic
+    gas_used[pays] = tx_numbers["gas_used"][tx[pays]].astype(object)
+    gas_price[pays] = tx_numbers["gas_prices"][tx[pays]].astype(object)
+    base_fee = object_column(base_fees)[row_block[pays]]
+    priority_fee[pays] = gas_used[pays] * gas_price[pays] - gas_used[pays] * base_fee
+    profit = usd["extractor_profit_usd"]
+    volume = usd["extractor_swap_volume_usd"]
+    user_volume = usd["user_swap_volume_usd"]
+    ones = np.ones(num_rows, dtype=object)
+
+    # nonatomic rows by the first criterion of nonatomic_mev.analyze_tx they meet
+    block_fee_recipients = np.zeros((num_blocks, 20), dtype=np.uint8)
+    has_fee_recipient = np.zeros(num_blocks, dtype=bool)
+    for block, raw in enumerate(fee_recipients):
+        if raw is not None:
+            block_fee_recipients[block] = np.frombuffer(raw, dtype=np.uint8)
+            has_fee_recipient[block] = True
+    followed_by_transfer = (
+        ~is_last
+        & (tx_binary["from"][next_tx] == tx_binary["from"][tx]).all(axis=1)
+        & (tx_binary["to"][next_tx] == block_fee_recipients[row_block]).all(axis=1)
+        & has_fee_recipient[row_block]
+        & ~tx_without_to[next_tx]
+    )
+    coinbase = nonatomic & in_transfer
+    after = nonatomic & ~coinbase & followed_by_transfer
+    top = nonatomic & ~coinbase & ~after
+    top &= tx_index <= np.array(boundaries, dtype=np.int64)[row_block]
+    # the value sent to the fee recipient after the swap, as helpers.wei_to_eth
+    eth = np.zeros(num_rows, dtype=object)
+    high = tx_numbers["values_high"][next_tx[after]].astype(object)
+    low = tx_numbers["values_low"][next_tx[after]].astype(object)
+    eth[after] = ((high << 64) | low) / WEI_PER_ETH
+
+    # address codes are ids + 1, so that None is 0
+    def decode_address(code):
+        return None if code == 0 else code - 1
+
+    def decode_builder(code):
+        return builders[code]
+
+    def decode_field(code):
+        return SEARCHER_FIELDS[code]
+
+    # ATOMIC
+
+    atomic_searcher = np.where(mev_type == LIQUID, addr_from, addr_to) + 1
+    to = addr_to + 1
+    fields = np.where(atomic, mev_type, TOTAL)
+    totals = np.full(num_rows, TOTAL)
+
+    def add_atomic(contributions, mask, address, values, total=True):
+        contributions.add(
+            rows[mask], (builder[mask], address[mask], fields[mask]), values[mask]
+        )
+        if total:
+            contributions.add(
+                rows[mask], (builder[mask], address[mask], totals[mask]), values[mask]
+            )
+
+    atomic_decode = (decode_builder, decode_address, decode_field)
+    coin = Contributions(*atomic_decode)
+    add_atomic(coin, atomic & in_transfer, to, transfer_value)
+    coin.add_sums_to(metrics.builder_atomic_map_coin_bribe)
+    gas = Contributions(*atomic_decode)
+    add_atomic(gas, atomic, to, priority_fee)
+    gas.add_sums_to(metrics.builder_atomic_map_gas_bribe)
+
+    is_arb = atomic & ((mev_type == ARB) | (mev_type == FRONTRUN))
+    is_backrun = atomic & (mev_type == BACKRUN)
+    is_liquid = atomic & (mev_type == LIQUID)
+    is_uncertain = atomic & (mev_type == UNCERTAIN)
+    searcher_volume = np.where(is_uncertain, user_volume, volume)
+
+    txs = Contributions(*atomic_decode)
+    add_atomic(txs, atomic, atomic_searcher, ones)
+    txs.add_sums_to(metrics.builder_atomic_map_tx)
+    profits = Contributions(*atomic_decode)
+    add_atomic(profits, is_arb | is_backrun, atomic_searcher, profit)
+    profits.add(
+        rows[is_liquid],
+        (builder[is_liquid], atomic_searcher[is_liquid], totals[is_liquid]),
+        profit[is_liquid],
+    )
+    profits.add_sums_to(metrics.builder_atomic_map_profit)
+    volumes = Contributions(*atomic_decode)
+    add_atomic(volumes, atomic & ~is_backrun, atomic_searcher, searcher_volume)
+    add_atomic(volumes, is_backrun, atomic_searcher, searcher_volume, total=False)
+    volumes.add_sums_to(metrics.builder_atomic_map_vol)
+    volume_lists = Contributions(decode_builder, decode_address)
+    volume_lists.add(
+        rows[atomic],
+        (builder[atomic], atomic_searcher[atomic]),
+        searcher_volume[atomic],
+    )
+    volume_lists.append_lists_to(metrics.builder_atomic_map_vol_list)
+
+    # NONATOMIC
+
+    counted = coinbase | after | top
+    nonatomic_searcher = np.where(after, addr_from, addr_to) + 1
+    nonatomic_decode = (decode_builder, decode_address)
+
+    def add_nonatomic(contributions, mask, values):
+        contributions.add(
+            rows[mask], (builder[mask], nonatomic_searcher[mask]), values[mask]
+        )
+
+    txs = Contributions(*nonatomic_decode)
+    add_nonatomic(txs, counted, ones)
+    txs.add_sums_to(metrics.builder_nonatomic_map_tx)
+    volumes = Contributions(*nonatomic_decode)
+    add_nonatomic(volumes, counted, user_volume)
+    volumes.add_sums_to(metrics.builder_nonatomic_map_vol)
+    volume_lists = Contributions(*nonatomic_decode)
+    add_nonatomic(volume_lists, counted, user_volume)
+    volume_lists.append_lists_to(metrics.builder_nonatomic_map_vol_list)
+    coin = Contributions(*nonatomic_decode)
+    add_nonatomic(coin, coinbase, transfer_value)
+    add_nonatomic(coin, after, eth)
+    coin.add_sums_to(metrics.builder_nonatomic_map_coin_bribe)
+    gas = Contributions(*nonatomic_decode)
+    add_nonatomic(gas, coinbase, priority_fee)
+    # the gas paid and the priority fee are both added for top of block swaps
+    add_nonatomic(gas, top, gas_used * gas_price + priority_fee)
+    gas.add_sums_to(metrics.builder_nonatomic_map_gas_bribe)
+
+    bribes = Contributions(decode_address, decode_builder)
+    bribes.add(
+        rows[coinbase],
+        (nonatomic_searcher[coinbase], builder[coinbase]),
+        transfer_value[coinbase],
+    )
+    bribes.append_lists_to(metrics.coinbase_bribe)
+    bribes = Contributions(decode_address, decode_builder)
+    bribes.add(rows[after], (nonatomic_searcher[after], builder[after]), eth[after])
+    bribes.append_lists_to(metrics.after_bribe)
+    bribes = Contributions(decode_address)
+    bribes.add(
+        rows[top],
+        (nonatomic_searcher[top],),
+        object_column(
+            [
+                {
+                    "builder": builders[block_builders[block]],
+                    "block_number": block_keys[block],
+                    "index": index,
+                    "gas_price": price,
+                }
+                for block, index, price in zip(
+                    row_block[top].tolist(),
+                    tx_index[top].tolist(),
+                    gas_price[top].tolist(),
+                )
+            ]
+        ),
+    )
+    bribes.append_lists_to(metrics.tob_bribe)
+
+    # BLOCKS COUNTED, once per searcher and block across atomic and nonatomic rows,
+    # in the metric of the searcher's first row in the block
+    block_searcher = np.where(atomic, atomic_searcher, nonatomic_searcher)
+    counts = atomic | counted
+    first_rows = rows[counts]
+    key = row_block[first_rows] * (len(registry) + 1) + block_searcher[first_rows]
+    _, first = np.unique(key, return_index=True)
+    first_rows = first_rows[np.sort(first)]
+    for metric, kind in [
+        (metrics.builder_atomic_map_block, atomic),
+        (metrics.builder_nonatomic_map_block, counted),
+    ]:
+        counted_rows = first_rows[kind[first_rows]]
+        blocks = Contributions(decode_builder, decode_address)
+        blocks.add(
+            counted_rows,
+            (builder[counted_rows], block_searcher[counted_rows]),
+            ones[counted_rows],
+        )
+        blocks.add_sums_to(metric)
+
+    return []
@@ -1,13 +1,39 @@
-import traceback
+import asyncio
+import aiohttp
 import requests, json, time
-from urllib3.exceptions import IncompleteRead
+from urllib3.util.retry import Retry
+from requests.adapters import HTTPAdapter
 import secret_keys
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import scheduler
+import rpc_cache
+from functools import partial
 from collections import defaultdict
 
 
 MAX_RETRIES = 5  # Define a maximum number of retries
 INITIAL_BACKOFF = 1  # Define initial backoff time in seconds
+MAX_BATCHES_IN_FLIGHT = 4  # Number of 1000-block batches kept in flight
+# "bisect" retries only the failed ids of a batch, "whole" re-posts the entire batch
+BATCH_RETRY_MODE = "bisect"
+BISECT_RETRIES = 2  # Attempts on a sub-batch before it is split in half
+# Posts of a batch, and of the sub-batches split from it, that may fail as a whole
+# (status 429, 5xx, a timeout) before its pending ids are reported as failed
+MAX_TRANSPORT_RETRIES = 5
+# "range" asks for transfers over block ranges per fee recipient, "block" sends one call per block
+TRANSFER_FETCH_MODE = "range"
+# "alchemy" sends one alchemy_getTransactionReceipts request per block,
+# "standard" sends JSON-RPC batches of eth_getBlockReceipts, which any node serves
+RECEIPTS_BACKEND = "alchemy"
+RECEIPTS_BATCH_SIZE = 50  # Blocks per eth_getBlockReceipts batch, receipts are heavy
+RECEIPTS_CONNECTION_RETRIES = 3  # Immediate retries of a dropped receipts connection
+# Internal transfers to the fee recipient of a block, as cached per block
+TRANSFERS_CACHE_METHOD = "alchemy_getAssetTransfers:internal_to_fee_recipient"
+# Blocks of a fee recipient further apart than this are fetched in separate ranges
+TRANSFER_RANGE_MAX_GAP = 7200
+REQUEST_TIMEOUT = 30  # Seconds before a single request is given up and retried
+
+# Throughput of the most recent block fetch, updated by record_fetch_stats
+fetch_stats = {"blocks": 0, "seconds": 0, "blocks_per_sec": 0, "failed_blocks": []}
 
 
 # BLOCKS
@@ -21,113 +47,394 @@ def simplify_block(block):
         "feeRecipient": block["miner"],
         "baseFeePerGas": int(block.get("baseFeePerGas", "0x0"), 16),
         "gasUsed": int(block.get("gasUsed", "0x0"), 16),
-        "transactions": [
-            {
-                "transactionIndex": int(tx["transactionIndex"], 16),
-                "hash": tx["hash"],
-                "from": tx["from"],
-                "to": tx.get("to", "0x0"),
-                "value": int(tx["value"], 16),
-                "gasPrice": int(tx.get("gasPrice", "0x0"), 16),
-            }
-            for _, tx in enumerate(block["transactions"])
-        ],
+        "transactions": [simplify_tx(tx) for tx in block["transactions"]],
     }
     return simplified
 
 
+def simplify_tx(tx):
+    return {
+        "transactionIndex": int(tx["transactionIndex"], 16),
+        "hash": tx["hash"],
+        "from": tx["from"],
+        "to": tx.get("to", "0x0"),
+        "value": int(tx["value"], 16),
+        "gasPrice": int(tx.get("gasPrice", "0x0"), 16),
+    }
+
+
+# Simplify a block fetched without full txs. Its transactions are tx hashes
+# until get_mev_txs_of_blocks fills in the ones that matter.
+def simplify_block_header(block):
+    return {
+        **simplify_block({**block, "transactions": []}),
+        "transactions": block["transactions"],
+    }
+
+
 # Simplify block fetched and handle errorneous responses
-def process_batch_response(response, blocks_fetched):
-    success = True
+# Returns the ids of the batch that could not be fetched, so an empty list means success
+# simplify is applied to every result, for batches of other calls than eth_getBlockByNumber
+def process_batch_response(batch, blocks, blocks_fetched, simplify=simplify_block):
+    failed_ids = []
+    cache = rpc_cache.get_cache()
+    calls_by_id = {call["id"]: call for call in batch}
     try:
-        blocks = response.json()  # [{}, {}]
+        # blocks is the parsed batch response: [{}, {}]
         for b in blocks:
             if ("result" in b and b["result"] is None) or "error" in b:
                 print(f"block {b['id']} cannot be fetched: {b}")
-                success = False
-                # immediately stop processing this batch of response bc whole batch may be bad
-                return success
+                failed_ids.append(b["id"])
             else:
                 block_number = str(b["id"])
                 full_block = b["result"]
-                blocks_fetched[block_number] = simplify_block(full_block)
-        return success
+                if cache is not None and b["id"] in calls_by_id:
+                    cache.put_call(calls_by_id[b["id"]], full_block)
+                blocks_fetched[block_number] = simplify(full_block)
+
+        # ids that are dropped from the response entirely also need a retry
+        failed_ids += [
+            req["id"] for req in batch if str(req["id"]) not in blocks_fetched
+        ]
+        return list(set(failed_ids))
 
     except Exception as e:
         print("Exception occurred", e)
+        return [req["id"] for req in batch if str(req["id"]) not in blocks_fetched]
+
 
+def transport_error(status, headers):
+    retry_after = scheduler.parse_retry_after(headers.get("Retry-After"))
+    if retry_after is not None:
+        scheduler.get_scheduler().pause("alchemy", retry_after)
+    return scheduler.RetryableError(
+        f"Non-success status code received: {status}", retry_after
+    )
 
-# Sends batch requests of 1000 to node
-# Uses exponential retries when errors are encountered
 
+# Seconds to wait before re-posting a batch after its n-th failed post
+def transport_backoff(error, n):
+    if error.retry_after is not None:
+        return error.retry_after
+    return INITIAL_BACKOFF * (2**n)
 
-# def batch_request(block, end_block, batch_size, retries, blocks_fetched):
-# def batch_request(first_block_of_batch, end_block, batch_size, retries, blocks_fetched):
-def batch_request(batch, retries, blocks_fetched):
-    headers = {"Content-Type": "application/json"}
 
+def sub_batch(batch, ids):
+    ids = set(ids)
+    return [req for req in batch if req["id"] in ids]
+
+
+def build_block_batch(block_nums):
+    return [
+        {
+            "jsonrpc": "2.0",
+            "id": block,
+            "method": "eth_getBlockByNumber",
+            "params": [hex(block), True],
+        }
+        for block in block_nums
+    ]
+
+
+# Same as build_block_batch, but the blocks come with tx hashes instead of txs
+def build_block_header_batch(block_nums):
+    return [
+        {**call, "params": [call["params"][0], False]}
+        for call in build_block_batch(block_nums)
+    ]
+
+
+# Posts a batch once, returns the ids the provider answered with an error or left
+# out. Raises scheduler.RetryableError when the whole post failed, e.g. on a 429,
+# a 5xx or a timeout, which says nothing about the individual ids.
+async def async_post_batch(session, batch, blocks_fetched, simplify=simplify_block):
+    await scheduler.get_scheduler().acquire_async(
+        "alchemy", sum(scheduler.compute_units(call["method"]) for call in batch)
+    )
+    try:
+        async with session.post(
+            secret_keys.ALCHEMY, data=json.dumps(batch)
+        ) as response:
+            if response.status != 200:
+                raise transport_error(response.status, response.headers)
+            body = await response.read()
+            # parsing happens while the other batches are still on the wire
+            blocks = json.loads(body)
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+        raise scheduler.RetryableError(f"{type(e).__name__} occurred: {e}")
+    return process_batch_response(batch, blocks, blocks_fetched, simplify)
+
+
+# Sends a batch of calls to the node with exponential retries.
+# BATCH_RETRY_MODE "whole" re-posts the entire batch on any error,
+# "bisect" keeps successful results and only re-requests the failed ids.
+# Sleeping between retries only parks this batch, other batches in flight keep going.
+async def async_batch_request(
+    session, batch, blocks_fetched, failed_blocks, simplify=simplify_block
+):
+    if BATCH_RETRY_MODE == "bisect":
+        await async_bisect_batch_request(
+            session, batch, blocks_fetched, failed_blocks, simplify
+        )
+        return
+
+    retries = 0
     while retries < MAX_RETRIES:
+        delay = INITIAL_BACKOFF * (2**retries)
+        try:
+            failed_ids = await async_post_batch(
+                session, batch, blocks_fetched, simplify
+            )
+        except scheduler.RetryableError as e:
+            print(e)
+            failed_ids = [req["id"] for req in batch]
+            delay = transport_backoff(e, retries)
+        if len(failed_ids) == 0:
+            print(f"Batch starting at {batch[0]['id']} fetched & processed")
+            return
+
+        retries += 1
+        if retries == MAX_RETRIES:
+            print(f"Max retries reached for batch starting at {batch[0]['id']}.")
+            failed_blocks += failed_ids
+            return
+        print(f"Retrying for the {retries + 1} time")
+        await asyncio.sleep(delay)
+
+
+# Re-requests only the failed ids of a batch. If some ids keep failing after
+# BISECT_RETRIES attempts, the remaining sub-batch is split in half and each
+# half is retried on its own until every bad block is isolated in failed_blocks.
+# Only ids the provider answered with an error are bisected. A post that failed
+# as a whole is re-sent as it is after a backoff, and once the batch and its
+# sub-batches used up MAX_TRANSPORT_RETRIES such failures, its pending ids fail.
+async def async_bisect_batch_request(
+    session, batch, blocks_fetched, failed_blocks, simplify=simplify_block, budget=None
+):
+    if budget is None:
+        budget = [MAX_TRANSPORT_RETRIES]  # shared with the sub-batches
+    pending = batch
+    attempt = 0
+    while attempt < BISECT_RETRIES:
         try:
-            start = time.time()
-            print(f"Attempt {retries + 1} at fetching batch.")
-            response = requests.post(
-                secret_keys.ALCHEMY, headers=headers, data=json.dumps(batch)
+            failed_ids = await async_post_batch(
+                session, pending, blocks_fetched, simplify
+            )
+        except scheduler.RetryableError as e:
+            budget[0] -= 1
+            if budget[0] <= 0:
+                print(f"{e}, giving up on {len(pending)} blocks")
+                failed_blocks += [req["id"] for req in pending]
+                return
+            await asyncio.sleep(
+                transport_backoff(e, MAX_TRANSPORT_RETRIES - budget[0] - 1)
             )
+            continue
+        pending = sub_batch(pending, failed_ids)
+        if len(pending) == 0:
+            return
+        attempt += 1
+        if attempt < BISECT_RETRIES:
+            await asyncio.sleep(INITIAL_BACKOFF * (2 ** (attempt - 1)))
+
+    if len(pending) == 1:
+        print(f"block {pending[0]['id']} failed after {BISECT_RETRIES} attempts")
+        failed_blocks.append(pending[0]["id"])
+        return
+
+    mid = len(pending) // 2
+    print(f"Splitting {len(pending)} failed blocks starting at {pending[0]['id']}")
+    await async_bisect_batch_request(
+        session, pending[:mid], blocks_fetched, failed_blocks, simplify, budget
+    )
+    await async_bisect_batch_request(
+        session, pending[mid:], blocks_fetched, failed_blocks, simplify, budget
+    )
 
-            if response.status_code == 200:
-                success = process_batch_response(response, blocks_fetched)
-                if success:  # if retry is not required, process is complete'
-                    print("Batch successfully fetched & processed")
-                    break
-            else:
-                print(
-                    f"Non-success status code received: {response.status_code}, retrying for the {retries + 1} time"
+
+# Keeps up to max_in_flight batches posted at once instead of waiting on each
+# batch's full round trip before sending the next one
+async def fetch_block_batches(
+    batches, max_in_flight=MAX_BATCHES_IN_FLIGHT, simplify=simplify_block
+):
+    blocks_fetched = {}
+    failed_blocks = []
+    in_flight = asyncio.Semaphore(max_in_flight)
+    headers = {"Content-Type": "application/json"}
+    connector = aiohttp.TCPConnector(limit=max_in_flight)
+
+    async with aiohttp.ClientSession(headers=headers, connector=connector) as session:
+
+        async def fetch_one(batch):
+            async with in_flight:
+                await async_batch_request(
+                    session, batch, blocks_fetched, failed_blocks, simplify
                 )
 
-            retries += 1
-            time.sleep(
-                INITIAL_BACKOFF * (2**retries)
-            )  # Sleep before next retry with exponential backoff
+        await asyncio.gather(*(fetch_one(batch) for batch in batches))
 
-            if retries == MAX_RETRIES:
-                print("Max retries reached. Exiting.")
-        except IncompleteRead as e:
-            print(
-                f"IncompleteRead error occurred: {e}, retrying for the {retries + 1} time"
-            )
-            retries += 1
-            time.sleep(
-                INITIAL_BACKOFF * (2**retries)
-            )  # Sleep before next retry with exponential backof
+    return blocks_fetched, failed_blocks
 
 
-# Get all blocks in batch requests of 1000
-def get_blocks_by_list(block_nums):
-    batch_size = 1000
-    blocks_fetched = {}
+def record_fetch_stats(num_blocks, seconds, failed_blocks=()):
+    fetch_stats["blocks"] = num_blocks
+    fetch_stats["seconds"] = seconds
+    fetch_stats["blocks_per_sec"] = num_blocks / seconds if seconds > 0 else 0
+    fetch_stats["failed_blocks"] = sorted(failed_blocks)
+    print(
+        f"Fetched {num_blocks} blocks in {seconds} seconds ({fetch_stats['blocks_per_sec']:.1f} blocks/sec)"
+    )
+    if len(failed_blocks) > 0:
+        print(
+            f"{len(failed_blocks)} blocks could not be fetched:", sorted(failed_blocks)
+        )
+    return fetch_stats["blocks_per_sec"]
+
+
+# Adds the block nums whose data could not be fetched to fetch_stats, for the
+# caller to leave out of the window so that the next run fetches them again
+def report_failed_blocks(failed_blocks, what):
+    failed_blocks = sorted(int(block_num) for block_num in failed_blocks)
+    if len(failed_blocks) > 0:
+        fetch_stats["failed_blocks"] = sorted(
+            set(fetch_stats["failed_blocks"]) | set(failed_blocks)
+        )
+        print(f"{len(failed_blocks)} blocks of {what} could not be fetched:")
+        print(failed_blocks)
+    return failed_blocks
+
+
+# Sends calls in batches of batch_size, max_in_flight batches at a time.
+# Returns {str(call id): simplify(result)} and the ids that could not be fetched.
+def get_batched(
+    calls,
+    simplify,
+    batch_size=1000,
+    max_in_flight=MAX_BATCHES_IN_FLIGHT,
+    use_cache=True,
+):
+    # calls already answered in the rpc cache are not sent again
+    cached = {}
+    cache = rpc_cache.get_cache()
+    if cache is not None and use_cache:
+        to_send = []
+        for call in calls:
+            result = cache.get_call(call)
+            if result is None:
+                to_send.append(call)
+            else:
+                cached[str(call["id"])] = simplify(result)
+        if len(cached) > 0:
+            print(f"{len(cached)} of {len(calls)} calls answered from the rpc cache")
+        calls = to_send
+
+    batches = [calls[i : i + batch_size] for i in range(0, len(calls), batch_size)]
+    results, failed_ids = asyncio.run(
+        fetch_block_batches(batches, max_in_flight, simplify)
+    )
+    results.update(cached)
+    return results, failed_ids
 
+
+# Get all blocks in batch requests of 1000, max_in_flight batches at a time
+def get_blocks_by_list(block_nums, max_in_flight=MAX_BATCHES_IN_FLIGHT):
     start = time.time()
     print("Fetching blocks at", start)
 
-    for i in range(0, len(block_nums), batch_size):
-        batch = [
-            {
-                "jsonrpc": "2.0",
-                "id": block,
-                "method": "eth_getBlockByNumber",
-                "params": [hex(block), True],
-            }
-            for block in block_nums[i : i + batch_size]
-        ]
+    blocks_fetched, failed_blocks = get_batched(
+        build_block_batch(block_nums), simplify_block, max_in_flight=max_in_flight
+    )
 
-        batch_request(batch, 0, blocks_fetched)
+    record_fetch_stats(len(blocks_fetched), time.time() - start, failed_blocks)
 
-    print(
-        "Finished fetching blocks in",
-        time.time() - start,
-        " seconds. Now adding gasUsed to block txs.",
+    return blocks_fetched
+
+
+# Indices of the txs zeromev flagged in a block and of the tx right after
+# each of them, which is every tx analyze_block reads
+def mev_tx_indices(zeromev_block_txs):
+    indices = set()
+    for tx in zeromev_block_txs or []:
+        indices.add(tx["tx_index"])
+        indices.add(tx["tx_index"] + 1)
+    return indices
+
+
+def build_tx_call(method, block_num, index, tx_hash):
+    return {
+        "jsonrpc": "2.0",
+        "id": f"{block_num}:{index}",
+        "method": method,
+        "params": [tx_hash],
+    }
+
+
+def simplify_tx_receipt(receipt):
+    return int(receipt["gasUsed"], 16)
+
+
+# Zeromev-first alternative to get_blocks_by_list + get_blocks_receipts_by_list.
+# Fetches block headers, then only the txs and receipts at the indices zeromev
+# flagged in each block (see mev_tx_indices). The other txs are left as None so
+# that tx indices and the block's tx count stay the same as in a full block.
+# Blocks with a tx or a receipt that could not be fetched are left out, so they show
+# up as missing and are fetched again on the next run.
+def get_mev_txs_of_blocks(
+    block_nums, zeromev_blocks, max_in_flight=MAX_BATCHES_IN_FLIGHT
+):
+    start = time.time()
+    print("Fetching block headers at", start)
+    headers, failed_blocks = get_batched(
+        build_block_header_batch(block_nums),
+        simplify_block_header,
+        max_in_flight=max_in_flight,
     )
 
+    tx_calls = []
+    receipt_calls = []
+    for block_num, header in headers.items():
+        tx_hashes = header["transactions"]
+        for index in mev_tx_indices(zeromev_blocks.get(block_num, [])):
+            if index < len(tx_hashes):
+                tx_hash = tx_hashes[index]
+                tx_calls.append(
+                    build_tx_call("eth_getTransactionByHash", block_num, index, tx_hash)
+                )
+                receipt_calls.append(
+                    build_tx_call(
+                        "eth_getTransactionReceipt", block_num, index, tx_hash
+                    )
+                )
+
+    print(f"Fetching {len(tx_calls)} txs and receipts flagged by zeromev")
+    txs, _ = get_batched(tx_calls, simplify_tx, max_in_flight=max_in_flight)
+    # a tx without its receipt would be stored with a made up gasUsed, which
+    # zeroes its priority fee and gas bribe, so its block is left out instead
+    gas_used, _ = get_batched(
+        receipt_calls, simplify_tx_receipt, max_in_flight=max_in_flight
+    )
+
+    blocks_fetched = {}
+    for block_num, header in headers.items():
+        transactions = [None] * len(header["transactions"])
+        complete = True
+        for index in mev_tx_indices(zeromev_blocks.get(block_num, [])):
+            if index >= len(transactions):
+                continue
+            tx = txs.get(f"{block_num}:{index}")
+            tx_gas_used = gas_used.get(f"{block_num}:{index}")
+            if tx is None or tx_gas_used is None:
+                complete = False
+                break
+            tx["gasUsed"] = tx_gas_used
+            transactions[index] = tx
+        if complete:
+            blocks_fetched[block_num] = {**header, "transactions": transactions}
+        else:
+            failed_blocks.append(int(block_num))
+
+    record_fetch_stats(len(blocks_fetched), time.time() - start, failed_blocks)
+
     return blocks_fetched
 
 
@@ -135,46 +442,30 @@ def get_blocks_by_list(block_nums):
 def add_gas_used_to_blocks(blocks, receipts):
     for block_num, block in blocks.items():
         rs = receipts.get(str(block_num), {})
-        rs_num = len(rs)
-        txs = block["transactions"]
-        for tx in txs:
-            tx_index = tx["transactionIndex"]
-            if tx_index >= rs_num:  #
-                block["transactions"][tx_index]["gasUsed"] = 0
-            else:
-                gas_used = rs[tx_index].get("gas_used", 0)
-                block["transactions"][tx_index]["gasUsed"] = gas_used
+        add_gas_used_to_block(block, rs)
 
     return blocks
 
 
-# Get all blocks in batch requests of 1000
-def get_blocks(start_block, num_blocks):
-    batch_size = 1000
-    end_block = start_block + num_blocks - 1
-    blocks_fetched = {}
+def add_gas_used_to_block(block, rs):
+    rs_num = len(rs)
+    txs = block["transactions"]
+    for tx in txs:
+        if tx is None:  # tx left out by get_mev_txs_of_blocks
+            continue
+        tx_index = tx["transactionIndex"]
+        if tx_index >= rs_num:  #
+            block["transactions"][tx_index]["gasUsed"] = 0
+        else:
+            gas_used = rs[tx_index].get("gas_used", 0)
+            block["transactions"][tx_index]["gasUsed"] = gas_used
+    return block
 
-    start = time.time()
-    print("Fetching blocks at", start)
 
-    for block in range(start_block, end_block + 1, batch_size):
-        batch = [
-            {
-                "jsonrpc": "2.0",
-                "id": i,
-                "method": "eth_getBlockByNumber",
-                "params": [hex(i), True],
-            }
-            for i in range(block, min(block + batch_size, end_block + 1))
-        ]
-        batch_request(batch, 0, blocks_fetched)
-
-    print(
-        "Finished fetching blocks within",
-        time.time() - start,
-        "seconds.",
-    )
-    return blocks_fetched
+# Get all blocks in batch requests of 1000
+def get_blocks(start_block, num_blocks, max_in_flight=MAX_BATCHES_IN_FLIGHT):
+    end_block = start_block + num_blocks - 1
+    return get_blocks_by_list(list(range(start_block, end_block + 1)), max_in_flight)
 
 
 # Counts that the blocks in block file is in order and present
@@ -212,52 +503,218 @@ def default_internal_transfer_dic():
 def get_internal_transfers_to_fee_recipient_in_block(
     block_number, builder, all_internal_transfers
 ):
-    try:
-        headers = {"accept": "application/json", "content-type": "application/json"}
-        payload = {
-            "id": 1,
-            "jsonrpc": "2.0",
-            "method": "alchemy_getAssetTransfers",
-            "params": [
-                {
-                    "category": ["internal"],
-                    "toAddress": builder,
-                    "fromBlock": hex(int(block_number)),
-                    "toBlock": hex(int(block_number)),
-                }
-            ],
-        }
+    headers = {"accept": "application/json", "content-type": "application/json"}
+    payload = {
+        "id": 1,
+        "jsonrpc": "2.0",
+        "method": "alchemy_getAssetTransfers",
+        "params": [
+            {
+                "category": ["internal"],
+                "toAddress": builder,
+                "fromBlock": hex(int(block_number)),
+                "toBlock": hex(int(block_number)),
+            }
+        ],
+    }
 
-        response = requests.post(secret_keys.ALCHEMY, json=payload, headers=headers)
-        print(block_number)
-        transfers = response.json()["result"]["transfers"]
-        transfer_map = {
-            tr["hash"]: {"from": tr["from"], "to": tr["to"], "value": tr["value"]}
-            for tr in transfers
-        }
-        all_internal_transfers[block_number] = transfer_map
-    except Exception as e:
-        print("error found in one block", e, block_number)
-        print(traceback.format_exc())
+    response = requests.post(secret_keys.ALCHEMY, json=payload, headers=headers)
+    scheduler.check_response(response)
+    print(block_number)
+    transfers = response.json()["result"]["transfers"]
+    cache = rpc_cache.get_cache()
+    if cache is not None:
+        cache.put(TRANSFERS_CACHE_METHOD, block_number, transfers)
+    all_internal_transfers[block_number] = transfer_map_from_transfers(transfers)
+
+
+def transfer_map_from_transfers(transfers):
+    return {
+        tr["hash"]: {"from": tr["from"], "to": tr["to"], "value": tr["value"]}
+        for tr in transfers
+    }
+
+
+# Takes the blocks whose transfers are in the rpc cache out of blocks and puts
+# their transfer maps in all_internal_transfers. Returns the blocks left to fetch.
+def load_cached_internal_transfers(blocks, all_internal_transfers):
+    cache = rpc_cache.get_cache()
+    if cache is None:
+        return blocks
+
+    to_fetch = {}
+    for block_number, block in blocks.items():
+        transfers = cache.get(TRANSFERS_CACHE_METHOD, block_number)
+        if transfers is None:
+            to_fetch[block_number] = block
+        else:
+            all_internal_transfers[block_number] = transfer_map_from_transfers(
+                transfers
+            )
+    if len(to_fetch) < len(blocks):
+        print(f"{len(blocks) - len(to_fetch)} blocks of transfers from the rpc cache")
+    return to_fetch
 
 
-def get_internal_transfers_to_fee_recipients_in_blocks(blocks):
+def get_internal_transfers_to_fee_recipients_in_blocks(
+    blocks, mode=TRANSFER_FETCH_MODE
+):
     all_internal_transfers = defaultdict(
         lambda: defaultdict(default_internal_transfer_dic)
     )
-    with ThreadPoolExecutor(max_workers=64) as executor:
-        # Use the executor to submit the tasks
-        futures = [
-            executor.submit(
-                get_internal_transfers_to_fee_recipient_in_block,
+    blocks = load_cached_internal_transfers(blocks, all_internal_transfers)
+    if mode == "range":
+        get_internal_transfers_to_fee_recipients_in_ranges(
+            blocks, all_internal_transfers
+        )
+    else:
+        cost = scheduler.compute_units("alchemy_getAssetTransfers")
+        jobs = [
+            (
                 block_number,
-                block["feeRecipient"],
-                all_internal_transfers,
+                "alchemy",
+                cost,
+                partial(
+                    get_internal_transfers_to_fee_recipient_in_block,
+                    block_number,
+                    block["feeRecipient"],
+                    all_internal_transfers,
+                ),
             )
             for block_number, block in blocks.items()
         ]
-        for future in as_completed(futures):
-            pass
+        scheduler.get_scheduler().run(jobs, "internal transfer requests")
+
+    # the blocks of the requests that failed get no transfer map at all, unlike
+    # blocks without transfers, so they are not taken for blocks without bribes
+    report_failed_blocks(
+        [
+            block_number
+            for block_number in blocks
+            if block_number not in all_internal_transfers
+        ],
+        "internal transfers",
+    )
+    return all_internal_transfers
+
+
+# Groups blocks by fee recipient and splits each recipient's blocks into ranges,
+# starting a new range when the next block is more than max_gap blocks away.
+# Returns [(fee_recipient, from_block, to_block, {block_number: block_key})]
+def group_blocks_into_transfer_ranges(blocks, max_gap=TRANSFER_RANGE_MAX_GAP):
+    by_recipient = defaultdict(list)
+    for block_number, block in blocks.items():
+        by_recipient[block["feeRecipient"]].append(int(block_number))
+
+    ranges = []
+    for fee_recipient, block_nums in by_recipient.items():
+        block_nums.sort()
+        current = [block_nums[0]]
+        for block_num in block_nums[1:]:
+            if block_num - current[-1] > max_gap:
+                ranges.append((fee_recipient, current))
+                current = []
+            current.append(block_num)
+        ranges.append((fee_recipient, current))
+
+    key_type = type(next(iter(blocks))) if len(blocks) > 0 else str
+    return [
+        (fee_recipient, nums[0], nums[-1], {num: key_type(num) for num in nums})
+        for fee_recipient, nums in ranges
+    ]
+
+
+# Fetches one page of internal transfers to fee_recipient over [from_block, to_block].
+# Transfers are collected in range_transfers until the last page, which splits them
+# back into per-block maps. Transfers landing in blocks where fee_recipient was not
+# the fee recipient are not coinbase transfers and are dropped.
+def get_internal_transfers_to_fee_recipient_in_range(
+    fee_recipient,
+    from_block,
+    to_block,
+    block_keys,
+    all_internal_transfers,
+    range_transfers=None,
+    page_key=None,
+):
+    if range_transfers is None:
+        range_transfers = []
+    headers = {"accept": "application/json", "content-type": "application/json"}
+    params = {
+        "category": ["internal"],
+        "toAddress": fee_recipient,
+        "fromBlock": hex(from_block),
+        "toBlock": hex(to_block),
+    }
+    if page_key is not None:
+        params["pageKey"] = page_key
+    payload = {
+        "id": 1,
+        "jsonrpc": "2.0",
+        "method": "alchemy_getAssetTransfers",
+        "params": [params],
+    }
+
+    response = requests.post(secret_keys.ALCHEMY, json=payload, headers=headers)
+    scheduler.check_response(response)
+    result = response.json()["result"]
+    range_transfers += result["transfers"]
+
+    if result.get("pageKey"):
+        return [
+            (
+                (fee_recipient, from_block, result["pageKey"]),
+                "alchemy",
+                scheduler.compute_units("alchemy_getAssetTransfers"),
+                partial(
+                    get_internal_transfers_to_fee_recipient_in_range,
+                    fee_recipient,
+                    from_block,
+                    to_block,
+                    block_keys,
+                    all_internal_transfers,
+                    range_transfers,
+                    result["pageKey"],
+                ),
+            )
+        ]
+
+    block_transfers = {block_key: [] for block_key in block_keys.values()}
+    for tr in range_transfers:
+        block_key = block_keys.get(int(tr["blockNum"], 16))
+        if block_key is not None:
+            block_transfers[block_key].append(tr)
+
+    cache = rpc_cache.get_cache()
+    for block_key, transfers in block_transfers.items():
+        if cache is not None:
+            cache.put(TRANSFERS_CACHE_METHOD, block_key, transfers)
+        all_internal_transfers[block_key] = transfer_map_from_transfers(transfers)
+    print(f"{fee_recipient} {from_block}-{to_block}")
+
+
+def get_internal_transfers_to_fee_recipients_in_ranges(blocks, all_internal_transfers):
+    ranges = group_blocks_into_transfer_ranges(blocks)
+    print(f"Fetching transfers for {len(blocks)} blocks in {len(ranges)} ranges")
+
+    cost = scheduler.compute_units("alchemy_getAssetTransfers")
+    jobs = [
+        (
+            (fee_recipient, from_block),
+            "alchemy",
+            cost,
+            partial(
+                get_internal_transfers_to_fee_recipient_in_range,
+                fee_recipient,
+                from_block,
+                to_block,
+                block_keys,
+                all_internal_transfers,
+            ),
+        )
+        for fee_recipient, from_block, to_block, block_keys in ranges
+    ]
+    scheduler.get_scheduler().run(jobs, "internal transfer range requests")
 
     return all_internal_transfers
 
@@ -278,22 +735,38 @@ def simplify_receipts(receipts):
     return simplified
 
 
+# Session for the receipts stage, with a connection pool as large as the
+# scheduler's worker pool so that workers don't queue for the default 10
+# connections. Dropped connections are retried right away a few times, slower
+# retries of throttled or failed calls are left to the scheduler.
+def make_receipts_session():
+    session = requests.Session()
+    retries = Retry(
+        total=RECEIPTS_CONNECTION_RETRIES,
+        status=0,
+        allowed_methods=None,
+        backoff_factor=0,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1, pool_maxsize=scheduler.MAX_WORKERS, max_retries=retries
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
 def get_block_receipts(session, block_num, all_receipts):
-    payload = {
-        "id": 1,
-        "jsonrpc": "2.0",
-        "method": "alchemy_getTransactionReceipts",
-        "params": [{"blockNumber": hex(int(block_num))}],
-    }
-    headers = {"accept": "application/json", "content-type": "application/json"}
-    response = session.post(secret_keys.ALCHEMY, json=payload, headers=headers)
-    response = response.json()["result"]["receipts"]
-    print(block_num)
-    response = simplify_receipts(response)
-    all_receipts[str(block_num)] = response
+    all_receipts[str(block_num)] = return_one_block_receipts(session, block_num)
 
 
 def return_one_block_receipts(session, block_num):
+    cache = rpc_cache.get_cache()
+    if cache is not None:
+        receipts = cache.get("alchemy_getTransactionReceipts", block_num)
+        if receipts is not None:
+            return simplify_receipts(receipts)
+
     payload = {
         "id": 1,
         "jsonrpc": "2.0",
@@ -302,48 +775,110 @@ def return_one_block_receipts(session, block_num):
     }
     headers = {"accept": "application/json", "content-type": "application/json"}
     response = session.post(secret_keys.ALCHEMY, json=payload, headers=headers)
+    scheduler.check_response(response)
     response = response.json()["result"]["receipts"]
     print(block_num)
+    if cache is not None:
+        cache.put_receipts("alchemy_getTransactionReceipts", block_num, response)
     response = simplify_receipts(response)
     return response
 
 
-def get_blocks_receipts_by_list(blocks_nums):
+def build_block_receipts_batch(block_nums):
+    return [
+        {
+            "jsonrpc": "2.0",
+            "id": int(block),
+            "method": "eth_getBlockReceipts",
+            "params": [hex(int(block))],
+        }
+        for block in block_nums
+    ]
+
+
+# Standard backend: eth_getBlockReceipts for many blocks per POST through the
+# same batching as block fetching. Only simplify_receipts' fields are kept.
+# Returns {block_num: receipts} and the block numbers that failed.
+def get_blocks_receipts_batched(blocks_nums):
+    start = time.time()
+    print("Fetching receipts for blocks in batches")
+    all_receipts, failed_blocks = get_batched(
+        build_block_receipts_batch(blocks_nums),
+        simplify_receipts,
+        batch_size=RECEIPTS_BATCH_SIZE,
+    )
+    print(
+        f"Finished fetching receipts of {len(all_receipts)} blocks in {time.time() - start} seconds, {len(failed_blocks)} failed"
+    )
+    return all_receipts, failed_blocks
+
+
+def get_blocks_receipts_by_list(blocks_nums, backend=RECEIPTS_BACKEND):
+    if backend == "standard":
+        all_receipts, _ = get_blocks_receipts_batched(list(blocks_nums))
+        return all_receipts
+
     all_receipts = defaultdict(lambda: defaultdict)
-    with requests.Session() as session:
-        # Create a ThreadPoolExecutor
-        start = time.time()
+    cost = scheduler.compute_units("alchemy_getTransactionReceipts")
+    with make_receipts_session() as session:
         print("Fetching receipts for blocks")
-        with ThreadPoolExecutor(max_workers=64) as executor:
-            # Use the executor to submit the tasks
-            futures = [
-                executor.submit(get_block_receipts, session, block_number, all_receipts)
-                for block_number in blocks_nums
-            ]
-            for future in as_completed(futures):
-                pass
-        print("Finished fetching receipts in", time.time() - start, " seconds")
+        jobs = [
+            (
+                block_number,
+                "alchemy",
+                cost,
+                partial(get_block_receipts, session, block_number, all_receipts),
+            )
+            for block_number in blocks_nums
+        ]
+        scheduler.get_scheduler().run(jobs, "receipt requests")
 
     return all_receipts
 
 
 def get_blocks_receipts(start_block, end_block):
-    all_receipts = defaultdict(lambda: defaultdict)
-    with requests.Session() as session:
-        # Create a ThreadPoolExecutor
-        start = time.time()
-        print("Fetching receipts for blocks")
-        with ThreadPoolExecutor(max_workers=64) as executor:
-            # Use the executor to submit the tasks
-            futures = [
-                executor.submit(get_block_receipts, session, block_number, all_receipts)
-                for block_number in range(start_block, end_block + 1)
+    return get_blocks_receipts_by_list(range(start_block, end_block + 1))
+
+
+def merge_block_receipts(session, block_num, block):
+    add_gas_used_to_block(block, return_one_block_receipts(session, block_num))
+
+
+# Fetches the receipts of every block in blocks and merges their gasUsed into
+# the block's txs as each one arrives, instead of holding all receipts until
+# the end. A block whose receipts could not be fetched would be stored with a
+# made up gasUsed, so only the complete blocks are returned. The failed ones are
+# reported in fetch_stats["failed_blocks"], which the later stages skip and the
+# next run fetches again.
+def add_receipts_gas_used_to_blocks(blocks, backend=RECEIPTS_BACKEND):
+    if backend == "standard":
+        # receipts are merged once their batches are in, only the simplified
+        # receipts are held until then
+        all_receipts, failed = get_blocks_receipts_batched(list(blocks))
+        for block_num, block in blocks.items():
+            if block_num in all_receipts:
+                add_gas_used_to_block(block, all_receipts[block_num])
+    else:
+        cost = scheduler.compute_units("alchemy_getTransactionReceipts")
+        with make_receipts_session() as session:
+            print("Fetching receipts for blocks")
+            jobs = [
+                (
+                    block_num,
+                    "alchemy",
+                    cost,
+                    partial(merge_block_receipts, session, block_num, block),
+                )
+                for block_num, block in blocks.items()
             ]
-            for future in as_completed(futures):
-                pass
-        print("Finished fetching receipts in", time.time() - start, " seconds")
+            failed = scheduler.get_scheduler().run(jobs, "receipt requests")
 
-    return all_receipts
+    failed = set(report_failed_blocks(failed, "receipts"))
+    return {
+        block_num: block
+        for block_num, block in blocks.items()
+        if int(block_num) not in failed
+    }
 
 
 def get_new_start_and_end_block_nums():
@@ -363,4 +898,60 @@ def get_new_start_and_end_block_nums():
     return current_block_number - int(blocks_in_14_days), current_block_number
 
 
+def fetch_finalized_block_num(result):
+    payload = {
+        "id": 1,
+        "jsonrpc": "2.0",
+        "method": "eth_getBlockByNumber",
+        "params": ["finalized", False],
+    }
+    headers = {"accept": "application/json", "content-type": "application/json"}
+    response = requests.post(
+        secret_keys.ALCHEMY, json=payload, headers=headers, timeout=REQUEST_TIMEOUT
+    )
+    scheduler.check_response(response)
+    result["finalized"] = int(response.json()["result"]["number"], 16)
+
+
+# Number of the latest block the beacon chain has finalized. Blocks up to it
+# can no longer be reorged, the ones after it may still be replaced.
+# Returns None when the request still failed after the scheduler's retries.
+def get_finalized_block_num():
+    result = {}
+    job = (
+        "finalized",
+        "alchemy",
+        scheduler.compute_units("eth_getBlockByNumber"),
+        partial(fetch_finalized_block_num, result),
+    )
+    scheduler.get_scheduler().run([job], "finalized block requests")
+    return result.get("finalized")
+
+
+# Fetches the current hash of each of block_nums, bypassing the rpc cache, and
+# compares it with the hash stored in blocks. Returns (reorged, unverified):
+# the block nums whose hash changed and the ones that could not be fetched.
+# Recording the new hashes drops whatever the rpc cache held for reorged blocks.
+def find_reorged_blocks(blocks, block_nums):
+    start = time.time()
+    print(f"Verifying the hashes of {len(block_nums)} unfinalized blocks")
+    hashes, unverified = get_batched(
+        build_block_header_batch(block_nums),
+        lambda header: header["hash"],
+        use_cache=False,
+    )
+
+    reorged = [
+        block_num
+        for block_num in block_nums
+        if str(block_num) in hashes
+        and hashes[str(block_num)] != blocks[str(block_num)].get("hash")
+    ]
+    print(
+        f"Verified {len(hashes)} blocks in {time.time() - start} seconds,",
+        f"{len(reorged)} reorged: {reorged}",
+    )
+    return reorged, [int(block_num) for block_num in unverified]
+
+
 # if __name__ == "__main__":
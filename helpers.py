@@ -1,6 +1,7 @@
 import os
 from decimal import Decimal
 import json
+import heapq
 import ijson
 import labels.non_mev_contracts as non_mev_contracts
 from collections import defaultdict
@@ -11,21 +12,22 @@ import re
 import atomic_mev, main_mev
 import labels.builder_addr_map as builder_addr_map
 import attributes
+import serialization
+import builder_resolver
 
 # FILE METHODS
 
 
+# the format is picked per path and detected on load, see serialization.py
 def load_dict_from_json(filename):
-    with open(filename) as file:
-        dict = json.load(file)
-        if dict == None:
-            dict = {}
-        return dict
+    dict = serialization.load(filename)
+    if dict == None:
+        dict = {}
+    return dict
 
 
 def dump_dict_to_json(dict, filename):
-    with open(filename, "w+") as fp:
-        json.dump(dict, fp)
+    serialization.dump(dict, filename)
 
 
 def decimal_serializer(obj):
@@ -42,7 +44,7 @@ def merge_large_json_files(file_list, output_file):
         write_comma = False
 
         for file in file_list:
-            with open(file, "rb") as infile:
+            with serialization.open_stream(file) as infile:
                 # process file
                 objects = ijson.kvitems(infile, "")
                 for key, value in objects:
@@ -59,6 +61,71 @@ def merge_large_json_files(file_list, output_file):
         outfile.write("}")  # end of json
 
 
+# tags each (block_num, value) of a source with the source's priority, for heapq.merge
+def tag_block_items(items, priority):
+    for block_num, value in items:
+        yield int(block_num), -priority, value
+
+
+def merge_block_files(sources, output_file, start, end, dropped=()):
+    """
+    Streams a k-way merge of block-keyed sources into output_file, keeping the
+    blocks in [start, end] that are not in dropped. Sources are filenames or
+    lists of (block_num, value), each in block order. A block found in several
+    sources takes its value from the last one. Only one block per source is held
+    in memory at a time, whatever the length of the window. Returns the block
+    nums in [start, end] that no source had, as combine_blocks does.
+    """
+    streams = [
+        tag_block_items(
+            serialization.stream_items(source) if isinstance(source, str) else source,
+            priority,
+        )
+        for priority, source in enumerate(sources)
+    ]
+    dropped = {int(block_num) for block_num in dropped}
+    missing = []
+    next_block_num = start
+
+    # flag to keep track if we need to write a comma
+    write_comma = False
+
+    tmp = output_file + ".tmp"
+    with serialization.open_write_stream(tmp) as outfile:
+        outfile.write(b"{")
+        for block_num, _, value in heapq.merge(*streams, key=lambda item: item[:2]):
+            # the first of a block's entries is from the last source that has it,
+            # the others come after it and are skipped
+            if block_num < next_block_num or block_num > end or block_num in dropped:
+                continue
+            missing += [str(i) for i in range(next_block_num, block_num)]
+            next_block_num = block_num + 1
+            if write_comma:
+                outfile.write(b",")
+            outfile.write(
+                b'"%d":' % block_num
+                + serialization.encode(value, "orjson", default=decimal_serializer)
+            )
+            write_comma = True
+        outfile.write(b"}")
+    missing += [str(i) for i in range(next_block_num, end + 1)]
+    os.replace(tmp, output_file)
+    return missing
+
+
+# Yields the dict in filename as dicts of at most chunk_size pairs, so a large file
+# is not held in memory at once
+def load_dict_in_chunks(filename, chunk_size):
+    chunk = {}
+    for key, value in serialization.stream_items(filename):
+        chunk[key] = value
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = {}
+    if len(chunk) > 0:
+        yield chunk
+
+
 def prepare_file_list(dir, keyword="", sort=True):
     # dir = block_data, no /
     files = os.listdir(dir)
@@ -597,10 +664,11 @@ def find_notable_searcher_builder_relationships(map):
 
 
 def is_builder_fee_recipient(builder, fee_recipient):
-    for b, addr in builder_addr_map.BUILDER_ADDR_MAP.items():
-        if b in builder:
-            return addr == fee_recipient
-    return False
+    # the address of the first BUILDER_ADDR_MAP key in builder, cached per builder
+    addr = builder_resolver.get_resolver().builder_addresses(builder)
+    if addr is None:
+        return False
+    return addr == fee_recipient
 
 
 def calculate_builder_profitability(blocks, receipts, internal_transfers):
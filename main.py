@@ -1,21 +1,55 @@
+import os
 import time
 import subprocess
 import fetch_blocks
 import helpers
+import block_store
+import tx_table
+import mev_table
+import sqlite_store
 import main_mev
 import chartprep
 import secret_keys
 
 BLOCK_DIR = "blockchain_data/block_data/"
 TR_DIR = "blockchain_data/transfer_data/"
+ZEROMEV_DIR = "blockchain_data/zeromev_data/"
 
+# Single-file windows from before the data was partitioned, imported into the
+# stores below on the first update
 BLOCK_FILE = "blockchain_data/block_data/fourteen_day_blocks.json"
 TR_FILE = "blockchain_data/transfer_data/fourteen_day_transfers.json"
-BLOCK_FILE_SANS_GASUSED = (
-    "blockchain_data/block_data/fourteen_day_blocks_sans_gasUsed.json"
-)
 ZEROMEV_FILE = "blockchain_data/zeromev_data/fourteen_day_zeromev.json"
 
+# Where the window is kept. With "files", blocks are kept in an append-only log
+# indexed by block num, which tells the blocks to fetch without parsing the stored
+# ones, and transfers and zeromev rows in one file per block_store.PARTITION_SIZE
+# blocks. With "sqlite", all three are tables of sqlite_store.DB_FILE.
+STORE_BACKEND = "files"
+
+if STORE_BACKEND == "sqlite":
+    BLOCK_STORE = sqlite_store.SQLiteStore(sqlite_store.DB_FILE, "blocks")
+    TR_STORE = sqlite_store.SQLiteStore(sqlite_store.DB_FILE, "transfers")
+    ZEROMEV_STORE = sqlite_store.SQLiteStore(sqlite_store.DB_FILE, "zeromev")
+else:
+    BLOCK_STORE = block_store.BlockLog(BLOCK_DIR + "block_log/")
+    TR_STORE = block_store.PartitionedStore(TR_DIR + "partitions/")
+    ZEROMEV_STORE = block_store.PartitionedStore(ZEROMEV_DIR + "partitions/")
+
+# The finalized block num at the last update. Blocks stored after it were not final
+# yet, so their hashes are checked again on the next update.
+FINALIZED_FILE = "blockchain_data/block_data/finalized_block_num.json"
+
+# Journal of the update in progress: its window, the stages done and the reorged
+# blocks. An update that crashes or stops resumes from it on the next run.
+JOURNAL_FILE = "blockchain_data/update_journal.json"
+# blocks fetched and written to the store at a time, see fetch_in_checkpoints
+CHECKPOINT_BLOCKS = 1000
+
+# "full" fetches every tx and receipt of every block, "zeromev_first" fetches the
+# zeromev rows first and then only the txs and receipts they point at
+PIPELINE_MODE = "full"
+
 SMALL_BLOCK_FILE = "blockchain_data/block_data/small_block.json"
 SMALL_TR_FILE = "blockchain_data/transfer_data/small_transfer.json"
 SMALL_BLOCK_FILE_SANS_GASUSED = (
@@ -24,6 +58,16 @@ SMALL_BLOCK_FILE_SANS_GASUSED = (
 SMALL_ZEROMEV_FILE = "blockchain_data/zeromev_data/small_zeromev.json"
 
 
+def import_legacy_file(store, legacy_file):
+    if store.is_empty() and os.path.exists(legacy_file):
+        store.import_file(legacy_file)
+
+
+def load_window(store, legacy_file, new_start, new_end):
+    import_legacy_file(store, legacy_file)
+    return store.load(new_start, new_end)
+
+
 def combine_blocks(new_start, new_end, old_blocks, new_blocks):
     # take 14 days of blocks and append 1 days of blocks to it and remove the first 1
     # num_blocks_flush = 7200  # 24*60*60/12
@@ -54,25 +98,138 @@ def find_to_fetch(old_data, new_start, new_end):
     return to_fetch
 
 
+# Re-verifies the hashes of the stored blocks that were not finalized when they were
+# fetched and drops the reorged ones from the store so that they are fetched again.
+# Returns (reorged block nums, finalized block num to save once the update is done).
+def verify_unfinalized_tail(store, new_start, new_end):
+    finalized = fetch_blocks.get_finalized_block_num()
+    if os.path.exists(FINALIZED_FILE):
+        verified_up_to = helpers.load_dict_from_json(FINALIZED_FILE)["finalized"]
+    else:
+        # nothing tells which blocks were final when stored, so check them all once
+        verified_up_to = new_start - 1
+    if finalized is None:
+        # the tail is still checked, the next update moves the finalized block on
+        print("Could not fetch the finalized block num")
+        finalized = verified_up_to
+    tail_blocks = store.load(max(verified_up_to, new_start - 1) + 1, new_end)
+    tail = sorted(int(block_num) for block_num in tail_blocks)
+
+    reorged, unverified = fetch_blocks.find_reorged_blocks(tail_blocks, tail)
+    store.write({}, reorged)
+    if len(unverified) > 0:
+        # the ones that could not be checked are checked again on the next update
+        finalized = min(finalized, min(unverified) - 1)
+    return reorged, max(finalized, verified_up_to)
+
+
+def drop_blocks(data, block_nums):
+    for block_num in block_nums:
+        data.pop(str(block_num), None)
+
+
 def fetch_new_blocks(old_blocks, new_start, new_end):
     # find blocks that go from new start to new end, but using old_blocks if it already has it
     # old_end = max(old_blocks, key=int)
+    # old_blocks is anything that answers `str(block_num) in old_blocks`, e.g. BLOCK_STORE
     to_fetch = find_to_fetch(old_blocks, new_start, new_end)
     blocks = fetch_blocks.get_blocks_by_list(to_fetch)
     return blocks, to_fetch
 
 
-def update_tr_file(new_start, new_end, blocks):
-    print("Loading old tr file")
-    old_trs = helpers.load_dict_from_json(TR_FILE)
-    to_fetch = find_to_fetch(old_trs, new_start, new_end)
+# Fetches to_fetch CHECKPOINT_BLOCKS at a time with fetch(block_nums), which returns
+# {block_num: data}, and checkpoints each chunk to store as it arrives. The store is
+# the record of what was fetched, so a crash loses at most the chunk in flight.
+# The checkpoints are merged into the store once all chunks are in.
+# The blocks fetch reported in fetch_blocks.fetch_stats as failed are not stored,
+# so the next run fetches them again, and are kept in the journal under stage
+# along with skipped, the blocks of the stage that could not even be asked for.
+def fetch_in_checkpoints(store, to_fetch, fetch, journal, stage, skipped=()):
+    fetched = {}
+    failed = set(skipped)
+    for i in range(0, len(to_fetch), CHECKPOINT_BLOCKS):
+        fetch_blocks.fetch_stats["failed_blocks"] = []
+        chunk = fetch(to_fetch[i : i + CHECKPOINT_BLOCKS])
+        failed.update(fetch_blocks.fetch_stats["failed_blocks"])
+        store.checkpoint(chunk)
+        fetched.update(chunk)
+        print(f"Checkpoint: {len(fetched)} of {len(to_fetch)} blocks saved")
+    store.flush()
+    journal.setdefault("failed", {})[stage] = sorted(failed)
+    save_journal(journal)
+    return fetched
+
+
+# Returns the journal of the unfinished update, or starts one for the latest window
+def open_journal():
+    if os.path.exists(JOURNAL_FILE):
+        journal = helpers.load_dict_from_json(JOURNAL_FILE)
+        print(
+            "Resuming the update of blocks",
+            journal["start"],
+            journal["end"],
+            "after stages",
+            journal["stages"],
+        )
+        return journal
+
+    new_start, new_end = fetch_blocks.get_new_start_and_end_block_nums()
+    journal = {
+        "start": new_start,
+        "end": new_end,
+        "stages": [],  # completed stages
+        "reorged": [],  # block nums dropped from the window by this update
+        "finalized": None,  # set once the unfinalized tail is verified
+        "failed": {},  # stage -> block nums that could not be fetched
+    }
+    save_journal(journal)
+    return journal
+
 
-    to_fetch_blocks = {}
-    for block_num in to_fetch:
-        to_fetch_blocks[str(block_num)] = blocks[str(block_num)]
+def save_journal(journal):
+    os.makedirs(os.path.dirname(JOURNAL_FILE), exist_ok=True)
+    helpers.dump_dict_to_json(journal, JOURNAL_FILE)
 
-    new_trs = fetch_blocks.get_internal_transfers_to_fee_recipients_in_blocks(
-        to_fetch_blocks
+
+def complete_stage(journal, stage):
+    if stage not in journal["stages"]:
+        journal["stages"].append(stage)
+        save_journal(journal)
+
+
+# reorged block nums still to be dropped from the data of stage
+def pending_reorged(journal, stage):
+    return [] if stage in journal["stages"] else journal["reorged"]
+
+
+def close_journal():
+    if os.path.exists(JOURNAL_FILE):
+        os.remove(JOURNAL_FILE)
+
+
+def update_tr_file(new_start, new_end, blocks, journal, reorged=()):
+    print("Loading old trs")
+    old_trs = load_window(TR_STORE, TR_FILE, new_start, new_end)
+    # dropped from the store before the refetched ones are written to it
+    drop_blocks(old_trs, reorged)
+    TR_STORE.write({}, reorged)
+    to_fetch = find_to_fetch(old_trs, new_start, new_end)
+    # transfers are asked for by the block's fee recipient, so the blocks that
+    # could not be fetched wait for the run that fetches them
+    without_block = [
+        block_num for block_num in to_fetch if str(block_num) not in blocks
+    ]
+    if len(without_block) > 0:
+        print(f"{len(without_block)} blocks are missing, no transfers fetched for them")
+        to_fetch = [block_num for block_num in to_fetch if str(block_num) in blocks]
+
+    def fetch_transfers(block_nums):
+        return fetch_blocks.get_internal_transfers_to_fee_recipients_in_blocks(
+            {str(block_num): blocks[str(block_num)] for block_num in block_nums}
+        )
+
+    new_trs = fetch_in_checkpoints(
+        TR_STORE, to_fetch, fetch_transfers, journal, "transfers", without_block
     )
 
     missing, updated_trs = combine_blocks(new_start, new_end, old_trs, new_trs)
@@ -82,15 +239,21 @@ def update_tr_file(new_start, new_end, blocks):
         if len(missing) > 1000:
             return
 
+    TR_STORE.expire(new_start)
     return updated_trs
 
 
-def update_zeromev_file(new_start, new_end):
-    print("Loading old zeromev file")
-    old_zeromev = helpers.load_dict_from_json(ZEROMEV_FILE)
+def update_zeromev_file(new_start, new_end, journal, reorged=()):
+    print("Loading old zeromev blocks")
+    old_zeromev = load_window(ZEROMEV_STORE, ZEROMEV_FILE, new_start, new_end)
+    # dropped from the store before the refetched ones are written to it
+    drop_blocks(old_zeromev, reorged)
+    ZEROMEV_STORE.write({}, reorged)
     to_fetch = find_to_fetch(old_zeromev, new_start, new_end)
 
-    new_zeromev = main_mev.fetch_zeromev_blocks(to_fetch)
+    new_zeromev = fetch_in_checkpoints(
+        ZEROMEV_STORE, to_fetch, main_mev.fetch_zeromev_blocks, journal, "zeromev"
+    )
     missing, updated_zeromev = combine_blocks(
         new_start, new_end, old_zeromev, new_zeromev
     )
@@ -100,38 +263,154 @@ def update_zeromev_file(new_start, new_end):
         if len(missing) > 1000:
             return
 
-    return updated_zeromev
+    ZEROMEV_STORE.expire(new_start)
+    # rows are kept in a MevTable while the window is analyzed
+    return mev_table.MevTable(updated_zeromev)
+
+
+def save_finalized(finalized):
+    # the sqlite backend keeps nothing else in the block dir
+    os.makedirs(os.path.dirname(FINALIZED_FILE), exist_ok=True)
+    helpers.dump_dict_to_json({"finalized": finalized}, FINALIZED_FILE)
 
 
-def update_block_files(new_start, new_end):
+# Re-verifies the unfinalized tail once per update and keeps the reorged block nums
+# in the journal, so that the transfer and zeromev stages drop them even when they
+# run after a crash
+def verify_blocks_once(journal, new_start, new_end):
+    if journal["finalized"] is None:
+        import_legacy_file(BLOCK_STORE, BLOCK_FILE)
+        reorged, finalized = verify_unfinalized_tail(BLOCK_STORE, new_start, new_end)
+        journal["reorged"] = sorted(set(journal["reorged"]) | set(reorged))
+        journal["finalized"] = finalized
+        save_journal(journal)
+
+
+def update_block_files(new_start, new_end, journal):
     # new_start = 18035586
     # new_end = new_start + 1000
     print("New start and end block num", new_start, new_end)
-    old_blocks = helpers.load_dict_from_json(BLOCK_FILE)
-    new_blocks, to_fetch = fetch_new_blocks(old_blocks, new_start, new_end)
+    if PIPELINE_MODE == "zeromev_first":
+        return update_block_files_zeromev_first(new_start, new_end, journal)
+
+    verify_blocks_once(journal, new_start, new_end)
+    if "blocks" not in journal["stages"]:
+        to_fetch = find_to_fetch(BLOCK_STORE, new_start, new_end)
+        # only the new blocks need receipts, gasUsed is merged in as they arrive
+        new_blocks = fetch_in_checkpoints(
+            BLOCK_STORE,
+            to_fetch,
+            lambda block_nums: fetch_blocks.add_receipts_gas_used_to_blocks(
+                fetch_blocks.get_blocks_by_list(block_nums)
+            ),
+            journal,
+            "blocks",
+        )
+
+        missing = [
+            str(block_num) for block_num in to_fetch if str(block_num) not in new_blocks
+        ]
+        if len(missing) > 0:
+            print("Missing some BLOCKS. Failed to combine fully.")
+            print(missing)
+            if len(missing) > 1000:
+                return
+
+        BLOCK_STORE.expire(new_start)
+        # while blocks are missing the stage runs again on resume, which only
+        # fetches the missing ones
+        if len(missing) == 0:
+            complete_stage(journal, "blocks")
+
+    # txs are kept in TxTables while the window is analyzed
+    updated_blocks = BLOCK_STORE.load(new_start, new_end, tx_table.compact_block)
+
+    updated_trs = update_tr_file(
+        new_start,
+        new_end,
+        updated_blocks,
+        journal,
+        pending_reorged(journal, "transfers"),
+    )
+    if updated_trs is None:
+        return
+    complete_stage(journal, "transfers")
+    updated_zeromev_blocks = update_zeromev_file(
+        new_start, new_end, journal, pending_reorged(journal, "zeromev")
+    )
+    if updated_zeromev_blocks is None:
+        return
+    complete_stage(journal, "zeromev")
 
-    missing, updated_blocks = combine_blocks(new_start, new_end, old_blocks, new_blocks)
+    save_finalized(journal["finalized"])
 
-    if len(missing) > 0:
-        print("Missing some BLOCKS. Failed to combine fully.")
-        print(missing)
-        if len(missing) > 1000:
-            return
-
-    helpers.dump_dict_to_json(updated_blocks, BLOCK_FILE_SANS_GASUSED)
+    return updated_blocks, updated_trs, updated_zeromev_blocks
 
-    updated_receipts = fetch_blocks.get_blocks_receipts_by_list(to_fetch)
-    updated_blocks = fetch_blocks.add_gas_used_to_blocks(
-        updated_blocks, updated_receipts
-    )
 
-    helpers.dump_dict_to_json(updated_blocks, BLOCK_FILE)
+# Same as update_block_files, but fetches zeromev first so that only headers and
+# the txs and receipts at the flagged indices (and the tx after each) are fetched.
+# Blocks already carry gasUsed, so there is no receipts stage nor sans-gasUsed file.
+def update_block_files_zeromev_first(new_start, new_end, journal):
+    verify_blocks_once(journal, new_start, new_end)
 
-    updated_trs = update_tr_file(new_start, new_end, updated_blocks)
-    helpers.dump_dict_to_json(updated_trs, TR_FILE)
+    updated_zeromev_blocks = update_zeromev_file(
+        new_start, new_end, journal, pending_reorged(journal, "zeromev")
+    )
+    if updated_zeromev_blocks is None:
+        return
+    complete_stage(journal, "zeromev")
+
+    if "blocks" not in journal["stages"]:
+        # a block is only fetched once zeromev has answered for it, otherwise it
+        # would be stored without the txs that matter
+        not_stored = find_to_fetch(BLOCK_STORE, new_start, new_end)
+        to_fetch = [
+            block_num
+            for block_num in not_stored
+            if str(block_num) in updated_zeromev_blocks
+        ]
+        new_blocks = fetch_in_checkpoints(
+            BLOCK_STORE,
+            to_fetch,
+            lambda block_nums: fetch_blocks.get_mev_txs_of_blocks(
+                block_nums, updated_zeromev_blocks
+            ),
+            journal,
+            "blocks",
+        )
+
+        missing = [
+            str(block_num)
+            for block_num in not_stored
+            if str(block_num) not in new_blocks
+        ]
+        if len(missing) > 0:
+            print("Missing some BLOCKS. Failed to combine fully.")
+            print(missing)
+            if len(missing) > 1000:
+                return
+
+        BLOCK_STORE.expire(new_start)
+        # while blocks are missing the stage runs again on resume, which only
+        # fetches the missing ones
+        if len(missing) == 0:
+            complete_stage(journal, "blocks")
+
+    # txs are kept in TxTables while the window is analyzed
+    updated_blocks = BLOCK_STORE.load(new_start, new_end, tx_table.compact_block)
+
+    updated_trs = update_tr_file(
+        new_start,
+        new_end,
+        updated_blocks,
+        journal,
+        pending_reorged(journal, "transfers"),
+    )
+    if updated_trs is None:
+        return
+    complete_stage(journal, "transfers")
 
-    updated_zeromev_blocks = update_zeromev_file(new_start, new_end)
-    helpers.dump_dict_to_json(updated_zeromev_blocks, ZEROMEV_FILE)
+    save_finalized(journal["finalized"])
 
     return updated_blocks, updated_trs, updated_zeromev_blocks
 
@@ -150,30 +429,52 @@ def check_blocks_all_present(blocks, new_start, new_end):
 
 
 def update_worker():
-    new_start, new_end = fetch_blocks.get_new_start_and_end_block_nums()
+    journal = open_journal()
+    new_start, new_end = journal["start"], journal["end"]
 
-    fetched_blocks, fetched_trs, fetched_zeromev_blocks = update_block_files(
-        new_start, new_end
-    )
-
-    full_blocks, missing_blocks = check_blocks_all_present(
-        fetched_blocks, new_start, new_end
-    )
-    print("All blocks are present:", full_blocks)
-
-    full_trs, missing_trs = check_blocks_all_present(fetched_trs, new_start, new_end)
-    print("All trs are present:", full_trs)
-
-    full_zeromev, missing_zeromev = check_blocks_all_present(
-        fetched_zeromev_blocks, new_start, new_end
-    )
-    print("All zeromev blocks are present:", full_zeromev)
-
-    # create maps and aggs used in chartprep
-    main_mev.create_mev_analysis(fetched_blocks, fetched_trs, fetched_zeromev_blocks)
+    if "analysis" not in journal["stages"]:
+        updated = update_block_files(new_start, new_end, journal)
+        if updated is None:
+            print(f"Update stopped, the next run resumes it from {JOURNAL_FILE}")
+            return
+        fetched_blocks, fetched_trs, fetched_zeromev_blocks = updated
+
+        full_blocks, missing_blocks = check_blocks_all_present(
+            fetched_blocks, new_start, new_end
+        )
+        print("All blocks are present:", full_blocks)
+
+        full_trs, missing_trs = check_blocks_all_present(
+            fetched_trs, new_start, new_end
+        )
+        print("All trs are present:", full_trs)
+
+        full_zeromev, missing_zeromev = check_blocks_all_present(
+            fetched_zeromev_blocks, new_start, new_end
+        )
+        print("All zeromev blocks are present:", full_zeromev)
+
+        # a block whose transfers or zeromev rows could not be fetched would be
+        # analyzed as a block without mev, so it is left out until the next run
+        # fetches what it misses
+        drop_blocks(fetched_blocks, set(missing_trs) | set(missing_zeromev))
+        failed = {
+            stage: block_nums
+            for stage, block_nums in journal.get("failed", {}).items()
+            if len(block_nums) > 0
+        }
+        if len(failed) > 0:
+            print("Blocks that could not be fetched:", failed)
+
+        # create maps and aggs used in chartprep
+        main_mev.create_mev_analysis(
+            fetched_blocks, fetched_trs, fetched_zeromev_blocks
+        )
+        complete_stage(journal, "analysis")
 
     # update the charts
     chartprep.create_html_page()
+    close_journal()
 
 
 if __name__ == "__main__":
@@ -1,67 +1,203 @@
 import time
 import requests
 import traceback
-import re
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import multiprocessing
+import os
 from itertools import islice
-from collections import defaultdict
+from functools import partial
 import atomic_mev, nonatomic_mev
-import labels.builder_addr_map as builder_addr_map
+import scheduler
+import rpc_cache
+import fetch_blocks
+import address_registry
+import mev_table
+import analysis_metrics
+import columnar_analysis
+import builder_resolver
+import analysis_partials
+
+
+ZEROMEV_URL = "https://data.zeromev.org/v1/mevBlock"
+# "range" asks zeromev for up to ZEROMEV_MAX_COUNT blocks per call, "block" for one
+ZEROMEV_FETCH_MODE = "range"
+ZEROMEV_MAX_COUNT = 100  # largest count the mevBlock API accepts
+ZEROMEV_TARGET_SECONDS = 2  # range size shrinks when a call takes longer than this
+ZEROMEV_TARGET_BYTES = 2_000_000  # or when its response is larger than this
+ZEROMEV_CACHE_METHOD = "zeromev_mevBlock"
+
+# "python" analyzes the blocks with analyze_block, one block and row at a time,
+# "columnar" with the array rules of columnar_analysis.py, in this process only
+ANALYSIS_BACKEND = "python"
+# With the python backend, analyze_blocks splits the blocks in ranges of
+# ANALYSIS_RANGE_SIZE, analyzes each range into metrics of its own in one of
+# ANALYSIS_PROCESSES worker processes, and adds those up in block order. With one
+# process the ranges are analyzed in turn.
+ANALYSIS_PROCESSES = os.cpu_count() or 1
+ANALYSIS_RANGE_SIZE = 2000
+# create_mev_analysis merges the window's full days from saved per-day partial
+# aggregates, see analysis_partials.py, instead of analyzing all its blocks
+ANALYSIS_PARTIALS = True
+# (blocks, transfers, zeromev blocks, registry size) of the running analysis, set
+# before the workers are forked so that they inherit it
+analysis_input = None
 
 
 def fetch_zeromev_block(session, url, block_num, zeromev_blocks):
     payload = {"block_number": block_num, "count": "1"}
+    res = session.get(url, params=payload)
+    scheduler.check_response(res)
+    data = res.json()
+    print(block_num)
+    cache = rpc_cache.get_cache()
+    # no rows may only mean zeromev has not classified the block yet
+    if cache is not None and len(data) > 0:
+        cache.put(ZEROMEV_CACHE_METHOD, block_num, data)
+    zeromev_blocks[str(block_num)] = data
+
+
+class ZeromevRangeSizer:
+    """
+    Picks how many blocks to ask zeromev for per call. The count doubles
+    while calls come back fast and small, and halves when a call is slow,
+    large, or fails.
+    """
+
+    def __init__(self, initial=10, maximum=ZEROMEV_MAX_COUNT):
+        self.count = initial
+        self.maximum = maximum
+        self.lock = threading.Lock()
+
+    def size(self):
+        with self.lock:
+            return self.count
+
+    def record(self, seconds, num_bytes):
+        with self.lock:
+            if seconds > ZEROMEV_TARGET_SECONDS or num_bytes > ZEROMEV_TARGET_BYTES:
+                self.count = max(1, self.count // 2)
+            elif (
+                seconds < ZEROMEV_TARGET_SECONDS / 2
+                and num_bytes < ZEROMEV_TARGET_BYTES / 2
+            ):
+                self.count = min(self.maximum, self.count * 2)
+
+    def shrink(self):
+        with self.lock:
+            self.count = max(1, self.count // 2)
+
+
+# Fetches the first sizer.size() blocks of [start, end] in one call and splits
+# the rows back into per-block lists. The rest of the segment is returned as a
+# follow-up job so that it is fetched with the size adapted to this call.
+def fetch_zeromev_range(session, url, start, end, sizer, zeromev_blocks):
+    count = min(sizer.size(), end - start + 1)
+    payload = {"block_number": start, "count": str(count)}
+    begin = time.time()
     try:
         res = session.get(url, params=payload)
-        if res.status_code == 200:
-            data = res.json()
-            print(block_num)
-            zeromev_blocks[str(block_num)] = data
-    except Exception as e:
-        print("error found in one block", e, block_num)
-        print(traceback.format_exc())
+        scheduler.check_response(res)
+        rows = res.json()
+    except Exception:
+        sizer.shrink()
+        raise
+    sizer.record(time.time() - begin, len(res.content))
+
+    blocks = {str(block_num): [] for block_num in range(start, start + count)}
+    for row in rows:
+        block_rows = blocks.get(str(row["block_number"]))
+        if block_rows is not None:
+            block_rows.append(row)
+    cache = rpc_cache.get_cache()
+    if cache is not None:
+        for block_num, block_rows in blocks.items():
+            if len(block_rows) > 0:
+                cache.put(ZEROMEV_CACHE_METHOD, block_num, block_rows)
+    zeromev_blocks.update(blocks)
+    print(f"{start}-{start + count - 1}")
+
+    if start + count <= end:
+        return [
+            zeromev_range_job(session, url, start + count, end, sizer, zeromev_blocks)
+        ]
+
+
+def zeromev_range_job(session, url, start, end, sizer, zeromev_blocks):
+    return (
+        (start, end),
+        "zeromev",
+        0,
+        partial(fetch_zeromev_range, session, url, start, end, sizer, zeromev_blocks),
+    )
+
+
+# Splits block_nums into contiguous segments of at most max_len blocks
+def split_into_segments(block_nums, max_len=ZEROMEV_MAX_COUNT):
+    segments = []
+    for block_num in sorted(int(b) for b in block_nums):
+        if (
+            len(segments) > 0
+            and segments[-1][1] == block_num - 1
+            and segments[-1][1] - segments[-1][0] + 1 < max_len
+        ):
+            segments[-1][1] = block_num
+        else:
+            segments.append([block_num, block_num])
+    return segments
 
 
-def fetch_zeromev_blocks(block_nums):
-    zeromev_url = "https://data.zeromev.org/v1/mevBlock"
+def fetch_zeromev_blocks(block_nums, mode=ZEROMEV_FETCH_MODE):
     zeromev_blocks = {}
+    cache = rpc_cache.get_cache()
+    if cache is not None:
+        for block_num in block_nums:
+            rows = cache.get(ZEROMEV_CACHE_METHOD, block_num)
+            if rows is not None:
+                zeromev_blocks[str(block_num)] = rows
+        print(f"{len(zeromev_blocks)} zeromev blocks from the rpc cache")
+        block_nums = [b for b in block_nums if str(b) not in zeromev_blocks]
     with requests.Session() as session:
-        # Create a ThreadPoolExecutor
-        start = time.time()
         print("Fetching Zeromev blocks")
-        with ThreadPoolExecutor(max_workers=64) as executor:
-            # Use the executor to submit the tasks
-            futures = [
-                executor.submit(
-                    fetch_zeromev_block, session, zeromev_url, block_num, zeromev_blocks
+        if mode == "range":
+            sizer = ZeromevRangeSizer()
+            jobs = [
+                zeromev_range_job(
+                    session, ZEROMEV_URL, start, end, sizer, zeromev_blocks
+                )
+                for start, end in split_into_segments(block_nums)
+            ]
+        else:
+            jobs = [
+                (
+                    block_num,
+                    "zeromev",
+                    0,
+                    partial(
+                        fetch_zeromev_block,
+                        session,
+                        ZEROMEV_URL,
+                        block_num,
+                        zeromev_blocks,
+                    ),
                 )
                 for block_num in block_nums
             ]
-            for future in as_completed(futures):
-                pass
-        print("Finished fetching Zeromev blocks in", time.time() - start, " seconds")
-    return zeromev_blocks
-
-
-def check_keys_in_string(extra_data):
-    for keyword, label in builder_addr_map.extraData_builder_mapping.items():
-        if keyword in extra_data.lower():
-            return label
-    return extra_data
+        scheduler.get_scheduler().run(jobs, "zeromev requests")
+    # the blocks of the requests that failed get no rows at all, unlike blocks
+    # without mev, so they are not taken for blocks without mev
+    fetch_blocks.report_failed_blocks(
+        [b for b in block_nums if str(b) not in zeromev_blocks], "zeromev rows"
+    )
+    # only the fields the analysis reads are stored, see mev_table.MEV_FIELDS
+    return {
+        block_num: mev_table.normalize_rows(rows)
+        for block_num, rows in zeromev_blocks.items()
+    }
 
 
 def map_extra_data_to_builder(extra_data, feeRecipient):
-    builder = re.sub(r"\W+", "", extra_data)
-    is_known_anon = feeRecipient in builder_addr_map.known_anons.keys()
-    if is_known_anon:
-        builder = builder_addr_map.known_anons[feeRecipient]
-    elif builder == "":
-        builder = feeRecipient
-    # elif "geth" in builder or "nethermind" in builder or "linux" in builder:
-    #     builder = "vanilla_builder"
-    else:
-        builder = check_keys_in_string(builder)
-    return builder
+    # human-readable builder name, cached per extraData, see builder_resolver.py
+    return builder_resolver.get_resolver().builder(extra_data, feeRecipient)
 
 
 def analyze_tx(
@@ -75,22 +211,8 @@ def analyze_tx(
     top_of_block_boundary,
     block_base_fee,
     addrs_counted_in_block,
-    builder_atomic_map_block,
-    builder_atomic_map_tx,
-    builder_atomic_map_profit,
-    builder_atomic_map_vol,
-    builder_atomic_map_coin_bribe,
-    builder_atomic_map_gas_bribe,
-    builder_atomic_map_vol_list,
-    builder_nonatomic_map_block,
-    builder_nonatomic_map_tx,
-    builder_nonatomic_map_vol,
-    builder_nonatomic_map_coin_bribe,
-    builder_nonatomic_map_gas_bribe,
-    builder_nonatomic_map_vol_list,
-    coinbase_bribe,
-    after_bribe,
-    tob_bribe,
+    metrics,
+    registry,
 ):
     mev_type = tx["mev_type"]
     if mev_type == "sandwich":
@@ -108,15 +230,8 @@ def analyze_tx(
             top_of_block_boundary,
             block_base_fee,
             addrs_counted_in_block,
-            builder_nonatomic_map_block,
-            builder_nonatomic_map_tx,
-            builder_nonatomic_map_vol,
-            builder_nonatomic_map_coin_bribe,
-            builder_nonatomic_map_gas_bribe,
-            builder_nonatomic_map_vol_list,
-            coinbase_bribe,
-            after_bribe,
-            tob_bribe,
+            metrics,
+            registry,
         )
     else:
         # if tx has touched multiple protocol, it is more likely to be an atomic MEV tx
@@ -128,13 +243,8 @@ def analyze_tx(
             transfer_map,
             block_base_fee,
             addrs_counted_in_block,
-            builder_atomic_map_block,
-            builder_atomic_map_tx,
-            builder_atomic_map_profit,
-            builder_atomic_map_vol,
-            builder_atomic_map_coin_bribe,
-            builder_atomic_map_gas_bribe,
-            builder_atomic_map_vol_list,
+            metrics,
+            registry,
         )
 
 
@@ -144,22 +254,7 @@ def analyze_block(
     block,
     transfer_map,
     zeromev_block_txs,
-    builder_atomic_map_block,
-    builder_atomic_map_tx,
-    builder_atomic_map_profit,
-    builder_atomic_map_vol,
-    builder_atomic_map_coin_bribe,
-    builder_atomic_map_gas_bribe,
-    builder_atomic_map_vol_list,
-    builder_nonatomic_map_block,
-    builder_nonatomic_map_tx,
-    builder_nonatomic_map_vol,
-    builder_nonatomic_map_coin_bribe,
-    builder_nonatomic_map_gas_bribe,
-    builder_nonatomic_map_vol_list,
-    coinbase_bribe,
-    after_bribe,
-    tob_bribe,
+    metrics,
 ):
     try:
         total_txs = len(block["transactions"])
@@ -180,10 +275,12 @@ def analyze_block(
         if (int(block_number) - 17595510) % 500 == 0:
             print(block_number)
 
-        builder_atomic_map_block[builder]["total"] += 1
-        builder_nonatomic_map_block[builder]["total"] += 1
+        metrics.builder_atomic_map_block.add((builder, "total"), 1)
+        metrics.builder_nonatomic_map_block.add((builder, "total"), 1)
 
         addrs_counted_in_block = set()
+        # searchers are keyed by address id, see address_registry
+        registry = address_registry.get_registry()
 
         if zeromev_block_txs != None or len(zeromev_block_txs) > 0:
             for tx in zeromev_block_txs:
@@ -203,22 +300,8 @@ def analyze_block(
                     top_of_block_boundary,
                     block_base_fee,
                     addrs_counted_in_block,
-                    builder_atomic_map_block,
-                    builder_atomic_map_tx,
-                    builder_atomic_map_profit,
-                    builder_atomic_map_vol,
-                    builder_atomic_map_coin_bribe,
-                    builder_atomic_map_gas_bribe,
-                    builder_atomic_map_vol_list,
-                    builder_nonatomic_map_block,
-                    builder_nonatomic_map_tx,
-                    builder_nonatomic_map_vol,
-                    builder_nonatomic_map_coin_bribe,
-                    builder_nonatomic_map_gas_bribe,
-                    builder_nonatomic_map_vol_list,
-                    coinbase_bribe,
-                    after_bribe,
-                    tob_bribe,
+                    metrics,
+                    registry,
                 )
 
         else:
@@ -233,89 +316,102 @@ def analyze_block(
         print(traceback.format_exc())
 
 
-def default_block_dic():
-    # Create a defaultdict that defaults to 0
-    inner = defaultdict(int)
-    # But initialize 'total' to 0 explicitly
-    inner["total"] = 0
-    return inner
+def can_fork():
+    return "fork" in multiprocessing.get_all_start_methods()
+
+
+def analyze_block_range(block_nums, metrics=None):
+    """
+    Analyzes the blocks of analysis_input with the given block nums into metrics,
+    or into metrics of its own when run in a worker. A worker returns its metrics
+    and the addresses it interned, whose ids are only valid in the worker and are
+    remapped by merge_analysis_metrics.
+    """
+    (
+        fetched_blocks,
+        fetched_internal_transfers,
+        fetched_zeromev_blocks,
+        base,
+    ) = analysis_input
+    in_worker = metrics is None
+    if in_worker:
+        metrics = analysis_metrics.AnalysisMetrics()
+    for block_number in block_nums:
+        analyze_block(
+            block_number,
+            fetched_blocks[block_number],
+            fetched_internal_transfers.get(str(block_number), {}),
+            fetched_zeromev_blocks.get(str(block_number), []),
+            metrics,
+        )
+    if in_worker:
+        registry = address_registry.get_registry()
+        return metrics, registry.addresses[base:]
+
+
+# Adds the metrics of a block range analyzed in a worker into metrics, in block
+# order, with the ids of the addresses the worker interned remapped to the ids
+# they get here
+def merge_analysis_metrics(metrics, partial_metrics, new_addresses):
+    registry = address_registry.get_registry()
+    base = analysis_input[3]
+    remap = {
+        base + i: registry.intern(address) for i, address in enumerate(new_addresses)
+    }
+    metrics.merge(partial_metrics, remap)
 
 
 def analyze_blocks(
-    fetched_blocks,
-    fetched_internal_transfers,
-    fetched_zeromev_blocks,
-    builder_atomic_map_block,
-    builder_atomic_map_tx,
-    builder_atomic_map_profit,
-    builder_atomic_map_vol,
-    builder_atomic_map_coin_bribe,
-    builder_atomic_map_gas_bribe,
-    builder_atomic_map_vol_list,
-    builder_nonatomic_map_block,
-    builder_nonatomic_map_tx,
-    builder_nonatomic_map_vol,
-    builder_nonatomic_map_coin_bribe,
-    builder_nonatomic_map_gas_bribe,
-    builder_nonatomic_map_vol_list,
-    coinbase_bribe,
-    after_bribe,
-    tob_bribe,
+    fetched_blocks, fetched_internal_transfers, fetched_zeromev_blocks, metrics
 ):
-    # Create a ThreadPoolExecutor
-
+    """
+    Adds the analysis of fetched_blocks to metrics, an
+    analysis_metrics.AnalysisMetrics, and returns it.
+    """
     start = time.time()
     print("Zero-ing into blocks")
-    with ThreadPoolExecutor(max_workers=64) as executor:
-        # Use the executor to submit the tasks
-        futures = [
-            executor.submit(
-                analyze_block,
-                block_number,
-                block,
-                fetched_internal_transfers.get(str(block_number), {}),
-                fetched_zeromev_blocks.get(str(block_number), []),
-                builder_atomic_map_block,
-                builder_atomic_map_tx,
-                builder_atomic_map_profit,
-                builder_atomic_map_vol,
-                builder_atomic_map_coin_bribe,
-                builder_atomic_map_gas_bribe,
-                builder_atomic_map_vol_list,
-                builder_nonatomic_map_block,
-                builder_nonatomic_map_tx,
-                builder_nonatomic_map_vol,
-                builder_nonatomic_map_coin_bribe,
-                builder_nonatomic_map_gas_bribe,
-                builder_nonatomic_map_vol_list,
-                coinbase_bribe,
-                after_bribe,
-                tob_bribe,
-            )
-            for block_number, block in fetched_blocks.items()
-        ]
-        for future in as_completed(futures):
-            pass
+    if ANALYSIS_BACKEND == "columnar":
+        columnar_analysis.analyze_blocks(
+            fetched_blocks, fetched_internal_transfers, fetched_zeromev_blocks, metrics
+        )
+    else:
+        analyze_blocks_in_ranges(
+            fetched_blocks, fetched_internal_transfers, fetched_zeromev_blocks, metrics
+        )
     print("Finished zeroing in", time.time() - start, " seconds")
+    return metrics
 
-    return (
-        builder_atomic_map_block,
-        builder_atomic_map_tx,
-        builder_atomic_map_profit,
-        builder_atomic_map_vol,
-        builder_atomic_map_coin_bribe,
-        builder_atomic_map_gas_bribe,
-        builder_atomic_map_vol_list,
-        builder_nonatomic_map_block,
-        builder_nonatomic_map_tx,
-        builder_nonatomic_map_vol,
-        builder_nonatomic_map_coin_bribe,
-        builder_nonatomic_map_gas_bribe,
-        builder_nonatomic_map_vol_list,
-        coinbase_bribe,
-        after_bribe,
-        tob_bribe,
+
+def analyze_blocks_in_ranges(
+    fetched_blocks, fetched_internal_transfers, fetched_zeromev_blocks, metrics
+):
+    block_nums = list(fetched_blocks)
+    ranges = [
+        block_nums[i : i + ANALYSIS_RANGE_SIZE]
+        for i in range(0, len(block_nums), ANALYSIS_RANGE_SIZE)
+    ]
+
+    global analysis_input
+    registry = address_registry.get_registry()
+    analysis_input = (
+        fetched_blocks,
+        fetched_internal_transfers,
+        fetched_zeromev_blocks,
+        len(registry),
     )
+    try:
+        if ANALYSIS_PROCESSES > 1 and len(ranges) > 1 and can_fork():
+            # workers are forked, so they read the window without it being copied
+            with multiprocessing.get_context("fork").Pool(
+                min(ANALYSIS_PROCESSES, len(ranges))
+            ) as pool:
+                partials = pool.imap(analyze_block_range, ranges)
+                for partial_metrics, new_addresses in partials:
+                    merge_analysis_metrics(metrics, partial_metrics, new_addresses)
+        else:
+            analyze_block_range(block_nums, metrics)
+    finally:
+        analysis_input = None
 
 
 def chunks(data, SIZE=10000):
@@ -328,69 +424,58 @@ def create_mev_analysis(fetched_blocks, fetched_internal_transfers, fetched_zero
     start = time.time()
     print(f"Starting to load blocks at {start / 1000}")
 
-    builder_atomic_map_block = defaultdict(default_block_dic)
-    builder_atomic_map_tx = defaultdict(
-        lambda: defaultdict(atomic_mev.default_searcher_dic)
-    )
-    builder_atomic_map_profit = defaultdict(
-        lambda: defaultdict(atomic_mev.default_searcher_dic)
-    )
-    builder_atomic_map_vol = defaultdict(
-        lambda: defaultdict(atomic_mev.default_searcher_dic)
-    )
-    builder_atomic_map_coin_bribe = defaultdict(
-        lambda: defaultdict(atomic_mev.default_searcher_dic)
-    )
-    builder_atomic_map_gas_bribe = defaultdict(
-        lambda: defaultdict(atomic_mev.default_searcher_dic)
-    )
-    builder_atomic_map_vol_list = defaultdict(lambda: defaultdict(list))
-
-    builder_nonatomic_map_block = defaultdict(default_block_dic)
-    builder_nonatomic_map_tx = defaultdict(lambda: defaultdict(int))
-    builder_nonatomic_map_vol = defaultdict(lambda: defaultdict(int))
-    builder_nonatomic_map_coin_bribe = defaultdict(lambda: defaultdict(int))
-    builder_nonatomic_map_gas_bribe = defaultdict(lambda: defaultdict(int))
-    builder_nonatomic_map_vol_list = defaultdict(lambda: defaultdict(list))
-
-    # {searcher: {builder: [bribes]}}
-    coinbase_bribe = defaultdict(lambda: defaultdict(list))
-    after_bribe = defaultdict(lambda: defaultdict(list))
-    # {searcher: [{high_gas_tx_info}]}
-    tob_bribe = {}
+    metrics = analysis_metrics.AnalysisMetrics()
 
     pre_analysis = time.time()
     print(
         f"Finished loading blocks in {pre_analysis - start} seconds. Now analyzing {len(fetched_blocks)} blocks for both atomic and nonatomic."
     )
-    for fetched_blocks_chunks in chunks(fetched_blocks, 100000):
-        analyze_blocks(
-            fetched_blocks_chunks,
-            fetched_internal_transfers,
-            fetched_zeromev,
-            builder_atomic_map_block,
-            builder_atomic_map_tx,
-            builder_atomic_map_profit,
-            builder_atomic_map_vol,
-            builder_atomic_map_coin_bribe,
-            builder_atomic_map_gas_bribe,
-            builder_atomic_map_vol_list,
-            builder_nonatomic_map_block,
-            builder_nonatomic_map_tx,
-            builder_nonatomic_map_vol,
-            builder_nonatomic_map_coin_bribe,
-            builder_nonatomic_map_gas_bribe,
-            builder_nonatomic_map_vol_list,
-            coinbase_bribe,
-            after_bribe,
-            tob_bribe,
+    if ANALYSIS_BACKEND == "columnar" and ANALYSIS_PROCESSES > 1:
+        print("ANALYSIS_PROCESSES is ignored, the columnar backend uses one process")
+    if ANALYSIS_PARTIALS:
+        analysis_partials.analyze_window(
+            fetched_blocks, fetched_internal_transfers, fetched_zeromev, metrics
         )
+    else:
+        for fetched_blocks_chunks in chunks(fetched_blocks, 100000):
+            analyze_blocks(
+                fetched_blocks_chunks,
+                fetched_internal_transfers,
+                fetched_zeromev,
+                metrics,
+            )
 
     post_analysis = time.time()
     print(
         f"Finished analysis in {post_analysis - pre_analysis} seconds. Now compiling data."
     )
+    address_registry.get_registry().save()
+    # blocks analyzed in worker processes are resolved, and counted, there
+    stats = builder_resolver.get_resolver().stats()
+    if stats["hits"] + stats["misses"] > 0:
+        print(
+            f"Builder names: {stats['hits']} cache hits, {stats['misses']} misses, "
+            f"{stats['names']} distinct extraData"
+        )
 
+    (
+        builder_atomic_map_block,
+        builder_atomic_map_tx,
+        builder_atomic_map_profit,
+        builder_atomic_map_vol,
+        builder_atomic_map_coin_bribe,
+        builder_atomic_map_gas_bribe,
+        builder_atomic_map_vol_list,
+        builder_nonatomic_map_block,
+        builder_nonatomic_map_tx,
+        builder_nonatomic_map_vol,
+        builder_nonatomic_map_coin_bribe,
+        builder_nonatomic_map_gas_bribe,
+        builder_nonatomic_map_vol_list,
+        coinbase_bribe,
+        after_bribe,
+        tob_bribe,
+    ) = metrics.to_maps()
     atomic_mev.compile_atomic_data(
         builder_atomic_map_block,
         builder_atomic_map_tx,
@@ -0,0 +1,219 @@
+from array import array
+from collections.abc import Mapping, Sequence
+import address_registry
+
+# Compact in-memory form of the window's zeromev rows. Only the fields the analysis
+# reads are kept, in one column each for all rows of the window, with a block num
+# column and {block_num: (first row, end row)} slices. A MevTable reads like the
+# {block_num: [row]} dict it replaces: its values are sequences of MevRowViews,
+# which read like the row dicts, so analyze_block and get_mev_txs_of_blocks work
+# on either form. Whole columns are returned by column() for vectorized analysis.
+
+# the fields of a zeromev row the analysis reads, the others are dropped at ingest
+MEV_FIELDS = [
+    "tx_index",
+    "mev_type",
+    "protocol",
+    "address_from",
+    "address_to",
+    "extractor_profit_usd",
+    "extractor_swap_volume_usd",
+    "user_swap_volume_usd",
+]
+# fields kept as codes into the table's list of distinct values
+CODED_FIELDS = ["mev_type", "protocol"]
+ADDRESS_FIELDS = ["address_from", "address_to"]
+USD_FIELDS = [
+    "extractor_profit_usd",
+    "extractor_swap_volume_usd",
+    "user_swap_volume_usd",
+]
+NO_VALUE = -1  # in the int columns, for values kept in extra or absent
+
+
+# Returns the rows with only MEV_FIELDS, for storing the zeromev window
+def normalize_rows(rows):
+    return [
+        {field: row[field] for field in MEV_FIELDS if field in row}
+        for row in rows or []
+    ]
+
+
+class MevTable(Mapping):
+    def __init__(self, zeromev_blocks, registry=None):
+        self.registry = registry or address_registry.get_registry()
+        self.slices = {}  # block_num -> (first row, end row)
+        self.block_nums = array("q")
+        self.tx_indices = array("q")
+        self.values = []  # distinct values of the coded fields
+        self.codes = {}  # value -> its index in self.values
+        self.coded = {field: array("q") for field in CODED_FIELDS}
+        self.addresses = {field: array("q") for field in ADDRESS_FIELDS}
+        # nan for values kept in extra or absent
+        self.usd = {field: array("d") for field in USD_FIELDS}
+        # {row: {field: value}} for values that do not fit their column, e.g. a
+        # profit of None or an int
+        self.extra = {}
+
+        for block_num in sorted(zeromev_blocks, key=int):
+            first = len(self.block_nums)
+            for row in zeromev_blocks[block_num] or []:
+                self.append(int(block_num), row)
+            self.slices[str(block_num)] = (first, len(self.block_nums))
+
+    def append(self, block_num, row):
+        index = len(self.block_nums)
+        self.block_nums.append(block_num)
+        extra = {}
+
+        tx_index = row.get("tx_index", None)
+        if type(tx_index) is int and tx_index >= 0:
+            self.tx_indices.append(tx_index)
+        else:
+            self.tx_indices.append(NO_VALUE)
+            if "tx_index" in row:
+                extra["tx_index"] = tx_index
+
+        for field in CODED_FIELDS:
+            if field not in row:
+                self.coded[field].append(NO_VALUE)
+                continue
+            value = row[field]
+            code = self.codes.get(value)
+            if code is None:
+                code = len(self.values)
+                self.values.append(value)
+                self.codes[value] = code
+            self.coded[field].append(code)
+
+        for field in ADDRESS_FIELDS:
+            value = row.get(field)
+            address_id = self.registry.intern(value) if type(value) is str else None
+            # kept as given when interning would change it, e.g. checksummed
+            if address_id is not None and self.registry.address(address_id) == value:
+                self.addresses[field].append(address_id)
+            else:
+                self.addresses[field].append(NO_VALUE)
+                if field in row:
+                    extra[field] = value
+
+        for field in USD_FIELDS:
+            value = row.get(field)
+            if type(value) is float and value == value:
+                self.usd[field].append(value)
+            else:
+                self.usd[field].append(float("nan"))
+                if field in row:
+                    extra[field] = value
+
+        if len(extra) > 0:
+            self.extra[index] = extra
+
+    def __getitem__(self, block_num):
+        first, end = self.slices[str(block_num)]
+        return MevRows(self, first, end)
+
+    def __contains__(self, block_num):
+        return str(block_num) in self.slices
+
+    def __iter__(self):
+        return iter(self.slices)
+
+    def __len__(self):
+        return len(self.slices)
+
+    def num_rows(self):
+        return len(self.block_nums)
+
+    def has_field(self, index, field):
+        if field in self.extra.get(index, {}):
+            return True
+        if field == "tx_index":
+            return self.tx_indices[index] != NO_VALUE
+        if field in CODED_FIELDS:
+            return self.coded[field][index] != NO_VALUE
+        if field in ADDRESS_FIELDS:
+            return self.addresses[field][index] != NO_VALUE
+        if field in USD_FIELDS:
+            value = self.usd[field][index]
+            return value == value
+        return False
+
+    def get_field(self, index, field):
+        extra = self.extra.get(index)
+        if extra is not None and field in extra:
+            return extra[field]
+        if not self.has_field(index, field):
+            raise KeyError(field)
+        if field == "tx_index":
+            return self.tx_indices[index]
+        if field in CODED_FIELDS:
+            return self.values[self.coded[field][index]]
+        if field in ADDRESS_FIELDS:
+            return self.registry.address(self.addresses[field][index])
+        return self.usd[field][index]
+
+    def column(self, field):
+        """
+        Returns field's value for every row of the window, in block order, e.g. to
+        be used with the block_nums column. Values that are absent are None.
+        """
+        if field == "block_number":
+            return list(self.block_nums)
+        return [
+            self.get_field(index, field) if self.has_field(index, field) else None
+            for index in range(self.num_rows())
+        ]
+
+    # the {block_num: [row dict]} form, e.g. for storing
+    def to_dict(self):
+        return {
+            block_num: [dict(row) for row in self[block_num]]
+            for block_num in self.slices
+        }
+
+
+class MevRows(Sequence):
+    __slots__ = ("table", "first", "end")
+
+    def __init__(self, table, first, end):
+        self.table = table
+        self.first = first
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.first
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("row index out of range")
+        return MevRowView(self.table, self.first + i)
+
+    def __repr__(self):
+        return repr([dict(row) for row in self])
+
+
+class MevRowView(Mapping):
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, field):
+        return self.table.get_field(self.index, field)
+
+    def __iter__(self):
+        return (
+            field for field in MEV_FIELDS if self.table.has_field(self.index, field)
+        )
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
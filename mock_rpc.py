@@ -0,0 +1,306 @@
+import sys
+import json
+import random
+import threading
+from collections import defaultdict
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the JSON-RPC provider, serving a synthetic (or recorded)
+# chain so the fetchers can be run and their request counts measured offline.
+# Point secret_keys.ALCHEMY at the url returned by start_server, or
+# main_mev.ZEROMEV_URL at the one returned with handler=MockZeromevHandler.
+
+ASSET_TRANSFERS_PAGE_SIZE = 1000  # alchemy_getAssetTransfers default maxCount
+ZEROMEV_MAX_COUNT = 100  # largest count the zeromev mevBlock API accepts
+MEV_TYPES = ["arb", "frontrun", "backrun", "sandwich", "liquid", "swap"]
+
+
+def random_hex(rng, num_bytes):
+    return "0x" + "".join(f"{rng.randrange(256):02x}" for _ in range(num_bytes))
+
+
+def make_chain(start_block, num_blocks, txs_per_block=10, num_recipients=5, seed=0):
+    """
+    Returns {"blocks": {num: block}, "receipts": {num: [receipt]}, "transfers": [transfer],
+    "zeromev": {num: [row]}} with blocks and receipts shaped like eth_getBlockByNumber
+    and alchemy_getTransactionReceipts results, transfers like alchemy_getAssetTransfers
+    and zeromev rows like mevBlock rows.
+    """
+    rng = random.Random(seed)
+    recipients = [random_hex(rng, 20) for _ in range(num_recipients)]
+    blocks = {}
+    receipts = {}
+    transfers = []
+    zeromev = {}
+
+    for num in range(start_block, start_block + num_blocks):
+        fee_recipient = rng.choice(recipients)
+        block_hash = random_hex(rng, 32)
+        txs = []
+        block_receipts = []
+        for i in range(txs_per_block):
+            tx = {
+                "transactionIndex": hex(i),
+                "hash": random_hex(rng, 32),
+                "from": random_hex(rng, 20),
+                "to": random_hex(rng, 20),
+                "value": hex(rng.randrange(10**18)),
+                "gasPrice": hex(rng.randrange(10**9, 10**11)),
+                "blockHash": block_hash,
+                "blockNumber": hex(num),
+            }
+            txs.append(tx)
+            block_receipts.append(
+                {
+                    "transactionIndex": hex(i),
+                    "transactionHash": tx["hash"],
+                    "blockNumber": hex(num),
+                    "blockHash": block_hash,
+                    "effectiveGasPrice": tx["gasPrice"],
+                    "gasUsed": hex(rng.randrange(21000, 500000)),
+                }
+            )
+            # coinbase transfers to this block's fee recipient, and the odd
+            # transfer to a recipient that did not propose this block
+            if rng.random() < 0.1:
+                to = fee_recipient if rng.random() < 0.8 else rng.choice(recipients)
+                transfers.append(
+                    {
+                        "blockNum": hex(num),
+                        "hash": tx["hash"],
+                        "from": tx["to"],
+                        "to": to,
+                        "value": rng.randrange(1, 10**6) / 10**6,
+                        "category": "internal",
+                    }
+                )
+
+        blocks[num] = {
+            "number": hex(num),
+            "hash": block_hash,
+            "miner": fee_recipient,
+            "extraData": "0x" + b"beaverbuild.org".hex(),
+            "baseFeePerGas": hex(rng.randrange(10**9, 5 * 10**10)),
+            "gasUsed": hex(rng.randrange(10**6, 3 * 10**7)),
+            "transactions": txs,
+        }
+        receipts[num] = block_receipts
+        zeromev[num] = [
+            {
+                "block_number": num,
+                "tx_index": i,
+                "mev_type": rng.choice(MEV_TYPES),
+                "protocol": rng.choice(["uniswap3", "multiple"]),
+                "user_swap_count": 1,
+                "user_swap_volume_usd": rng.randrange(10**6) / 100,
+                "extractor_profit_usd": rng.randrange(10**4) / 100,
+                "extractor_swap_volume_usd": rng.randrange(10**6) / 100,
+                "address_from": txs[i]["from"],
+                "address_to": txs[i]["to"],
+            }
+            for i in sorted(rng.sample(range(txs_per_block), min(3, txs_per_block)))
+        ]
+
+    return {
+        "blocks": blocks,
+        "receipts": receipts,
+        "transfers": transfers,
+        "zeromev": zeromev,
+    }
+
+
+class RPCError(Exception):
+    pass
+
+
+# chain["finalized"], when set, is the block the "finalized" and "safe" tags point at
+def block_number_param(chain, param):
+    if param in ("finalized", "safe") and "finalized" in chain:
+        return chain["finalized"]
+    if param in ("latest", "finalized", "safe"):
+        return max(chain["blocks"])
+    return int(param, 16)
+
+
+def eth_block_number(chain, params):
+    return hex(max(chain["blocks"]))
+
+
+def eth_get_block_by_number(chain, params):
+    block = chain["blocks"].get(block_number_param(chain, params[0]))
+    if block is None or len(params) < 2 or params[1]:
+        return block
+    return {**block, "transactions": [tx["hash"] for tx in block["transactions"]]}
+
+
+def find_tx(chain, tx_hash):
+    if "tx_locations" not in chain:
+        chain["tx_locations"] = {
+            tx["hash"]: (num, i)
+            for num, block in chain["blocks"].items()
+            for i, tx in enumerate(block["transactions"])
+        }
+    if tx_hash not in chain["tx_locations"]:
+        raise RPCError(f"tx {tx_hash} not found")
+    return chain["tx_locations"][tx_hash]
+
+
+def eth_get_transaction_by_hash(chain, params):
+    num, i = find_tx(chain, params[0])
+    return chain["blocks"][num]["transactions"][i]
+
+
+def eth_get_transaction_receipt(chain, params):
+    num, i = find_tx(chain, params[0])
+    return chain["receipts"][num][i]
+
+
+def eth_get_block_receipts(chain, params):
+    return chain["receipts"].get(block_number_param(chain, params[0]))
+
+
+def alchemy_get_transaction_receipts(chain, params):
+    num = int(params[0]["blockNumber"], 16)
+    if num not in chain["receipts"]:
+        raise RPCError(f"block {num} not found")
+    return {"receipts": chain["receipts"][num]}
+
+
+def alchemy_get_asset_transfers(chain, params):
+    query = params[0]
+    from_block = int(query.get("fromBlock", "0x0"), 16)
+    to_block = block_number_param(chain, query.get("toBlock", "latest"))
+    to_address = query.get("toAddress")
+    page_size = int(query.get("maxCount", hex(ASSET_TRANSFERS_PAGE_SIZE)), 16)
+    offset = int(query.get("pageKey", "0"))
+
+    matches = [
+        tr
+        for tr in chain["transfers"]
+        if from_block <= int(tr["blockNum"], 16) <= to_block
+        and (to_address is None or tr["to"] == to_address)
+        and tr["category"] in query.get("category", [tr["category"]])
+    ]
+    result = {"transfers": matches[offset : offset + page_size]}
+    if offset + page_size < len(matches):
+        result["pageKey"] = str(offset + page_size)
+    return result
+
+
+METHODS = {
+    "eth_blockNumber": eth_block_number,
+    "eth_getBlockByNumber": eth_get_block_by_number,
+    "eth_getTransactionByHash": eth_get_transaction_by_hash,
+    "eth_getTransactionReceipt": eth_get_transaction_receipt,
+    "eth_getBlockReceipts": eth_get_block_receipts,
+    "alchemy_getTransactionReceipts": alchemy_get_transaction_receipts,
+    "alchemy_getAssetTransfers": alchemy_get_asset_transfers,
+}
+
+
+# chain["unavailable"], when set, maps a method to the block nums it fails for. A
+# post carrying a call of one of them fails as a whole with a 503, as in an outage.
+def is_unavailable(chain, call):
+    block_nums = chain.get("unavailable", {}).get(call.get("method"), ())
+    params = call.get("params", [])
+    if len(block_nums) == 0 or len(params) == 0:
+        return False
+    param = params[0]["blockNumber"] if isinstance(params[0], dict) else params[0]
+    return block_number_param(chain, param) in block_nums
+
+
+def handle_call(chain, call):
+    response = {"jsonrpc": "2.0", "id": call.get("id")}
+    method = METHODS.get(call.get("method"))
+    if method is None:
+        response["error"] = {"code": -32601, "message": "method not found"}
+        return response
+    try:
+        response["result"] = method(chain, call.get("params", []))
+    except (RPCError, KeyError, ValueError, IndexError) as e:
+        response["error"] = {"code": -32000, "message": str(e)}
+    return response
+
+
+class MockRPCHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        calls = body if isinstance(body, list) else [body]
+        with server.lock:
+            server.stats["http_requests"] += 1
+            for call in calls:
+                server.stats["calls"][call.get("method")] += 1
+
+        if any(is_unavailable(server.chain, call) for call in calls):
+            self.send_json(503, {"error": "service unavailable"})
+            return
+        responses = [handle_call(server.chain, call) for call in calls]
+        self.send_json(200, responses if isinstance(body, list) else responses[0])
+
+
+# Serves GET /v1/mevBlock?block_number=&count= from chain["zeromev"]
+class MockZeromevHandler(MockRPCHandler):
+    def do_GET(self):
+        server = self.server
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        with server.lock:
+            server.stats["http_requests"] += 1
+            server.stats["calls"][url.path] += 1
+
+        try:
+            start = int(query["block_number"][0])
+            count = int(query.get("count", ["1"])[0])
+        except (KeyError, ValueError):
+            self.send_json(400, {"error": "block_number and count must be integers"})
+            return
+        if url.path != "/v1/mevBlock" or not 1 <= count <= ZEROMEV_MAX_COUNT:
+            self.send_json(400, {"error": f"count must be 1-{ZEROMEV_MAX_COUNT}"})
+            return
+
+        rows = []
+        for num in range(start, start + count):
+            rows += server.chain["zeromev"].get(num, [])
+        self.send_json(200, rows)
+
+
+def start_server(chain, port=0, handler=MockRPCHandler):
+    """
+    Serves chain on localhost in a background thread. Returns (server, url);
+    server.stats counts http requests and calls per method, server.shutdown() stops it.
+    """
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.chain = chain
+    server.lock = threading.Lock()
+    server.stats = {"http_requests": 0, "calls": defaultdict(int)}
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+if __name__ == "__main__":
+    # python mock_rpc.py [port] [start_block] [num_blocks]
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8545
+    start_block = int(sys.argv[2]) if len(sys.argv) > 2 else 18000000
+    num_blocks = int(sys.argv[3]) if len(sys.argv) > 3 else 1000
+    chain = make_chain(start_block, num_blocks)
+    server, url = start_server(chain, port)
+    print(f"Serving blocks {start_block}-{start_block + num_blocks - 1} at {url}")
+    zeromev_server, zeromev_url = start_server(chain, port + 1, MockZeromevHandler)
+    print(f"Serving zeromev rows at {zeromev_url}/v1/mevBlock")
+    threading.Event().wait()
@@ -1,5 +1,6 @@
 import statistics
 import helpers
+import address_registry
 
 
 def calculate_block_median_gas_price(transactions):
@@ -27,15 +28,8 @@ def analyze_tx(
     top_of_block_boundary,
     block_base_fee,
     addrs_counted_in_block,
-    builder_nonatomic_map_block,
-    builder_nonatomic_map_tx,
-    builder_nonatomic_map_vol,
-    builder_nonatomic_map_coin_bribe,
-    builder_nonatomic_map_gas_bribe,
-    builder_nonatomic_map_vol_list,
-    coinbase_bribe,
-    after_bribe,
-    tob_bribe,
+    metrics,
+    registry,
 ):
     """
     For any uni-directional swaps detected by zeromev, we classify it as a CEX-DEX arbitrage if it meets one of the following criteria:
@@ -49,75 +43,85 @@ def analyze_tx(
     tx_index = swap["tx_index"]
     tx_volume = swap.get("user_swap_volume_usd", 0) or 0
 
-    addr_to = (swap.get("address_to") or "").lower()
-    addr_from = (swap.get("address_from") or "").lower()  # Corrected to "address_from"
-    if addr_to == "" or addr_from == "":
+    addr_to = swap.get("address_to")
+    addr_from = swap.get("address_from")  # Corrected to "address_from"
+    if not addr_to or not addr_from:
         return
+    # searchers are keyed by address id, see address_registry
+    addr_to = registry.intern(addr_to)
+    addr_from = registry.intern(addr_from)
+    # the metrics of analysis_metrics.AnalysisMetrics, keyed by (builder, searcher)
+    block_counts = metrics.builder_nonatomic_map_block
+    tx_counts = metrics.builder_nonatomic_map_tx
+    volumes = metrics.builder_nonatomic_map_vol
+    coin_bribes = metrics.builder_nonatomic_map_coin_bribe
+    gas_bribes = metrics.builder_nonatomic_map_gas_bribe
+    volume_lists = metrics.builder_nonatomic_map_vol_list
 
     if full_tx["hash"] in transfer_map.keys():
-        builder_nonatomic_map_tx[builder][addr_to] += 1
-        builder_nonatomic_map_vol[builder][addr_to] += tx_volume
-        builder_nonatomic_map_vol_list[builder][addr_to].append(tx_volume)
+        key = (builder, addr_to)
+        tx_counts.add(key, 1)
+        volumes.add(key, tx_volume)
+        volume_lists.append(key, tx_volume)
 
-        builder_nonatomic_map_coin_bribe[builder][addr_to] += transfer_map[
-            full_tx["hash"]
-        ]["value"]
+        coin_bribes.add(key, transfer_map[full_tx["hash"]]["value"])
 
         tx_priority_fee = (
             full_tx["gasUsed"] * full_tx["gasPrice"]
             - full_tx["gasUsed"] * block_base_fee
         )
 
-        builder_nonatomic_map_gas_bribe[builder][addr_to] += tx_priority_fee
+        gas_bribes.add(key, tx_priority_fee)
 
-        coinbase_bribe[addr_to][builder].append(transfer_map[full_tx["hash"]]["value"])
+        metrics.coinbase_bribe.append(
+            (addr_to, builder), transfer_map[full_tx["hash"]]["value"]
+        )
 
         if addr_to not in addrs_counted_in_block:
-            builder_nonatomic_map_block[builder][addr_to] += 1
+            block_counts.add(key, 1)
             addrs_counted_in_block.add(addr_to)
 
     elif followed_by_transfer_to_builder(fee_recipient, full_tx, full_next_tx) == True:
         # mev bot collected here will be an EOA
-        builder_nonatomic_map_tx[builder][addr_from] += 1
-        builder_nonatomic_map_vol[builder][addr_from] += tx_volume
-        builder_nonatomic_map_vol_list[builder][addr_from].append(tx_volume)
-        builder_nonatomic_map_coin_bribe[builder][addr_from] += helpers.wei_to_eth(
-            full_next_tx["value"]
-        )
-
-        after_bribe[addr_from][builder].append(
-            helpers.wei_to_eth(full_next_tx["value"])
+        key = (builder, addr_from)
+        tx_counts.add(key, 1)
+        volumes.add(key, tx_volume)
+        volume_lists.append(key, tx_volume)
+        coin_bribes.add(key, helpers.wei_to_eth(full_next_tx["value"]))
+
+        metrics.after_bribe.append(
+            (addr_from, builder), helpers.wei_to_eth(full_next_tx["value"])
         )
 
         if addr_from not in addrs_counted_in_block:
-            builder_nonatomic_map_block[builder][addr_from] += 1
+            block_counts.add(key, 1)
             addrs_counted_in_block.add(addr_from)
 
     # if within top of block (first 10%):
     elif tx_index <= top_of_block_boundary:
-        builder_nonatomic_map_tx[builder][addr_to] += 1
-        builder_nonatomic_map_vol[builder][addr_to] += tx_volume
-        builder_nonatomic_map_vol_list[builder][addr_to].append(tx_volume)
-        builder_nonatomic_map_gas_bribe[builder][addr_to] += (
-            full_tx["gasUsed"] * full_tx["gasPrice"]
-        )
+        key = (builder, addr_to)
+        tx_counts.add(key, 1)
+        volumes.add(key, tx_volume)
+        volume_lists.append(key, tx_volume)
+        gas_bribes.add(key, full_tx["gasUsed"] * full_tx["gasPrice"])
         tx_priority_fee = (
             full_tx["gasUsed"] * full_tx["gasPrice"]
             - full_tx["gasUsed"] * block_base_fee
         )
 
-        builder_nonatomic_map_gas_bribe[builder][addr_to] += tx_priority_fee
+        gas_bribes.add(key, tx_priority_fee)
 
-        tob_bribe.setdefault(addr_to, []).append(
+        metrics.tob_bribe.append(
+            (addr_to,),
             {
                 "builder": builder,
                 "block_number": block_number,
                 "index": tx_index,
                 "gas_price": full_tx["gasPrice"],
-            }
+            },
         )
         if addr_to not in addrs_counted_in_block:
-            builder_nonatomic_map_block[builder][addr_to] += 1
+            block_counts.add(key, 1)
             addrs_counted_in_block.add(addr_to)
 
 
@@ -132,6 +136,24 @@ def compile_cefi_defi_data(
     after_bribe,
     tob_bribe,
 ):
+    # back from address ids to hex addresses before anything is written out
+    registry = address_registry.get_registry()
+    builder_nonatomic_map_block = registry.hex_keys(builder_nonatomic_map_block, 1)
+    builder_nonatomic_map_tx = registry.hex_keys(builder_nonatomic_map_tx, 1)
+    builder_nonatomic_map_vol = registry.hex_keys(builder_nonatomic_map_vol, 1)
+    builder_nonatomic_map_coin_bribe = registry.hex_keys(
+        builder_nonatomic_map_coin_bribe, 1
+    )
+    builder_nonatomic_map_gas_bribe = registry.hex_keys(
+        builder_nonatomic_map_gas_bribe, 1
+    )
+    builder_nonatomic_map_vol_list = registry.hex_keys(
+        builder_nonatomic_map_vol_list, 1
+    )
+    coinbase_bribe = registry.hex_keys(coinbase_bribe)
+    after_bribe = registry.hex_keys(after_bribe)
+    tob_bribe = registry.hex_keys(tob_bribe)
+
     # trimmed_map = searcher_db.clean_up(builder_nonatomic_map, 5)
     helpers.dump_dict_to_json(
         builder_nonatomic_map_block,
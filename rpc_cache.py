@@ -0,0 +1,217 @@
+import os
+import gzip
+import json
+import sqlite3
+import hashlib
+import threading
+
+# Persistent cache of raw RPC and zeromev responses, keyed by (method, block number).
+# Calls by tx hash are keyed by the block they were looked up for, see TX_KEYED_METHODS.
+# Response bodies are stored once per content digest under objects/, the index
+# remembers which digest answers which (method, block) and under which block hash.
+# When a block comes back with another hash (a reorg), every entry of that block
+# is dropped so that it is fetched again.
+CACHE_DIR = "blockchain_data/rpc_cache/"
+ENABLED = True
+
+# Methods whose calls are keyed by the block number in their first param
+BLOCK_KEYED_METHODS = {"eth_getBlockByNumber", "eth_getBlockReceipts"}
+# Methods whose calls are keyed by a tx hash. fetch_blocks.build_tx_call gives them
+# an id of "block_num:tx_index", they are cached per tx index under that block.
+TX_KEYED_METHODS = {"eth_getTransactionByHash", "eth_getTransactionReceipt"}
+
+
+class RPCCache:
+    def __init__(self, cache_dir=CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(os.path.join(cache_dir, "objects"), exist_ok=True)
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            os.path.join(cache_dir, "index.sqlite"), check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "method TEXT, block_num INTEGER, block_hash TEXT, digest TEXT, "
+            "PRIMARY KEY (method, block_num))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS block_hashes ("
+            "block_num INTEGER PRIMARY KEY, block_hash TEXT)"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest)")
+        self.db.commit()
+        self.stats = {"hits": 0, "misses": 0, "invalidated_blocks": 0}
+
+    def object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest + ".json.gz")
+
+    def block_hash(self, block_num):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT block_hash FROM block_hashes WHERE block_num = ?",
+                (int(block_num),),
+            ).fetchone()
+        return row[0] if row else None
+
+    def record_block_hash(self, block_num, block_hash):
+        """
+        Remembers the hash a block was fetched with. If it differs from the one
+        recorded before, the block was reorged and all of its entries are dropped.
+        Returns True when that happened.
+        """
+        previous = self.block_hash(block_num)
+        if previous == block_hash:
+            return False
+        reorged = previous is not None
+        if reorged:
+            print(f"block {block_num} changed hash {previous} -> {block_hash}")
+            self.invalidate_block(block_num)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO block_hashes VALUES (?, ?)",
+                (int(block_num), block_hash),
+            )
+            self.db.commit()
+        return reorged
+
+    def invalidate_block(self, block_num):
+        with self.lock:
+            digests = [
+                row[0]
+                for row in self.db.execute(
+                    "SELECT digest FROM entries WHERE block_num = ?", (int(block_num),)
+                )
+            ]
+            self.db.execute(
+                "DELETE FROM entries WHERE block_num = ?", (int(block_num),)
+            )
+            self.db.execute(
+                "DELETE FROM block_hashes WHERE block_num = ?", (int(block_num),)
+            )
+            self.db.commit()
+            # objects are shared between entries with the same content
+            for digest in set(digests):
+                still_used = self.db.execute(
+                    "SELECT 1 FROM entries WHERE digest = ? LIMIT 1", (digest,)
+                ).fetchone()
+                if still_used is None and os.path.exists(self.object_path(digest)):
+                    os.remove(self.object_path(digest))
+            self.stats["invalidated_blocks"] += 1
+
+    def get(self, method, block_num):
+        """
+        Returns the cached response of method for block_num, or None. Entries
+        stored under another hash than the block's current one are stale.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT e.digest, e.block_hash, h.block_hash FROM entries e "
+                "LEFT JOIN block_hashes h ON h.block_num = e.block_num "
+                "WHERE e.method = ? AND e.block_num = ?",
+                (method, int(block_num)),
+            ).fetchone()
+        if row is None or (row[1] is not None and row[2] not in (None, row[1])):
+            self.stats["misses"] += 1
+            return None
+        try:
+            with gzip.open(self.object_path(row[0]), "rb") as f:
+                result = json.loads(f.read())
+        except (OSError, ValueError):
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return result
+
+    def put(self, method, block_num, result, block_hash=None):
+        if block_hash is None:
+            block_hash = self.block_hash(block_num)
+        data = json.dumps(result, separators=(",", ":")).encode()
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            with gzip.open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                (method, int(block_num), block_hash, digest),
+            )
+            self.db.commit()
+
+    # JSON-RPC calls that are keyed by a block number, e.g. eth_getBlockByNumber
+    # with and without full txs are cached under different keys
+    def call_key(self, call):
+        if call.get("method") in TX_KEYED_METHODS:
+            block_num, _, tx_index = str(call.get("id")).partition(":")
+            if not block_num.isdigit() or not tx_index.isdigit():
+                return None
+            return f"{call['method']}:{tx_index}", int(block_num)
+        if call.get("method") not in BLOCK_KEYED_METHODS:
+            return None
+        params = call.get("params", [])
+        if len(params) == 0 or not str(params[0]).startswith("0x"):
+            return None  # tags like "latest" are not cacheable
+        method = call["method"]
+        if method == "eth_getBlockByNumber" and not (len(params) > 1 and params[1]):
+            method += ":header"
+        return method, int(params[0], 16)
+
+    def get_call(self, call):
+        key = self.call_key(call)
+        if key is None:
+            return None
+        return self.get(*key)
+
+    def put_call(self, call, result):
+        key = self.call_key(call)
+        if key is None or result is None:
+            return
+        method, block_num = key
+        if method.startswith("eth_getBlockByNumber"):
+            block_hash = result["hash"]
+            self.record_block_hash(block_num, block_hash)
+            self.put(method, block_num, result, block_hash)
+        elif method == "eth_getBlockReceipts":
+            self.put_receipts(method, block_num, result)
+        else:
+            self.put_tx(method, block_num, result)
+
+    # Receipts carry the hash of their block, receipts from another fork than
+    # the block we hold are not cached
+    def put_receipts(self, method, block_num, receipts):
+        if len(receipts) == 0:
+            self.put(method, block_num, receipts)
+            return
+        block_hash = receipts[0].get("blockHash")
+        known_hash = self.block_hash(block_num)
+        if known_hash is not None and block_hash != known_hash:
+            return
+        self.put(method, block_num, receipts, block_hash)
+
+    # Same for a tx or a receipt looked up by hash, which may have landed in
+    # another block than the one it is cached under
+    def put_tx(self, method, block_num, result):
+        block_hash = result.get("blockHash")
+        known_hash = self.block_hash(block_num)
+        if block_hash is None or (known_hash is not None and block_hash != known_hash):
+            return
+        self.put(method, block_num, result, block_hash)
+
+
+_shared_cache = None
+_shared_lock = threading.Lock()
+
+
+# Returns the shared cache, or None when caching is disabled
+def get_cache():
+    global _shared_cache
+    if not ENABLED:
+        return None
+    with _shared_lock:
+        if _shared_cache is None:
+            _shared_cache = RPCCache(CACHE_DIR)
+        return _shared_cache
@@ -0,0 +1,224 @@
+import time
+import heapq
+import asyncio
+import threading
+import itertools
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+# One scheduler is shared by every fetcher so that they draw from the same
+# per-endpoint budgets instead of each bursting its own 64-thread pool at the
+# provider. Budgets are those of the plan in use, adjust to the account's limits.
+ENDPOINT_LIMITS = {
+    "alchemy": {"requests_per_sec": 300, "compute_units_per_sec": 10000},
+    "zeromev": {"requests_per_sec": 20, "compute_units_per_sec": None},
+}
+
+# Alchemy compute units charged per method call
+COMPUTE_UNITS = {
+    "eth_blockNumber": 10,
+    "eth_getBlockByNumber": 16,
+    "eth_getTransactionByHash": 17,
+    "eth_getTransactionReceipt": 15,
+    "alchemy_getAssetTransfers": 150,
+    "alchemy_getTransactionReceipts": 250,
+    "eth_getBlockReceipts": 500,
+}
+
+MAX_WORKERS = 64
+MAX_ATTEMPTS = 5  # attempts per request before it is reported as failed
+INITIAL_BACKOFF = 1  # seconds, doubled on every attempt
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class RetryableError(Exception):
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def compute_units(method, count=1):
+    return COMPUTE_UNITS.get(method, 0) * count
+
+
+# Returns the number of seconds asked for by a Retry-After header, which is
+# either delta-seconds or an HTTP date
+def parse_retry_after(value):
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Raises RetryableError for throttling and transient server errors so that the
+# scheduler puts the request back on its retry queue instead of dropping it
+def check_response(response):
+    status = getattr(response, "status_code", None) or getattr(response, "status")
+    if status == 200:
+        return
+    retry_after = parse_retry_after(response.headers.get("Retry-After"))
+    if status in RETRY_STATUS_CODES:
+        raise RetryableError(f"status {status}", retry_after)
+    raise Exception(f"Non-success status code received: {status}")
+
+
+class TokenBucket:
+    """
+    Refills at `rate` tokens per second up to `capacity`. A reservation larger
+    than what is available puts the bucket in debt and returns how long the
+    caller has to wait, so a single large batch is allowed but paid for.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def reserve(self, cost=1):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+            self.tokens -= cost
+            wait = 0 if self.tokens >= 0 else -self.tokens / self.rate
+            return max(wait, self.paused_until - now)
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RequestScheduler:
+    def __init__(self, limits=ENDPOINT_LIMITS, max_workers=MAX_WORKERS):
+        self.max_workers = max_workers
+        self.request_buckets = {}
+        self.compute_buckets = {}
+        for endpoint, limit in limits.items():
+            self.request_buckets[endpoint] = TokenBucket(limit["requests_per_sec"])
+            if limit.get("compute_units_per_sec"):
+                self.compute_buckets[endpoint] = TokenBucket(
+                    limit["compute_units_per_sec"]
+                )
+
+    # seconds until a request of `cost` compute units may be sent to endpoint
+    def reserve(self, endpoint, cost=0):
+        wait = self.request_buckets[endpoint].reserve(1)
+        if endpoint in self.compute_buckets:
+            wait = max(wait, self.compute_buckets[endpoint].reserve(cost))
+        return wait
+
+    def acquire(self, endpoint, cost=0):
+        wait = self.reserve(endpoint, cost)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self, endpoint, cost=0):
+        wait = self.reserve(endpoint, cost)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    # honours a Retry-After from the endpoint for every fetcher using it
+    def pause(self, endpoint, seconds):
+        self.request_buckets[endpoint].pause(seconds)
+
+    def run(self, jobs, name="requests"):
+        """
+        Runs jobs, a list of (key, endpoint, cost, fn) tuples, on a shared
+        worker pool at the pace the endpoint budgets allow. fn() performs one
+        request and raises on failure. It may return a list of follow-up jobs,
+        e.g. the next page of a paginated call, which are queued right away.
+        Failed jobs go back on a single retry queue ordered by the time they
+        may run again, so workers never sleep.
+        Returns {key: error} for the jobs that failed MAX_ATTEMPTS times.
+        """
+        start = time.time()
+        seq = itertools.count()
+        queue = [(0, next(seq), job, 0) for job in jobs]
+        heapq.heapify(queue)
+        num_jobs = [len(jobs)]
+        failed = {}
+        in_flight = [0]
+        cond = threading.Condition()
+
+        def execute(job, attempt):
+            key, endpoint, cost, fn = job
+            delay = None
+            follow_ups = None
+            try:
+                follow_ups = fn()
+            except RetryableError as e:
+                error = e
+                if e.retry_after is not None:
+                    self.pause(endpoint, e.retry_after)
+                    delay = e.retry_after
+            except Exception as e:
+                error = e
+            else:
+                error = None
+
+            with cond:
+                in_flight[0] -= 1
+                for follow_up in follow_ups or []:
+                    heapq.heappush(queue, (0, next(seq), follow_up, 0))
+                    num_jobs[0] += 1
+                if error is not None:
+                    if attempt + 1 >= MAX_ATTEMPTS:
+                        failed[key] = repr(error)
+                    else:
+                        if delay is None:
+                            delay = INITIAL_BACKOFF * (2**attempt)
+                        heapq.heappush(
+                            queue,
+                            (time.monotonic() + delay, next(seq), job, attempt + 1),
+                        )
+                cond.notify()
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                with cond:
+                    if len(queue) == 0 and in_flight[0] == 0:
+                        break
+                    if len(queue) == 0 or in_flight[0] >= self.max_workers:
+                        cond.wait()
+                        continue
+                    not_before = queue[0][0] - time.monotonic()
+                    if not_before > 0:
+                        cond.wait(timeout=not_before)
+                        continue
+                    _, _, job, attempt = heapq.heappop(queue)
+                    in_flight[0] += 1
+
+                wait = self.reserve(job[1], job[2])
+                if wait > 0:
+                    time.sleep(wait)
+                executor.submit(execute, job, attempt)
+
+        print(
+            f"Finished {num_jobs[0]} {name} in {time.time() - start} seconds, {len(failed)} failed"
+        )
+        if len(failed) > 0:
+            print(f"Failed {name}:", failed)
+        return failed
+
+
+_shared_scheduler = None
+_shared_lock = threading.Lock()
+
+
+def get_scheduler():
+    global _shared_scheduler
+    with _shared_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = RequestScheduler(ENDPOINT_LIMITS)
+        return _shared_scheduler
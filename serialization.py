@@ -0,0 +1,150 @@
+import io
+import os
+import json
+import ijson
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Serialization behind helpers.load_dict_from_json and dump_dict_to_json. The format
+# a file is written in is picked by the first matching path prefix below, e.g.
+# "orjson+zstd", and detected from the file's first bytes when it is loaded, so
+# files written in any format (or by older versions, as plain JSON) load the same.
+#   json     the standard library encoder
+#   orjson   the same JSON, several times faster to write
+#   msgpack  binary, smaller and faster to load, but only for data whose ints fit
+#            64 bits and whose keys are strings
+#   +zstd    compresses the above
+# A format whose library is not installed, or that cannot encode the data (orjson
+# and msgpack reject ints over 64 bits, e.g. wei sums), falls back to json.
+# orjson writes nan as null, so the outputs that chartprep reads, whose sums and
+# medians can be nan, are kept in json.
+FORMATS_BY_PATH = [
+    ("blockchain_data/", "orjson+zstd"),
+    ("", "json"),
+]
+ZSTD_LEVEL = 3
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# first bytes of a JSON document, anything else is taken as msgpack
+JSON_START = set(b' \t\r\n{["-0123456789tfn')
+# ijson backends tried in turn by stream_items. The C one is about 20x faster but
+# fails on ints over 64 bits, which the pure python one reads. ijson may be
+# installed without the C one.
+STREAM_BACKENDS = [ijson.get_backend("python")]
+try:
+    STREAM_BACKENDS.insert(0, ijson.get_backend("yajl2_c"))
+except ImportError:
+    pass
+
+
+def format_for_path(filename):
+    for prefix, format in FORMATS_BY_PATH:
+        if filename.startswith(prefix):
+            return format
+    return "json"
+
+
+def encode(obj, format, default=None):
+    name, _, compression = format.partition("+")
+    data = None
+    try:
+        if name == "orjson" and orjson is not None:
+            data = orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)
+        elif name == "msgpack" and msgpack is not None:
+            data = msgpack.packb(obj, default=default)
+    except (TypeError, OverflowError, ValueError):
+        data = None
+    if data is None:
+        data = json.dumps(obj, default=default).encode()
+
+    if compression == "zstd" and zstandard is not None:
+        data = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return data
+
+
+# Raises for a file written in a format whose library is not installed here
+def require(module, name):
+    if module is None:
+        raise ImportError(f"{name} is needed to read this file, pip install {name}")
+    return module
+
+
+def decode(data):
+    if data[:4] == ZSTD_MAGIC:
+        decompressor = require(zstandard, "zstandard").ZstdDecompressor()
+        data = decompressor.decompressobj().decompress(data)
+    if len(data) == 0 or data[0] in JSON_START:
+        # the standard decoder, orjson reads ints over 64 bits as floats
+        return json.loads(data)
+    return require(msgpack, "msgpack").unpackb(data, strict_map_key=False)
+
+
+# written to a temp file first, so a crash never leaves a partly written file
+def dump(obj, filename, format=None, default=None):
+    data = encode(obj, format or format_for_path(filename), default)
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+
+def load(filename):
+    with open(filename, "rb") as f:
+        return decode(f.read())
+
+
+# Opens filename for streaming reads (e.g. with ijson), decompressing it if needed
+def open_stream(filename):
+    f = open(filename, "rb")
+    if f.read(4) == ZSTD_MAGIC:
+        f.seek(0)
+        if zstandard is None:
+            f.close()
+            require(zstandard, "zstandard")
+        return zstandard.ZstdDecompressor().stream_reader(f, closefd=True)
+    f.seek(0)
+    return f
+
+
+# Opens filename for streaming writes of JSON, compressing it if its path's format
+# says so. Streamed files are always JSON (or zstd JSON) so stream_items reads them.
+def open_write_stream(filename):
+    f = open(filename, "wb")
+    if format_for_path(filename).endswith("+zstd") and zstandard is not None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(f, closefd=True)
+    return f
+
+
+def stream_items(filename):
+    """
+    Yields the (key, value) pairs of a dict file in file order, parsing JSON one
+    value at a time. When the fast backend hits an int over 64 bits, the file is
+    read again with the next backend, skipping the pairs already yielded.
+    msgpack files cannot be streamed and are loaded whole.
+    """
+    yielded = 0
+    for backend in STREAM_BACKENDS:
+        try:
+            with io.BufferedReader(open_stream(filename)) as f:
+                head = f.peek(1)[:1]
+                if len(head) > 0 and head[0] not in JSON_START:
+                    yield from decode(f.read()).items()
+                    return
+                for i, item in enumerate(backend.kvitems(f, "", use_float=True)):
+                    if i >= yielded:
+                        yielded += 1
+                        yield item
+            return
+        except ijson.common.IncompleteJSONError as e:
+            if "integer overflow" not in str(e) or backend is STREAM_BACKENDS[-1]:
+                raise
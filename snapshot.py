@@ -0,0 +1,198 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import tarfile
+import main
+import helpers
+import rpc_cache
+import sqlite_store
+
+# Snapshots of a deployment's state, for starting a new one without refetching the
+# window: the window stores, the finalized block num, the address registry and the
+# compiled maps and aggs. A snapshot is a tar of those files and a manifest with the
+# snapshot version and each file's sha256. The block data in it is already
+# compressed (see serialization.py), so the tar is not. After an import, the next
+# update only fetches the blocks since the snapshot.
+#   python snapshot.py export [snapshot_file]
+#   python snapshot.py import snapshot_file [--force]
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FILE = "snapshot.tar"
+SNAPSHOT_PATHS = ["blockchain_data/", "atomic/fourteen/", "nonatomic/fourteen/"]
+# the rpc cache is only needed for refetching, and a snapshot is taken between updates
+SNAPSHOT_EXCLUDED = [rpc_cache.CACHE_DIR, main.JOURNAL_FILE]
+MANIFEST_NAME = "manifest.json"
+# files are extracted here and moved into place once all checksums match
+IMPORT_DIR = "snapshot_import.tmp/"
+COPY_CHUNK = 1 << 20
+
+
+class HashingReader:
+    """File wrapper computing the sha256 of what is read, so a file is read once."""
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.sha256.update(data)
+        return data
+
+
+def is_excluded(path):
+    if path.endswith(".tmp") or path.endswith("-wal") or path.endswith("-shm"):
+        return True
+    return any(path.startswith(excluded) for excluded in SNAPSHOT_EXCLUDED)
+
+
+def snapshot_files():
+    files = []
+    for root in SNAPSHOT_PATHS:
+        for directory, _, names in os.walk(root):
+            for name in names:
+                path = os.path.join(directory, name).replace(os.sep, "/")
+                if not is_excluded(path):
+                    files.append(path)
+    return sorted(files)
+
+
+# the database as a single consistent file, with its WAL checkpointed into it
+def copy_database(db_file, copy_file):
+    db, lock = sqlite_store.connect(db_file)
+    copy = sqlite3.connect(copy_file)
+    with lock:
+        db.backup(copy)
+    copy.close()
+
+
+def export_snapshot(snapshot_file=SNAPSHOT_FILE):
+    if os.path.exists(main.JOURNAL_FILE):
+        print("An update is in progress, let it finish before taking a snapshot")
+        return
+
+    start = time.time()
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "created": int(start),
+        "store_backend": main.STORE_BACKEND,
+        "finalized": None,
+        "files": {},
+    }
+    if os.path.exists(main.FINALIZED_FILE):
+        manifest["finalized"] = helpers.load_dict_from_json(main.FINALIZED_FILE)[
+            "finalized"
+        ]
+
+    tmp = snapshot_file + ".tmp"
+    with tarfile.open(tmp, "w") as tar:
+        for path in snapshot_files():
+            source = path
+            if path == sqlite_store.DB_FILE:
+                source = snapshot_file + ".sqlite.tmp"
+                copy_database(path, source)
+            with open(source, "rb") as f:
+                info = tar.gettarinfo(arcname=path, fileobj=f)
+                reader = HashingReader(f)
+                tar.addfile(info, reader)
+            if source != path:
+                os.remove(source)
+            manifest["files"][path] = {
+                "size": info.size,
+                "sha256": reader.sha256.hexdigest(),
+            }
+
+        data = json.dumps(manifest, indent=1).encode()
+        info = tarfile.TarInfo(MANIFEST_NAME)
+        info.size = len(data)
+        info.mtime = manifest["created"]
+        tar.addfile(info, io.BytesIO(data))
+    os.replace(tmp, snapshot_file)
+    print(
+        f"Exported {len(manifest['files'])} files to {snapshot_file} in "
+        f"{time.time() - start} seconds, finalized block {manifest['finalized']}"
+    )
+
+
+def read_manifest(tar):
+    manifest = json.load(tar.extractfile(MANIFEST_NAME))
+    if manifest.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(
+            f"Snapshot version {manifest.get('version')} is not {SNAPSHOT_VERSION}"
+        )
+    if manifest["store_backend"] != main.STORE_BACKEND:
+        raise ValueError(
+            f"Snapshot of a {manifest['store_backend']} store, this deployment uses "
+            f"{main.STORE_BACKEND}"
+        )
+    for path in manifest["files"]:
+        if os.path.isabs(path) or ".." in path.split("/"):
+            raise ValueError(f"Snapshot file {path} is outside the deployment")
+    return manifest
+
+
+def import_snapshot(snapshot_file, force=False):
+    """
+    Restores a snapshot taken by export_snapshot. Every file is checked against
+    the manifest before any is moved into place, so a corrupt snapshot leaves
+    the deployment as it was. Refuses to overwrite stores that hold data unless
+    force is set.
+    """
+    stores = [main.BLOCK_STORE, main.TR_STORE, main.ZEROMEV_STORE]
+    if not force and not all(store.is_empty() for store in stores):
+        print("The window stores are not empty, use --force to overwrite them")
+        return
+
+    start = time.time()
+    shutil.rmtree(IMPORT_DIR, ignore_errors=True)
+    try:
+        with tarfile.open(snapshot_file, "r") as tar:
+            manifest = read_manifest(tar)
+            for path, expected in manifest["files"].items():
+                member = tar.getmember(path)
+                if not member.isfile():
+                    raise ValueError(f"Snapshot file {path} is not a regular file")
+                target = os.path.join(IMPORT_DIR, path)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                reader = HashingReader(tar.extractfile(member))
+                with open(target, "wb") as f:
+                    shutil.copyfileobj(reader, f, COPY_CHUNK)
+                if (
+                    member.size != expected["size"]
+                    or reader.sha256.hexdigest() != expected["sha256"]
+                ):
+                    raise ValueError(f"Snapshot file {path} fails its checksum")
+
+        for store in stores:
+            if hasattr(store, "close"):
+                store.close()
+        # the old database's WAL would be applied to the new one
+        for path in [sqlite_store.DB_FILE + "-wal", sqlite_store.DB_FILE + "-shm"]:
+            if sqlite_store.DB_FILE in manifest["files"] and os.path.exists(path):
+                os.remove(path)
+        for path in manifest["files"]:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            os.replace(os.path.join(IMPORT_DIR, path), path)
+    finally:
+        shutil.rmtree(IMPORT_DIR, ignore_errors=True)
+
+    print(
+        f"Imported {len(manifest['files'])} files from {snapshot_file} in "
+        f"{time.time() - start} seconds, finalized block {manifest['finalized']}"
+    )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "export":
+        export_snapshot(sys.argv[2] if len(sys.argv) > 2 else SNAPSHOT_FILE)
+    elif len(sys.argv) > 2 and sys.argv[1] == "import":
+        import_snapshot(sys.argv[2], force="--force" in sys.argv[3:])
+    else:
+        print(
+            "usage: python snapshot.py export [snapshot_file]\n"
+            "       python snapshot.py import snapshot_file [--force]"
+        )
@@ -0,0 +1,310 @@
+import os
+import json
+import sqlite3
+import threading
+import helpers
+
+# Optional SQLite backend for the window (see main.STORE_BACKEND). Blocks, their txs,
+# transfers and zeromev rows go to indexed tables of one database in WAL mode, so a
+# range of blocks is read without parsing the rest, readers (e.g. a chart rebuild)
+# can run while an update writes, and a crashed update leaves the last committed
+# state. SQLiteStore has the same interface as block_store.PartitionedStore.
+DB_FILE = "blockchain_data/blockchain.sqlite"
+LOAD_CHUNK = 1000  # blocks read per query, and per write when importing a file
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS blocks (
+    block_num INTEGER PRIMARY KEY, hash TEXT, fee_recipient TEXT, extra_data TEXT,
+    base_fee_per_gas INTEGER, gas_used INTEGER, num_txs INTEGER
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    block_num INTEGER, tx_index INTEGER, hash TEXT, from_address TEXT,
+    to_address TEXT, value TEXT, gas_price INTEGER, gas_used INTEGER,
+    PRIMARY KEY (block_num, tx_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS transactions_hash ON transactions (hash);
+CREATE INDEX IF NOT EXISTS transactions_to ON transactions (to_address);
+CREATE TABLE IF NOT EXISTS transfer_blocks (block_num INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS transfers (
+    block_num INTEGER, hash TEXT, from_address TEXT, to_address TEXT, value REAL,
+    PRIMARY KEY (block_num, hash)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS zeromev_blocks (block_num INTEGER PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS mev_rows (
+    block_num INTEGER, row_num INTEGER, tx_index INTEGER, mev_type TEXT,
+    address_from TEXT, address_to TEXT, row TEXT,
+    PRIMARY KEY (block_num, row_num)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS mev_rows_address_to ON mev_rows (address_to);
+"""
+
+# {kind: tables holding it, the first one has a row for every stored block}
+KIND_TABLES = {
+    "blocks": ["blocks", "transactions"],
+    "transfers": ["transfer_blocks", "transfers"],
+    "zeromev": ["zeromev_blocks", "mev_rows"],
+}
+
+_connections = {}
+_connections_lock = threading.Lock()
+
+
+# one connection per database file, shared by the stores of the three kinds
+def connect(db_file):
+    with _connections_lock:
+        if db_file not in _connections:
+            os.makedirs(os.path.dirname(db_file) or ".", exist_ok=True)
+            db = sqlite3.connect(db_file, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            db.executescript(SCHEMA)
+            _connections[db_file] = (db, threading.Lock())
+        return _connections[db_file]
+
+
+def close(db_file):
+    with _connections_lock:
+        if db_file in _connections:
+            db, lock = _connections.pop(db_file)
+            with lock:
+                db.close()
+
+
+class SQLiteStore:
+    def __init__(self, db_file, kind):
+        self.db_file = db_file
+        self.kind = kind
+        self.tables = KIND_TABLES[kind]
+        self.directory = f"{db_file}:{kind}"
+
+    def connection(self):
+        return connect(self.db_file)
+
+    def close(self):
+        close(self.db_file)
+
+    def __contains__(self, block_num):
+        db, lock = self.connection()
+        with lock:
+            row = db.execute(
+                f"SELECT 1 FROM {self.tables[0]} WHERE block_num = ?",
+                (int(block_num),),
+            ).fetchone()
+        return row is not None
+
+    def is_empty(self):
+        db, lock = self.connection()
+        with lock:
+            row = db.execute(f"SELECT 1 FROM {self.tables[0]} LIMIT 1").fetchone()
+        return row is None
+
+    def get(self, block_num, default=None):
+        return self.load(int(block_num), int(block_num)).get(str(block_num), default)
+
+    # transform is applied to each block as it is read, e.g. tx_table.compact_block.
+    # Blocks are read LOAD_CHUNK at a time so that only those are held untransformed.
+    def load(self, start, end, transform=None):
+        db, lock = self.connection()
+        load_kind = getattr(self, f"load_{self.kind}")
+        data = {}
+        for chunk_start in range(start, end + 1, LOAD_CHUNK):
+            chunk_end = min(end, chunk_start + LOAD_CHUNK - 1)
+            with lock:
+                chunk = load_kind(db, chunk_start, chunk_end)
+            for block_num, value in chunk.items():
+                data[block_num] = value if transform is None else transform(value)
+        return data
+
+    def write(self, data, dropped=()):
+        """
+        Replaces the stored data of the blocks in data, {block_num: value}, and
+        deletes the dropped block nums, in a single transaction.
+        """
+        block_nums = [(int(block_num),) for block_num in list(data) + list(dropped)]
+        if len(block_nums) == 0:
+            return
+        db, lock = self.connection()
+        with lock, db:
+            for table in self.tables:
+                db.executemany(f"DELETE FROM {table} WHERE block_num = ?", block_nums)
+            getattr(self, f"insert_{self.kind}")(db, data)
+        print(f"Wrote {len(data)} blocks to {self.directory}")
+
+    # only the rows of data are written, so a checkpoint is a write
+    def checkpoint(self, data):
+        self.write(data)
+
+    def flush(self):
+        pass
+
+    def expire(self, start):
+        db, lock = self.connection()
+        with lock, db:
+            for table in self.tables:
+                db.execute(f"DELETE FROM {table} WHERE block_num < ?", (start,))
+
+    def import_file(self, filename):
+        print(f"Importing {filename} into {self.directory}")
+        for chunk in helpers.load_dict_in_chunks(filename, LOAD_CHUNK):
+            self.write(chunk)
+
+    # BLOCKS
+
+    def insert_blocks(self, db, blocks):
+        db.executemany(
+            "INSERT INTO blocks VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    int(block_num),
+                    block["hash"],
+                    block["feeRecipient"],
+                    block["extraData"],
+                    block["baseFeePerGas"],
+                    block["gasUsed"],
+                    len(block["transactions"]),
+                )
+                for block_num, block in blocks.items()
+            ],
+        )
+        db.executemany(
+            "INSERT INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    int(block_num),
+                    tx["transactionIndex"],
+                    tx["hash"],
+                    tx["from"],
+                    tx["to"],
+                    str(tx["value"]),  # wei values overflow sqlite integers
+                    tx["gasPrice"],
+                    tx.get("gasUsed"),
+                )
+                for block_num, block in blocks.items()
+                for tx in block["transactions"]
+                if tx is not None
+            ],
+        )
+
+    def load_blocks(self, db, start, end):
+        blocks = {}
+        for (
+            block_num,
+            block_hash,
+            fee_recipient,
+            extra_data,
+            base_fee,
+            gas_used,
+            num_txs,
+        ) in db.execute(
+            "SELECT * FROM blocks WHERE block_num BETWEEN ? AND ? ORDER BY block_num",
+            (start, end),
+        ):
+            blocks[str(block_num)] = {
+                "hash": block_hash,
+                "extraData": extra_data,
+                "feeRecipient": fee_recipient,
+                "baseFeePerGas": base_fee,
+                "gasUsed": gas_used,
+                # txs left out of sparse (zeromev_first) blocks stay None
+                "transactions": [None] * num_txs,
+            }
+        for (
+            block_num,
+            tx_index,
+            tx_hash,
+            sender,
+            to,
+            value,
+            gas_price,
+            gas_used,
+        ) in db.execute(
+            "SELECT * FROM transactions WHERE block_num BETWEEN ? AND ?", (start, end)
+        ):
+            tx = {
+                "transactionIndex": tx_index,
+                "hash": tx_hash,
+                "from": sender,
+                "to": to,
+                "value": int(value),
+                "gasPrice": gas_price,
+            }
+            if gas_used is not None:
+                tx["gasUsed"] = gas_used
+            blocks[str(block_num)]["transactions"][tx_index] = tx
+        return blocks
+
+    # TRANSFERS
+
+    def insert_transfers(self, db, transfers):
+        db.executemany(
+            "INSERT INTO transfer_blocks VALUES (?)",
+            [(int(block_num),) for block_num in transfers],
+        )
+        db.executemany(
+            "INSERT INTO transfers VALUES (?, ?, ?, ?, ?)",
+            [
+                (int(block_num), tx_hash, tr["from"], tr["to"], tr["value"])
+                for block_num, transfer_map in transfers.items()
+                for tx_hash, tr in transfer_map.items()
+            ],
+        )
+
+    def load_transfers(self, db, start, end):
+        transfers = {
+            str(block_num): {}
+            for (block_num,) in db.execute(
+                "SELECT block_num FROM transfer_blocks WHERE block_num BETWEEN ? AND ? "
+                "ORDER BY block_num",
+                (start, end),
+            )
+        }
+        for block_num, tx_hash, sender, to, value in db.execute(
+            "SELECT * FROM transfers WHERE block_num BETWEEN ? AND ?", (start, end)
+        ):
+            transfers[str(block_num)][tx_hash] = {
+                "from": sender,
+                "to": to,
+                "value": value,
+            }
+        return transfers
+
+    # ZEROMEV
+
+    def insert_zeromev(self, db, zeromev_blocks):
+        db.executemany(
+            "INSERT INTO zeromev_blocks VALUES (?)",
+            [(int(block_num),) for block_num in zeromev_blocks],
+        )
+        db.executemany(
+            "INSERT INTO mev_rows VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    int(block_num),
+                    row_num,
+                    row.get("tx_index"),
+                    row.get("mev_type"),
+                    row.get("address_from"),
+                    row.get("address_to"),
+                    json.dumps(row),
+                )
+                for block_num, rows in zeromev_blocks.items()
+                for row_num, row in enumerate(rows or [])
+            ],
+        )
+
+    def load_zeromev(self, db, start, end):
+        zeromev_blocks = {
+            str(block_num): []
+            for (block_num,) in db.execute(
+                "SELECT block_num FROM zeromev_blocks WHERE block_num BETWEEN ? AND ? "
+                "ORDER BY block_num",
+                (start, end),
+            )
+        }
+        for block_num, row in db.execute(
+            "SELECT block_num, row FROM mev_rows WHERE block_num BETWEEN ? AND ? "
+            "ORDER BY block_num, row_num",
+            (start, end),
+        ):
+            zeromev_blocks[str(block_num)].append(json.loads(row))
+        return zeromev_blocks
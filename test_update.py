@@ -0,0 +1,122 @@
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+from functools import partial
+from unittest import mock
+
+try:
+    import secret_keys
+except ImportError:
+    # the keys file is not checked in, the fetchers are pointed at the mock servers
+    secret_keys = types.ModuleType("secret_keys")
+    sys.modules["secret_keys"] = secret_keys
+
+import mock_rpc
+import scheduler
+import rpc_cache
+import block_store
+import fetch_blocks
+import main_mev
+import main
+
+START = 1000
+END = 1199
+
+
+# Runs main.update_worker against the mock RPC and zeromev servers, with the
+# window stored in a temporary directory and the analysis and charts left out
+class UpdateWithFailedReceiptsTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = partial(os.path.join, directory)
+
+        self.chain = mock_rpc.make_chain(START, END - START + 1, txs_per_block=3)
+        # every post of the receipts batch holding block 1060 fails
+        self.chain["unavailable"] = {"eth_getBlockReceipts": {1060}}
+        server, url = mock_rpc.start_server(self.chain)
+        zeromev_server, zeromev_url = mock_rpc.start_server(
+            self.chain, handler=mock_rpc.MockZeromevHandler
+        )
+        self.addCleanup(server.shutdown)
+        self.addCleanup(zeromev_server.shutdown)
+
+        self.analyzed = []
+        patches = [
+            mock.patch.object(secret_keys, "ALCHEMY", url, create=True),
+            mock.patch.object(main_mev, "ZEROMEV_URL", zeromev_url + "/v1/mevBlock"),
+            mock.patch.object(rpc_cache, "ENABLED", False),
+            mock.patch.object(fetch_blocks, "INITIAL_BACKOFF", 0),
+            mock.patch.object(scheduler, "INITIAL_BACKOFF", 0),
+            # the mock servers are not throttled, neither are the requests to them
+            mock.patch.object(
+                scheduler,
+                "_shared_scheduler",
+                scheduler.RequestScheduler(
+                    {
+                        endpoint: {"requests_per_sec": 10000}
+                        for endpoint in scheduler.ENDPOINT_LIMITS
+                    }
+                ),
+            ),
+            mock.patch.object(
+                fetch_blocks,
+                "add_receipts_gas_used_to_blocks",
+                partial(
+                    fetch_blocks.add_receipts_gas_used_to_blocks, backend="standard"
+                ),
+            ),
+            mock.patch.object(
+                fetch_blocks, "get_new_start_and_end_block_nums", lambda: (START, END)
+            ),
+            mock.patch.object(main, "BLOCK_FILE", path("blocks.json")),
+            mock.patch.object(main, "TR_FILE", path("transfers.json")),
+            mock.patch.object(main, "ZEROMEV_FILE", path("zeromev.json")),
+            mock.patch.object(main, "FINALIZED_FILE", path("finalized.json")),
+            mock.patch.object(main, "JOURNAL_FILE", path("journal.json")),
+            mock.patch.object(main, "BLOCK_STORE", block_store.BlockLog(path("bl/"))),
+            mock.patch.object(
+                main, "TR_STORE", block_store.PartitionedStore(path("tr/"), 100)
+            ),
+            mock.patch.object(
+                main, "ZEROMEV_STORE", block_store.PartitionedStore(path("zm/"), 100)
+            ),
+            mock.patch.object(
+                main_mev,
+                "create_mev_analysis",
+                lambda *args: self.analyzed.append(args),
+            ),
+            mock.patch.object(main.chartprep, "create_html_page", lambda: None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_update_finishes_without_the_failed_receipts_batch(self):
+        main.update_worker()
+
+        self.assertFalse(os.path.exists(main.JOURNAL_FILE))
+        blocks, trs, zeromev_blocks = self.analyzed[-1]
+        missing = [b for b in range(START, END + 1) if str(b) not in blocks]
+        self.assertIn(1060, missing)
+        self.assertEqual(len(missing), fetch_blocks.RECEIPTS_BATCH_SIZE)
+        for block_num in missing:
+            self.assertNotIn(str(block_num), main.BLOCK_STORE)
+            self.assertNotIn(str(block_num), trs)
+
+        # the next update fetches the blocks that were left out
+        self.chain["unavailable"] = {}
+        main.update_worker()
+
+        blocks, trs, zeromev_blocks = self.analyzed[-1]
+        self.assertEqual(len(blocks), END - START + 1)
+        self.assertEqual(len(trs), END - START + 1)
+        block = main.BLOCK_STORE.load(1060, 1060)["1060"]
+        self.assertTrue(all(tx["gasUsed"] > 0 for tx in block["transactions"]))
+
+
+if __name__ == "__main__":
+    unittest.main()
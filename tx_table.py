@@ -0,0 +1,153 @@
+from array import array
+from collections.abc import Mapping
+
+# Compact in-memory form of a block's simplified txs (see fetch_blocks.simplify_tx).
+# Hashes and addresses are kept as fixed-width binary and numbers in typed arrays,
+# about 110 bytes per tx instead of a dict of strings and ints. Indexing a TxTable
+# returns a TxView, which reads (and takes gasUsed) like the tx dict it replaces, so
+# analyze_block, add_gas_used_to_blocks and calculate_builder_profitability work on
+# either form.
+
+# {field: number of bytes} of the fields kept as binary
+BINARY_FIELDS = {"hash": 32, "from": 20, "to": 20}
+# fields in the order simplify_tx creates them
+TX_FIELDS = ["transactionIndex", "hash", "from", "to", "value", "gasPrice"]
+MAX_UINT64 = 2**64 - 1
+
+
+class TxTable:
+    def __init__(self, txs):
+        n = len(txs)
+        # 0 for the txs a sparse (zeromev_first) block did not fetch
+        self.present = bytearray(n)
+        self.binary = {
+            field: bytearray(size * n) for field, size in BINARY_FIELDS.items()
+        }
+        # values are wei and may not fit 64 bits, so they are split in two columns
+        self.values_low = array("Q", bytes(8 * n))
+        self.values_high = array("Q", bytes(8 * n))
+        self.gas_prices = array("Q", bytes(8 * n))
+        self.gas_used = array("Q", bytes(8 * n))
+        self.has_gas_used = bytearray(n)
+        # {index: {field: value}} for values that do not fit their column, e.g. a
+        # contract creation's "to" of None, and for fields the table does not know
+        self.extra = {}
+
+        for index, tx in enumerate(txs):
+            if tx is None:
+                continue
+            self.present[index] = 1
+            for field, value in tx.items():
+                self.set_field(index, field, value)
+
+    def __len__(self):
+        return len(self.present)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("tx index out of range")
+        return TxView(self, index) if self.present[index] else None
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def to_list(self):
+        return [None if tx is None else dict(tx) for tx in self]
+
+    def fields(self, index):
+        fields = list(TX_FIELDS)
+        if self.has_gas_used[index]:
+            fields.append("gasUsed")
+        for field in self.extra.get(index, {}):
+            if field not in fields:
+                fields.append(field)
+        return fields
+
+    def get_field(self, index, field):
+        extra = self.extra.get(index)
+        if extra is not None and field in extra:
+            return extra[field]
+        if field == "transactionIndex":
+            return index
+        if field in BINARY_FIELDS:
+            size = BINARY_FIELDS[field]
+            return "0x" + self.binary[field][index * size : (index + 1) * size].hex()
+        if field == "value":
+            return (self.values_high[index] << 64) | self.values_low[index]
+        if field == "gasPrice":
+            return self.gas_prices[index]
+        if field == "gasUsed" and self.has_gas_used[index]:
+            return self.gas_used[index]
+        raise KeyError(field)
+
+    def set_field(self, index, field, value):
+        if self.set_column(index, field, value):
+            extra = self.extra.get(index)
+            if extra is not None:
+                extra.pop(field, None)
+                if len(extra) == 0:
+                    del self.extra[index]
+        else:
+            self.extra.setdefault(index, {})[field] = value
+
+    # stores value in its column, returns False when it does not fit one exactly
+    def set_column(self, index, field, value):
+        if field == "transactionIndex":
+            return value == index
+        if field in BINARY_FIELDS:
+            size = BINARY_FIELDS[field]
+            if not isinstance(value, str) or len(value) != 2 + 2 * size:
+                return False
+            try:
+                raw = bytes.fromhex(value[2:])
+            except ValueError:
+                return False
+            if "0x" + raw.hex() != value:  # e.g. checksummed addresses
+                return False
+            self.binary[field][index * size : (index + 1) * size] = raw
+            return True
+        if type(value) is not int or value < 0:
+            return False
+        if field == "value" and value <= 2**128 - 1:
+            self.values_low[index] = value & MAX_UINT64
+            self.values_high[index] = value >> 64
+            return True
+        if field == "gasPrice" and value <= MAX_UINT64:
+            self.gas_prices[index] = value
+            return True
+        if field == "gasUsed" and value <= MAX_UINT64:
+            self.gas_used[index] = value
+            self.has_gas_used[index] = 1
+            return True
+        return False
+
+
+class TxView(Mapping):
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, field):
+        return self.table.get_field(self.index, field)
+
+    def __setitem__(self, field, value):
+        self.table.set_field(self.index, field, value)
+
+    def __iter__(self):
+        return iter(self.table.fields(self.index))
+
+    def __len__(self):
+        return len(self.table.fields(self.index))
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+# Returns block with its txs in a TxTable, to be used as BLOCK_STORE.load's transform
+def compact_block(block):
+    return {**block, "transactions": TxTable(block["transactions"])}